@@ -12,7 +12,27 @@ if __name__ == "__main__":
     # pin
     parser.add_argument("pin", type=str, help="the PIN of the smartcard")
 
+    # table
+    parser.add_argument("--table", type=int, default=None, help="the table to sit at, any open one if omitted")
+
+    # party size
+    parser.add_argument("--party-max", type=int, default=None, help="the number of players needed for the game to start at the caller's table")
+
+    # workers
+    parser.add_argument("--workers", type=int, default=None, help="processes used to decrypt the deck and compute the cards")
+
+    # software token
+    parser.add_argument("--softcard", type=str, default=None, help="file with the key of a software token standing in for the smartcard, made if missing")
+    parser.add_argument("--softcard-latency", type=float, default=0, help="seconds every operation on the software token takes")
+
+    # profiling
+    parser.add_argument("--profile", type=str, default=None, help="file the stacks of the profiled handlers are written to on exit, as collapsed stacks")
+
     args = parser.parse_args()
 
+    # restrictions
+    if args.party_max is not None and args.party_max <= 0:
+        parser.error("the party size must be greater than zero")
+
     # create playing area object
-    caller = Caller(args.nickname, args.pin)
+    caller = Caller(args.nickname, args.pin, args.table, args.workers, args.softcard, args.softcard_latency, args.profile, args.party_max)
@@ -12,7 +12,20 @@ if __name__ == "__main__":
     # pin
     parser.add_argument("pin", type=str, help="the PIN of the smartcard")
 
+    # table
+    parser.add_argument("--table", type=int, default=None, help="the table to sit at, any open one if omitted")
+
+    # workers
+    parser.add_argument("--workers", type=int, default=None, help="processes used to decrypt the deck and compute the cards")
+
+    # software token
+    parser.add_argument("--softcard", type=str, default=None, help="file with the key of a software token standing in for the smartcard, made if missing")
+    parser.add_argument("--softcard-latency", type=float, default=0, help="seconds every operation on the software token takes")
+
+    # profiling
+    parser.add_argument("--profile", type=str, default=None, help="file the stacks of the profiled handlers are written to on exit, as collapsed stacks")
+
     args = parser.parse_args()
 
     # create playing area object
-    player = Player(args.nickname, args.pin)
+    player = Player(args.nickname, args.pin, args.table, args.workers, args.softcard, args.softcard_latency, args.profile)
@@ -12,6 +12,32 @@ if __name__ == "__main__":
     # deck size
     parser.add_argument("deck_size", type=int, help="the size of the deck, from 1 to N")
 
+    # party size
+    parser.add_argument("--party-max", type=int, default=None, help="the number of players needed for a game to start at each table")
+
+    # server mode
+    parser.add_argument("--asyncio", action="store_true", help="serve every connection in its own coroutine instead of the selector loop")
+
+    # audit log signing
+    parser.add_argument("--strict-signing", action="store_true", help="sign every audit log entry as it is logged instead of one checkpoint per epoch of entries")
+
+    # audit log storage
+    parser.add_argument("--log-dir", default=PlayingArea.LOG_DIR, help="directory the audit logs are kept in, they are kept in memory if none is given")
+    parser.add_argument("--log-fsync", choices=["always", "epoch", "never"], default=PlayingArea.LOG_FSYNC, help="when the audit logs are synced to disk")
+
+    # callers
+    parser.add_argument("--callers", type=str, default=None, help="file with the public keys of the smartcards that can be callers, one per line as the base64 modulus and exponent")
+
+    # countdown
+    parser.add_argument("--countdown", type=float, default=None, help="seconds between a party filling up and its game starting")
+
+    # metrics
+    parser.add_argument("--stats-file", type=str, default=None, help="file the metrics are dumped to every so often, as JSON")
+    parser.add_argument("--stats-interval", type=float, default=None, help="seconds between dumps of the metrics")
+
+    # profiling
+    parser.add_argument("--profile", type=str, default=None, help="file the stacks of the profiled handlers are written to on exit, as collapsed stacks")
+
     args = parser.parse_args()
 
     # restrictions
@@ -21,6 +47,19 @@ if __name__ == "__main__":
         parser.error("the deck size must be greater than zero")
     if args.deck_size <= args.card_size:
         parser.error("the card size must be lesser than the deck size")
+    if args.party_max is not None and args.party_max <= 0:
+        parser.error("the party size must be greater than zero")
+    if args.countdown is not None and args.countdown < 0:
+        parser.error("the countdown cannot be negative")
+    if args.stats_interval is not None and args.stats_interval <= 0:
+        parser.error("the stats interval must be greater than zero")
+
+    # the caller keys are kept as the (modulus, exponent) tuples the users send
+    callers = None
+    if args.callers:
+        with open(args.callers) as f:
+            callers = set(tuple(line.split()) for line in f if line.strip())
 
     # create playing area object
-    playing_area = PlayingArea(args.card_size, args.deck_size)
+    playing_area = PlayingArea(args.card_size, args.deck_size, args.party_max, args.asyncio, 'entry' if args.strict_signing else 'epoch',
+                               args.log_dir, args.log_fsync, callers, args.countdown, args.stats_file, args.stats_interval, args.profile)
@@ -0,0 +1,71 @@
+"""Compares the JSON and binary codecs on the messages of the card generation.
+
+Run from the repository root: python -m benchmarks.codec_bench
+"""
+import argparse # for parsing command line arguments
+import base64
+import os
+import time
+
+from src.protocol import Proto, Message, GenerateCard, Records
+
+def layer_sizes(players : int) -> list:
+    """Size of the ciphertext records at each encryption layer. Every layer encrypts the base64 of the previous one"""
+    sizes = [16] # numbers are padded to a single AES block by the caller
+    for _ in range(players):
+        b64_size = 4 * ((sizes[-1] + 2) // 3)
+        sizes.append((b64_size // 16 + 1) * 16) # PKCS7 always adds padding
+    return sizes
+
+def game_messages(deck_size : int, players : int) -> list:
+    """Every GENCARD transmission of a game: (message, times sent) tuples"""
+    signature = base64.b64encode(os.urandom(256)).decode('ascii')
+    messages = []
+    for layer, size in enumerate(layer_sizes(players)):
+        deck = Records(os.urandom(size * deck_size), size) # as users keep the deck they encrypted
+        # user -> playing area -> next user
+        messages.append((GenerateCard(layer + 1, deck, [signature] * (layer + 1)), 2))
+
+    # the committed deck goes to the playing area and from there to every player
+    last = messages[-1][0]
+    messages.append((GenerateCard(last.sequence, last.deck, last.signatures + [signature], True), 1 + players))
+    return messages
+
+def round_trip(codec : str, messages : list) -> None:
+    """Checks that every message decodes to what was encoded, an empty deck included"""
+    for msg, _ in messages + [(GenerateCard(1, [], []), 1)]:
+        frame = b''.join(Proto.encode_msg(msg, codec))[Proto.HEADER_SIZE:]
+        decoded = Proto.parse_msg(memoryview(frame))
+        if Message.wire_fields(decoded) != Message.wire_fields(msg):
+            raise SystemExit(f'the {codec} codec does not round-trip {msg.header} (deck of {len(msg.deck)})')
+
+def measure(codec : str, messages : list) -> tuple:
+    """Returns the encode time, decode time and bytes on the wire of a game"""
+    encode_time, decode_time, total = 0, 0, 0
+    for msg, times in messages:
+        start = time.perf_counter()
+        buffers = Proto.encode_msg(msg, codec)
+        encode_time += (time.perf_counter() - start) * times
+
+        frame = b''.join(buffers)[Proto.HEADER_SIZE:]
+        total += len(frame) * times
+
+        start = time.perf_counter()
+        Proto.parse_msg(memoryview(frame))
+        decode_time += (time.perf_counter() - start) * times
+    return encode_time, decode_time, total
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="codec benchmark")
+    parser.add_argument("--sizes", type=str, default="100,10000,1000000", help="comma separated deck sizes")
+    parser.add_argument("--players", type=int, default=2, help="number of players in the game")
+    args = parser.parse_args()
+
+    print(f'{"deck":>9} {"codec":>7} {"encode (s)":>11} {"decode (s)":>11} {"bytes/game":>14}')
+    for deck_size in [int(size) for size in args.sizes.split(',')]:
+        messages = game_messages(deck_size, args.players)
+        for codec in Proto.CODECS:
+            round_trip(codec, messages)
+            encode_time, decode_time, total = measure(codec, messages)
+            print(f'{deck_size:>9} {codec:>7} {encode_time:>11.4f} {decode_time:>11.4f} {total:>14}')
@@ -0,0 +1,39 @@
+"""Compares encrypting / decrypting a deck item by item against the bulk deck API.
+
+Run from the repository root: python -m benchmarks.deck_crypto_bench
+"""
+import argparse # for parsing command line arguments
+import random
+import time
+
+from src.crypto import Crypto
+
+def timed(function, *args) -> tuple:
+    """Returns the result of the call and how long it took"""
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="deck encryption benchmark")
+    parser.add_argument("--sizes", type=str, default="100,10000,100000", help="comma separated deck sizes")
+    args = parser.parse_args()
+
+    key = Crypto.sym_gen()[0]
+
+    print(f'{"deck":>9} {"op":>8} {"per item (s)":>13} {"bulk (s)":>10} {"speedup":>8}')
+    for deck_size in [int(size) for size in args.sizes.split(',')]:
+        deck = list(range(deck_size))
+        random.shuffle(deck)
+
+        # the per item path works with base64 strings, the bulk one with a buffer of records
+        per_item, per_item_time = timed(lambda: [Crypto.sym_encrypt(key, num) for num in deck])
+        blob, bulk_time = timed(Crypto.encrypt_deck, key, deck)
+        assert Crypto.deck_to_blob(per_item) == blob, "bulk encryption does not match the per item path"
+        print(f'{deck_size:>9} {"encrypt":>8} {per_item_time:>13.4f} {bulk_time:>10.4f} {per_item_time / bulk_time:>7.1f}x')
+
+        decrypted, per_item_time = timed(lambda: [Crypto.sym_decrypt(key, num) for num in per_item])
+        bulk_decrypted, bulk_time = timed(Crypto.decrypt_deck, key, blob)
+        assert decrypted == bulk_decrypted, "bulk decryption does not match the per item path"
+        print(f'{deck_size:>9} {"decrypt":>8} {per_item_time:>13.4f} {bulk_time:>10.4f} {per_item_time / bulk_time:>7.1f}x')
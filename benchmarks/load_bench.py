@@ -0,0 +1,254 @@
+"""Load generator: drives a playing area with many simulated users over TCP, each one running the whole game on its own
+(challenge-response authentication, registration, card generation around the ring, deck key reveal and finding the winner).
+Reports the latency percentiles of every phase, the games finished per second and the CPU the playing area used,
+for every combination of deck and party sizes asked for. Starts a playing area of its own, and the users use software tokens.
+
+Run from the repository root: python -m benchmarks.load_bench --games 50 --party-sizes 2 4 --deck-sizes 100 1000
+"""
+import argparse # for parsing command line arguments
+import base64
+import multiprocessing # the users are spread over processes, so they don't all share one interpreter
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+from src.bingo import Bingo
+from src.caller import Caller
+from src.key_pool import KeyPool
+from src.player import Player
+from src.protocol import Authenticate, Register
+from src.smartcard_reader import SmartCardSession
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# phases of the game, each one timed from the end of the one before it
+PHASES = ('connect', 'auth', 'register', 'party', 'gencard', 'deckkey', 'winner')
+PERCENTILES = (50, 90, 99)
+
+class SimulatedUser:
+    """Plays a whole game without anyone typing, timing when it reaches the end of every phase"""
+
+    def __init__(self, nickname : str, pin : str, softcard : str, latency : float, barrier, stamps : dict):
+        self.barrier = barrier # every user connects at the same time
+        self.stamps = stamps # key is the phase, value is when it ended
+        super().__init__(nickname, pin, softcard=softcard, softcard_latency=latency)
+
+    def stamp(self, phase : str):
+        """Only the first time a phase ends counts"""
+        self.stamps.setdefault(phase, time.perf_counter())
+
+    def connect(self):
+        self.barrier.wait()
+        self.stamp('start')
+        super().connect()
+        self.stamp('connect')
+
+    def loop(self):
+        """Asks for a challenge straight away, then only answers the playing area"""
+        self.send(Authenticate(self.CC_public_encoded))
+        while self.running:
+            for key, _ in self.selector.select(timeout=None):
+                key.data(key.fileobj)
+
+    def authenticate(self, sock, msg):
+        super().authenticate(sock, msg)
+        if self.authenticated and 'auth' not in self.stamps:
+            self.stamp('auth')
+            self.send(Register(self.nickname, self.public_key, self.CC_public_encoded, "signature", table=self.table))
+
+    def game_info(self, sock, msg):
+        super().game_info(sock, msg)
+        self.stamp('register')
+
+    def user_list(self, sock, msg):
+        # the party is full once the playing area sends everyone the participants
+        super().user_list(sock, msg)
+        self.stamp('party')
+
+    def generate_card(self, sock, msg):
+        super().generate_card(sock, msg)
+        if self.encrypted_deck: # the deck was committed
+            self.stamp('gencard')
+
+    def decrypt_deck(self):
+        self.stamp('deckkey')
+        super().decrypt_deck()
+
+    def declare_winner(self):
+        """Finds the winners without printing them or waiting before powering off"""
+        Bingo.winners(Bingo.finishing_order(self.deck, self.cards))
+        self.stamp('winner')
+        self.poweroff()
+
+class SimulatedCaller(SimulatedUser, Caller):
+    pass
+
+class SimulatedPlayer(SimulatedUser, Player):
+    pass
+
+def make_softcard(path : str, pin : str) -> tuple:
+    """Makes the software token if missing, returning its public key as the users send it, in base64"""
+    modulus, pubexp = SmartCardSession.create(pin, path).getPublicKey()
+    return (base64.b64encode(modulus).decode('ascii'), base64.b64encode(pubexp).decode('ascii'))
+
+def fill_pool(path : str) -> None:
+    KeyPool(path, 1).put(rsa.generate_private_key(public_exponent=65537, key_size=KeyPool.KEY_SIZE))
+
+def play(cls, nickname : str, args, softcard : str, barrier, stamps : dict) -> None:
+    """Runs a single user until it powers off"""
+    try:
+        cls(nickname, args.pin, softcard, args.softcard_latency, barrier, stamps)
+    except SystemExit:
+        pass
+    except Exception as e:
+        stamps['error'] = repr(e)
+
+def worker(users : list, args, workdir : str, barrier, results) -> None:
+    """Runs its share of the users, each in a thread, and sends back when each reached every phase"""
+    os.chdir(workdir) # where the keystores are
+    sys.stdout = open(os.devnull, 'w')
+    KeyPool.SIZE = 0 # the pool was filled for the whole run, refilling it would take CPU from the game
+
+    stamps = [{} for _ in users]
+    threads = [threading.Thread(target=play, args=(cls, nickname, args, softcard, barrier, stamps[i]), daemon=True)
+               for i, (cls, nickname, softcard) in enumerate(users)]
+    for thread in threads:
+        thread.start()
+
+    deadline = time.monotonic() + args.timeout
+    for thread in threads:
+        thread.join(max(0, deadline - time.monotonic()))
+
+    # timestamps are turned into durations here, every process has its own clock
+    durations = []
+    for (cls, _, _), user_stamps in zip(users, stamps):
+        phases, previous = {}, user_stamps.get('start')
+        for phase in PHASES:
+            if phase not in user_stamps or previous == None:
+                break
+            phases[phase] = user_stamps[phase] - previous
+            previous = user_stamps[phase]
+        durations.append((cls == SimulatedCaller, phases, user_stamps.get('error')))
+    results.put(durations)
+
+def server_cpu(pid : int) -> float:
+    """Seconds of CPU the process used so far, user and system, from /proc"""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split() # the name of the process may have spaces
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def start_server(workdir : str, args, deck_size : int, party : int) -> subprocess.Popen:
+    """Starts the playing area, with its output in a file so it never blocks on it"""
+    output = open(os.path.join(workdir, 'playing_area.out'), 'w')
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'PlayingArea.py'), str(args.card_size), str(deck_size),
+                               '--party-max', str(party), '--callers', 'callers.txt', '--countdown', str(args.countdown), '--log-dir', '']
+                              + (['--asyncio'] if args.asyncio else []),
+                              cwd=workdir, stdin=subprocess.DEVNULL, stdout=output, stderr=subprocess.STDOUT,
+                              env=dict(os.environ, PYTHONUNBUFFERED='1'))
+    output.close()
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline and server.poll() == None:
+        with open(os.path.join(workdir, 'playing_area.out')) as f:
+            if 'Started playing area' in f.read():
+                return server
+        time.sleep(0.05)
+    server.kill()
+    sys.exit('the playing area did not start')
+
+def run(args, workdir : str, deck_size : int, party : int, moduli : dict) -> None:
+    """Plays the games at one deck and party size and prints the results"""
+    users = [(SimulatedCaller, f'caller{game}', os.path.join(workdir, 'softcards', f'caller{game}.pem')) for game in range(args.games)]
+    users += [(SimulatedPlayer, f'player{n}', os.path.join(workdir, 'softcards', f'player{n}.pem')) for n in range(args.games * party)]
+
+    # the playing keys of the users are all made before the run. each one goes to the keystore of its owner
+    stores = [os.path.join(workdir, KeyPool.user_path(moduli[softcard])) for _, _, softcard in users]
+    missing = [path for path in set(stores) for _ in range(stores.count(path) - KeyPool(path).count())]
+    with multiprocessing.Pool() as pool:
+        pool.map(fill_pool, missing)
+
+    server = start_server(workdir, args, deck_size, party)
+    try:
+        barrier = multiprocessing.Barrier(len(users) + 1, timeout=args.timeout)
+        results = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=worker, args=(users[i::args.procs], args, workdir, barrier, results))
+                 for i in range(min(args.procs, len(users)))]
+        for proc in procs:
+            proc.start()
+
+        barrier.wait()
+        start, cpu_start = time.perf_counter(), server_cpu(server.pid)
+        durations = []
+        for _ in procs:
+            durations += results.get(timeout=args.timeout + 30)
+        elapsed, cpu = time.perf_counter() - start, server_cpu(server.pid) - cpu_start
+        for proc in procs:
+            proc.join()
+    finally:
+        server.kill()
+        server.wait()
+
+    # a game is over once its caller found the winner
+    games = sum(1 for caller, phases, _ in durations if caller and 'winner' in phases)
+    finished = [phases for _, phases, _ in durations if 'winner' in phases]
+    errors = [error for _, _, error in durations if error]
+
+    print(f'\ndeck size {deck_size}, party of {party}, {args.games} games, {len(users)} users')
+    print(f'{"phase":>9}' + ''.join(f'{f"p{p} (ms)":>11}' for p in PERCENTILES) + f'{"max (ms)":>11}{"users":>7}')
+    for phase in PHASES + ('total',):
+        if phase == 'total':
+            times = [sum(phases.values()) for phases in finished]
+        else:
+            times = [phases[phase] for _, phases, _ in durations if phase in phases]
+        if not times:
+            continue
+        cuts = statistics.quantiles(times, n=100, method='inclusive') if len(times) > 1 else times * 99
+        print(f'{phase:>9}' + ''.join(f'{cuts[p - 1] * 1000:>11.1f}' for p in PERCENTILES) + f'{max(times) * 1000:>11.1f}{len(times):>7}')
+
+    print(f'{games}/{args.games} games finished in {elapsed:.2f} s, {games / elapsed:.2f} games/s')
+    print(f'playing area CPU: {cpu:.2f} s, {100 * cpu / elapsed:.0f}% of one core')
+    if len(finished) < len(users):
+        print(f'{len(users) - len(finished)} users did not finish' + (f', errors: {sorted(set(errors))}' if errors else ''))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="playing area load generator")
+    parser.add_argument("--games", type=int, default=20, help="games played at the same time")
+    parser.add_argument("--party-sizes", type=int, nargs='+', default=[2], help="players per game")
+    parser.add_argument("--deck-sizes", type=int, nargs='+', default=[100], help="numbers in the deck")
+    parser.add_argument("--card-size", type=int, default=5, help="numbers in every card")
+    parser.add_argument("--procs", type=int, default=os.cpu_count(), help="processes the simulated users are spread over")
+    parser.add_argument("--countdown", type=float, default=0, help="seconds the playing area waits before starting a full game")
+    parser.add_argument("--asyncio", action="store_true", help="run the playing area in asyncio mode")
+    parser.add_argument("--pin", type=str, default="1111", help="the PIN of the software tokens")
+    parser.add_argument("--softcard-latency", type=float, default=0, help="seconds every operation on a software token takes")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds the users have to finish their game")
+    parser.add_argument("--workdir", type=str, default=None, help="directory the software tokens and keystores are kept in, so other runs can reuse them")
+    parser.add_argument("--passphrase", type=str, default="benchmark", help="passphrase of the keystores, unless one is set in the environment")
+    args = parser.parse_args()
+    os.environ.setdefault(KeyPool.ENV, args.passphrase) # there's no key pool without one
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = os.path.abspath(args.workdir) if args.workdir else tmp
+        os.makedirs(os.path.join(workdir, 'softcards'), exist_ok=True)
+
+        # every user has a software token of its own, made once for the biggest party
+        count = args.games * max(args.party_sizes)
+        paths = [os.path.join(workdir, 'softcards', f'caller{game}.pem') for game in range(args.games)]
+        paths += [os.path.join(workdir, 'softcards', f'player{n}.pem') for n in range(count)]
+        with multiprocessing.Pool() as pool:
+            keys = pool.starmap(make_softcard, [(path, args.pin) for path in paths])
+        moduli = {path : base64.b64decode(modulus) for path, (modulus, _) in zip(paths, keys)} # for finding the keystore of every user
+
+        # only the callers' smartcards may call
+        with open(os.path.join(workdir, 'callers.txt'), 'w') as f:
+            f.writelines(f'{modulus} {pubexp}\n' for modulus, pubexp in keys[:args.games])
+
+        for deck_size in args.deck_sizes:
+            for party in args.party_sizes:
+                run(args, workdir, deck_size, party, moduli)
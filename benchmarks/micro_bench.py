@@ -0,0 +1,261 @@
+"""Microbenchmarks of the hot functions of Crypto and of the deck pipeline of a game (the caller generating the deck,
+the players generating their cards around the ring, decrypting the deck and finding the winner), over deck sizes and player counts.
+Results can be saved as JSON and compared against a saved baseline, so a change can be judged against numbers.
+
+Run from the repository root: python -m benchmarks.micro_bench --output baseline.json
+and after a change: python -m benchmarks.micro_bench --baseline baseline.json
+"""
+import argparse # for parsing command line arguments
+import contextlib # for silencing the users
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+
+from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives import hashes
+from src.caller import Caller
+from src.common import UserData
+from src.crypto import Crypto
+from src.deck_engine import DeckEngine
+from src.player import Player
+
+class OfflineUser:
+    """User with only what the deck pipeline needs, not connected to anything. Messages are kept instead of sent"""
+
+    POWEROFF_DELAY = 0
+
+    def __init__(self, sequence : int, private_key : str, users : dict, args):
+        self.sequence = sequence
+        self.nickname = users[sequence].nickname
+        self.private_key = Crypto.load_private_key(private_key)
+        self.users = users
+        self.deck_key = Crypto.sym_gen()[0]
+        self.deck_size = args.deck_size
+        self.card_size = args.card_size
+        self.shuffle_version = args.shuffle_version
+        self.deck_engine = DeckEngine(0)
+        self.sent = None
+
+    def send(self, msg):
+        self.sent = msg
+
+    def poweroff(self):
+        pass
+
+class OfflineCaller(OfflineUser, Caller):
+    pass
+
+class OfflinePlayer(OfflineUser, Player):
+    pass
+
+def measure(function, prepare=None, repeat : int = 3, min_time : float = 0.1) -> dict:
+    """Times calls to the function, like timeit. prepare() makes fresh arguments for every call and isn't timed.
+    Enough calls are made per round for it to take min_time, and the best round is the result"""
+
+    def round(calls : int) -> float:
+        total = 0
+        for _ in range(calls):
+            args = prepare() if prepare else ()
+            start = time.perf_counter()
+            function(*args)
+            total += time.perf_counter() - start
+        return total
+
+    calls = max(1, int(min_time / max(round(1), 1e-9))) # the first call also warms up
+    times = [round(calls) / calls for _ in range(repeat)]
+    return {'best' : min(times), 'median' : statistics.median(times), 'calls' : calls}
+
+def quiet(function):
+    """The function, without what it prints"""
+    def call(*args):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            return function(*args)
+    return call
+
+def forget_verified() -> tuple:
+    """Every signature is new in a real game, none of them is in the memo of verifications"""
+    Crypto.verified.clear()
+    return ()
+
+def case_id(name : str, params : dict) -> str:
+    return name + (f'[{",".join(f"{k}={v}" for k, v in params.items())}]' if params else '')
+
+def crypto_cases(args) -> list:
+    """(name, params, function, prepare) of the Crypto functions that don't depend on the deck"""
+    key = Crypto.sym_gen()[0]
+    ciphertext = Crypto.sym_encrypt(key, 42)
+    private_key, public_key = Crypto.asym_gen()
+    private_key = Crypto.load_private_key(private_key)
+    digest = Crypto.deck_digest([Crypto.sym_encrypt(key, n) for n in range(args.card_size)])
+    signature = Crypto.sign(private_key, digest)
+
+    # the citizen card signs with PKCS#1 v1.5
+    card_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    numbers = card_key.public_key().public_numbers()
+    modulus, pubexp = numbers.n.to_bytes(256, 'big'), numbers.e.to_bytes(3, 'big')
+    challenge = 'a' * 14
+    card_signature = card_key.sign(challenge.encode(), padding.PKCS1v15(), hashes.SHA256())
+
+    def asym_gen():
+        pool, Crypto.key_pool = Crypto.key_pool, None # always generates
+        Crypto.asym_gen()
+        Crypto.key_pool = pool
+
+    return [
+        ('sym_encrypt', {}, lambda: Crypto.sym_encrypt(key, 42), None),
+        ('sym_decrypt', {}, lambda: Crypto.sym_decrypt(key, ciphertext), None),
+        ('asym_gen', {}, asym_gen, None),
+        ('sign', {}, lambda: Crypto.sign(private_key, digest), None),
+        # results are memoized, the cost is that of a signature seen for the first time
+        ('verify', {}, lambda: Crypto.verify(public_key, digest, signature), forget_verified),
+        ('verifyFromCard', {}, lambda: Crypto.verifyFromCard(modulus, pubexp, challenge, card_signature), None),
+    ]
+
+def deck_cases(args, deck_size : int) -> list:
+    """(name, params, function, prepare) of the Crypto functions working on a whole deck"""
+    key = Crypto.sym_gen()[0]
+    deck = list(range(deck_size))
+    random.shuffle(deck)
+    blob = Crypto.encrypt_deck(key, deck)
+    encrypted = Crypto.blob_to_deck(blob, len(blob) // deck_size)
+    params = {'deck' : deck_size}
+
+    cases = [
+        ('encrypt_deck', params, lambda: Crypto.encrypt_deck(key, deck), None),
+        ('decrypt_deck', params, lambda: Crypto.decrypt_deck(key, blob, len(blob) // deck_size), None),
+        ('deck_digest', params, lambda: Crypto.deck_digest(encrypted), None),
+    ]
+    for version in Crypto.SHUFFLE_VERSIONS:
+        params = {'deck' : deck_size, 'version' : version}
+        cases += [
+            # shuffles in place, so every call gets a copy
+            ('deterministic_shuffle', params, lambda ls, version=version: Crypto.deterministic_shuffle(ls, key, version), lambda: (list(encrypted),)),
+            ('deterministic_unshuffle', params, lambda version=version: Crypto.deterministic_unshuffle(encrypted, key, version), None),
+        ]
+    return cases
+
+def pipeline_cases(args, deck_size : int, players : int, keys : list) -> list:
+    """(name, params, function, prepare) of the steps of a game, as the users run them"""
+    args.deck_size = deck_size
+    users = {seq : UserData(seq, f'user{seq}', keys[seq][1]) for seq in range(players + 1)}
+    caller = OfflineCaller(0, keys[0][0], users, args)
+    ring = [OfflinePlayer(seq, keys[seq][0], users, args) for seq in range(1, players + 1)]
+    params = {'deck' : deck_size, 'players' : players}
+
+    def generate_deck():
+        caller.generate_deck(None, None)
+        return caller.sent
+
+    def generate_cards(msg):
+        """Every player generates their card, each from the deck of the one before"""
+        for player in ring:
+            player.generate_card(None, msg)
+            msg = player.sent
+        return msg
+
+    def fresh_deck():
+        forget_verified()
+        return (quiet(generate_deck)(),)
+
+    # a committed deck, for decrypting it
+    quiet(caller.generate_card)(None, quiet(generate_cards)(quiet(generate_deck)()))
+    committed = caller.sent
+    deck_keys = {seq : user.deck_key for seq, user in enumerate([caller] + ring)}
+    user = ring[0]
+
+    def encrypted_deck():
+        forget_verified()
+        user.encrypted_deck, user.deck_signatures, user.deck_keys = list(committed.deck), list(committed.signatures), dict(deck_keys)
+        return ()
+
+    # decrypting the deck ends with finding the winner, which is timed on its own
+    def decrypt_deck():
+        declare_winner, user.declare_winner = user.declare_winner, lambda: None
+        user.decrypt_deck()
+        user.declare_winner = declare_winner
+
+    quiet(encrypted_deck)()
+    quiet(decrypt_deck)()
+
+    return [
+        ('Caller.generate_deck', params, quiet(generate_deck), None),
+        ('Player.generate_card', params, quiet(generate_cards), fresh_deck), # the whole ring
+        ('User.decrypt_deck', params, quiet(decrypt_deck), encrypted_deck),
+        ('User.declare_winner', params, quiet(user.declare_winner), None),
+    ]
+
+def compare(results : dict, baseline : dict, threshold : float) -> int:
+    """Prints how every case did against the baseline, returning how many got slower"""
+    print(f'\n{"case":<58} {"baseline (s)":>13} {"now (s)":>11} {"ratio":>7}')
+    slower = 0
+    for case, result in results.items():
+        if case not in baseline:
+            continue
+        ratio = result['best'] / baseline[case]['best']
+        verdict = 'slower' if ratio > 1 + threshold else 'faster' if ratio < 1 - threshold else ''
+        slower += verdict == 'slower'
+        print(f'{case:<58} {baseline[case]["best"]:>13.6f} {result["best"]:>11.6f} {ratio:>6.2f}x {verdict}')
+    print(f'{slower} case(s) more than {threshold:.0%} slower than the baseline')
+    return slower
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Crypto and deck pipeline microbenchmarks")
+    parser.add_argument("--sizes", type=str, default="100,10000,1000000", help="comma separated deck sizes")
+    parser.add_argument("--players", type=str, default="2,4", help="comma separated player counts")
+    parser.add_argument("--card-size", type=int, default=5, help="numbers in every card")
+    parser.add_argument("--shuffle-version", type=int, default=Crypto.SHUFFLE_VERSION, choices=Crypto.SHUFFLE_VERSIONS, help="shuffle used by the pipeline")
+    parser.add_argument("--repeat", type=int, default=3, help="rounds per case, the best is kept")
+    parser.add_argument("--min-time", type=float, default=0.1, help="seconds a round takes at least")
+    parser.add_argument("--filter", type=str, default=None, help="only the cases whose name has this text")
+    parser.add_argument("--output", type=str, default=None, help="file the results are saved to as JSON, - for stdout")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change against the baseline that counts")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    player_counts = [int(players) for players in args.players.split(',')]
+    keys = [Crypto.asym_gen() for _ in range(max(player_counts) + 1)]
+    log = sys.stderr if args.output == '-' else sys.stdout # the table stays out of the JSON
+
+    # cases are made as they are run and only if any is wanted, the pipelines of big decks take a while to set up
+    crypto_names = ('sym_encrypt', 'sym_decrypt', 'asym_gen', 'sign', 'verify', 'verifyFromCard')
+    deck_names = ('encrypt_deck', 'decrypt_deck', 'deck_digest', 'deterministic_shuffle', 'deterministic_unshuffle')
+    pipeline_names = ('Caller.generate_deck', 'Player.generate_card', 'User.decrypt_deck', 'User.declare_winner')
+    groups = [(crypto_names, lambda: crypto_cases(args))]
+    groups += [(deck_names, lambda size=size: deck_cases(args, size)) for size in sizes]
+    groups += [(pipeline_names, lambda size=size, players=players: pipeline_cases(args, size, players, keys)) for size in sizes for players in player_counts]
+
+    results = {}
+    print(f'{"case":<58} {"best (s)":>11} {"median (s)":>11} {"calls":>7}', file=log)
+    for names, group in groups:
+        if args.filter and not any(args.filter in name for name in names):
+            continue
+        for name, params, function, prepare in group():
+            if args.filter and args.filter not in name:
+                continue
+            result = measure(function, prepare, args.repeat, args.min_time)
+            results[case_id(name, params)] = dict(name=name, params=params, **result)
+            print(f'{case_id(name, params):<58} {result["best"]:>11.6f} {result["median"]:>11.6f} {result["calls"]:>7}', file=log)
+
+    report = {
+        'meta' : {'time' : time.strftime('%Y-%m-%dT%H:%M:%S'), 'python' : platform.python_version(), 'machine' : platform.machine(),
+                  'cpus' : os.cpu_count(), 'card_size' : args.card_size, 'shuffle_version' : args.shuffle_version},
+        'results' : results,
+    }
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+    elif args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        with contextlib.redirect_stdout(log):
+            slower = compare(results, baseline, args.threshold)
+        sys.exit(1 if slower else 0)
@@ -0,0 +1,80 @@
+"""Measures how long a player takes from the launch of its process to being connected to the playing area,
+with an empty and a full key pool. Starts a playing area of its own, and the players use a software token.
+
+Run from the repository root: python -m benchmarks.startup_bench
+"""
+import argparse # for parsing command line arguments
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from src.key_pool import KeyPool
+from src.smartcard_reader import SmartCardSession
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def launch(script : str, args : list, cwd : str) -> subprocess.Popen:
+    """Starts one of the scripts of the project, with its output unbuffered so lines can be waited on"""
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, script)] + args, cwd=cwd, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, env=dict(os.environ, PYTHONUNBUFFERED='1'))
+
+def wait_for(process : subprocess.Popen, text : str) -> bool:
+    """Reads the output of the process until a line has the text. False if it exited first"""
+    for line in process.stdout:
+        if text in line:
+            return True
+    return False
+
+def time_to_connect(args : list, cwd : str) -> float:
+    """Seconds from launching a player to it being connected"""
+    start = time.perf_counter()
+    player = launch('Player.py', args, cwd)
+    connected = wait_for(player, 'You are now connected to the playing area')
+    elapsed = time.perf_counter() - start
+    player.kill()
+    output = player.communicate()[0]
+    if not connected:
+        sys.exit(f'the player did not connect:\n{output}')
+    return elapsed
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="player startup benchmark")
+    parser.add_argument("--runs", type=int, default=5, help="players launched per key pool state")
+    parser.add_argument("--pin", type=str, default="1111", help="the PIN of the software token")
+    parser.add_argument("--passphrase", type=str, default="benchmark", help="passphrase of the keystore, unless one is set in the environment")
+    args = parser.parse_args()
+    os.environ.setdefault(KeyPool.ENV, args.passphrase) # there's no key pool without one, the players launched get it too
+
+    with tempfile.TemporaryDirectory() as server_dir, tempfile.TemporaryDirectory() as player_dir:
+        server = launch('PlayingArea.py', ['5', '50', '--log-dir', ''], server_dir)
+        if not wait_for(server, 'Started playing area'):
+            sys.exit(f'the playing area did not start:\n{server.communicate()[0]}')
+
+        # the token's key is made before, it would be made only once anyway
+        softcard = os.path.join(player_dir, 'softcard.pem')
+        modulus, _ = SmartCardSession.create(args.pin, softcard).getPublicKey()
+
+        # the player takes its keys from the keystore of its smartcard
+        pool = KeyPool(os.path.join(player_dir, KeyPool.user_path(modulus)), args.runs + KeyPool.SIZE)
+
+        print(f'{"key pool":>9} {"mean (s)":>9} {"median (s)":>11} {"min (s)":>8}')
+        try:
+            for state in ('empty', 'full'):
+                times = []
+                for run in range(args.runs):
+                    # the players refill the pool after a while, which doesn't count
+                    for name in os.listdir(pool.path):
+                        if state == 'empty' and name.endswith(KeyPool.SUFFIX):
+                            os.remove(os.path.join(pool.path, name))
+                    if state == 'full':
+                        pool.fill()
+
+                    times.append(time_to_connect([f'bench{run}', args.pin, '--softcard', softcard], player_dir))
+                print(f'{state:>9} {statistics.mean(times):>9.3f} {statistics.median(times):>11.3f} {min(times):>8.3f}')
+        finally:
+            server.kill()
+            server.communicate()
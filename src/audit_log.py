@@ -0,0 +1,140 @@
+from src.common import LogEntry
+from src.merkle import Merkle, MerkleLog # for proving what the log holds
+from src.log_store import LogStore, RecordFile # for keeping the log on disk
+import os
+import base64
+import struct # for the checkpoint records
+from src.protocol import LogCheckpoint
+from concurrent.futures import ThreadPoolExecutor # for signing in the background
+from collections import deque
+
+class AuditLog:
+    """Append-only log of LogEntry. Every entry carries the hash of the one before it, and a Merkle accumulator
+    over the entries answers inclusion and consistency proofs. Can be read like a list.
+    Given a path, the entries, the nodes of the accumulator and the signed checkpoints are kept on disk there, and an existing log is reopened"""
+
+    # size, root and signature of a checkpoint. signatures are made with the playing area's 2048-bit key
+    CHECKPOINT = struct.Struct('>Q32s256s')
+
+    def __init__(self, path : str = None, fsync : str = 'epoch'):
+        self.path = path
+        self.checkpoint = None # latest signed checkpoint of the log
+        self.closed = False
+
+        if path:
+            self.entries = LogStore(path, fsync)
+            nodes = RecordFile(os.path.join(path, 'nodes'), 32, fsync)
+            self.checkpoints = RecordFile(os.path.join(path, 'checkpoints'), self.CHECKPOINT.size, fsync)
+
+            # a crash may have left the entries and the nodes out of step, only what both have is kept
+            size = len(self.entries)
+            while MerkleLog.node_count(size) > len(nodes):
+                size -= 1
+            self.entries.truncate(size)
+            nodes.truncate_records(MerkleLog.node_count(size))
+
+            # as are the checkpoints of entries that were lost
+            while len(self.checkpoints) and self.read_checkpoint(-1).size > size:
+                self.checkpoints.truncate_records(len(self.checkpoints) - 1)
+            if len(self.checkpoints):
+                self.checkpoint = self.read_checkpoint(-1)
+        else:
+            self.entries = []
+            nodes, size = None, 0
+
+        self.tree = MerkleLog(nodes, size) # leaves are the entries' canonical bytes
+        self.head = self.entries[-1].hash() if size else None # hash of the last entry, kept so appending doesn't rehash it
+        self.checkpointed = self.checkpoint.size if self.checkpoint else 0 # entries covered by the last checkpoint handed out for signing
+        self.subscribers = set() # sockets of the users following the log
+
+        if not size:
+            self.append(LogEntry.genesis_block())
+
+    def append(self, entry : LogEntry) -> None:
+        data = entry.canonical()
+        if self.path:
+            self.entries.append(entry, data)
+        else:
+            self.entries.append(entry)
+        self.tree.append(Merkle.leaf(data))
+        self.head = LogEntry.hash_of(data)
+
+    def read_checkpoint(self, index : int) -> LogCheckpoint:
+        size, root, signature = self.CHECKPOINT.unpack(self.checkpoints[index])
+        return LogCheckpoint(size, root.hex(), base64.b64encode(signature).decode('ascii'))
+
+    def add_checkpoint(self, checkpoint : LogCheckpoint) -> None:
+        """Keeps a signed checkpoint of the log, which is the one handed out from now on"""
+        self.checkpoint = checkpoint
+        if self.path:
+            self.checkpoints.append(self.CHECKPOINT.pack(checkpoint.size, bytes.fromhex(checkpoint.root), base64.b64decode(checkpoint.signature)))
+            if self.closed: # the log was closed while its last checkpoint was being signed
+                self.checkpoints.close()
+
+    def unsigned(self) -> int:
+        """How many entries no checkpoint covers yet"""
+        return len(self.entries) - self.checkpointed
+
+    def sync(self) -> None:
+        """Writes what was appended to disk, as the fsync policy says"""
+        if self.path:
+            self.entries.sync()
+            self.tree.nodes.sync()
+            self.checkpoints.sync()
+
+    def close(self) -> None:
+        self.closed = True
+        if self.path:
+            self.entries.close()
+            self.tree.nodes.close()
+            self.checkpoints.close()
+
+    def root(self, size : int = None) -> str:
+        """Hex Merkle root of the log as it was when it had size entries, the current one by default"""
+        return self.tree.root(size).hex()
+
+    def inclusion_proof(self, index : int, size : int = None) -> list:
+        """Hex hashes proving the entry at index is in the log of given size"""
+        return [node.hex() for node in self.tree.inclusion_proof(index, size)]
+
+    def consistency_proof(self, old_size : int, size : int = None) -> list:
+        """Hex hashes proving the log of old_size is a prefix of the log of given size"""
+        return [node.hex() for node in self.tree.consistency_proof(old_size, size)]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, index):
+        return self.entries[index]
+
+    def __iter__(self):
+        return iter(self.entries)
+
+class LogSigner:
+    """Signs checkpoints of audit logs on a background thread, so logging a message never waits on RSA.
+    One checkpoint covers every entry of its log so far"""
+
+    def __init__(self, private_key):
+        self.private_key = private_key
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='log-signer')
+        self.pending = deque() # (log, checkpoint, future), in the order they were handed out
+
+    def submit(self, log : AuditLog) -> None:
+        """Checkpoints the log as it is now. The root is taken right away, the signature is made in the background"""
+        checkpoint = LogCheckpoint(len(log), log.root())
+        log.checkpointed = checkpoint.size
+        self.pending.append((log, checkpoint, self.pool.submit(checkpoint.sign, self.private_key)))
+
+    def collect(self) -> list:
+        """The (log, checkpoint) pairs signed since the last call. Each checkpoint is added to its log"""
+        done = []
+        while self.pending and self.pending[0][2].done():
+            log, checkpoint, future = self.pending.popleft()
+            future.result()
+            log.add_checkpoint(checkpoint)
+            done.append((log, checkpoint))
+        return done
+
+    def close(self) -> None:
+        """Waits for the checkpoints being signed"""
+        self.pool.shutdown()
@@ -0,0 +1,60 @@
+class Bingo:
+    """Game rules utilities"""
+
+    @classmethod
+    def validate_deck(cls, deck : list, deck_size : int) -> tuple:
+        """Checks in a single pass, over a bitmap of the numbers seen, that the deck only has numbers from 0 to deck_size - 1 and no repeats.
+        Returns the out of bounds and the repeated numbers, in the order they appear"""
+        seen = bytearray(deck_size)
+        out_of_bounds = []
+        repeated = []
+
+        for num in deck:
+            if not 0 <= num < deck_size:
+                out_of_bounds.append(num)
+            elif seen[num]:
+                repeated.append(num)
+            else:
+                seen[num] = 1
+
+        return out_of_bounds, repeated
+
+    @classmethod
+    def finishing_order(cls, deck : list, cards : dict) -> list:
+        """Returns a (draw index, sequence) tuple for every card that gets filled, in the order they are filled.
+        Runs in O(deck + total cells) using an index of the cells each number fills"""
+
+        # number -> [(sequence, cell)] of the cards it appears in
+        index = {}
+        for seq, card in cards.items():
+            seen = set()
+            for cell, num in enumerate(card):
+                # a number only fills the first cell it appears in
+                if num in seen:
+                    continue
+                seen.add(num)
+                index.setdefault(num, []).append((seq, cell))
+
+        # cells left to fill per card. as in a scan that marks the first cell matching each draw, the later cells of a
+        # repeated number are never filled, so a card with repeats never completes
+        remaining = {seq : len(card) for seq, card in cards.items()}
+        order = [(-1, seq) for seq, left in remaining.items() if left == 0] # empty cards are filled from the start
+
+        for draw, num in enumerate(deck):
+            # popped, so a number drawn again doesn't fill its cells twice
+            for seq, cell in index.pop(num, ()):
+                remaining[seq] -= 1
+                if remaining[seq] == 0:
+                    order.append((draw, seq))
+
+        # cards filled in the same draw keep the order of their sequence
+        order.sort()
+        return order
+
+    @classmethod
+    def winners(cls, order : list) -> list:
+        """Sequences of the cards filled on the earliest draw"""
+        if not order:
+            return []
+        first = order[0][0]
+        return [seq for draw, seq in order if draw == first]
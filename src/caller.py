@@ -4,11 +4,13 @@ from src.crypto import Crypto
 
 class Caller(User):
 
-    def __init__(self, nickname : str, pin : str):
+    def __init__(self, nickname : str, pin : str, table : int = None, workers : int = None, softcard : str = None, softcard_latency : float = 0,
+                 profile : str = None, party_max : int = None):
         print(f'You are a CALLER. Your nickname is "{nickname}".')
         self.signed_deck = False
+        self.party_max = party_max # players wanted at the table, None keeps the playing area's default
 
-        super().__init__(nickname, pin)
+        super().__init__(nickname, pin, table, workers, softcard, softcard_latency, profile)
 
     def handle_input(self, stdin):
         """Receives the typing input"""
@@ -16,32 +18,42 @@ class Caller(User):
 
         if text == 'AUTH' and not self.authenticated:
             print('[AUTH] Asking the playing area for a challenge...')
-            # convert tuple of bytes to tuple of base64 strings
-            modulus, pubexp = self.CC_public
-            modulus, pubexp = base64.b64encode(modulus).decode('ascii'), base64.b64encode(pubexp).decode('ascii')
-            encoded_CC_public = (modulus, pubexp)
-            Proto.send_msg(self.sock, Authenticate(encoded_CC_public))
+            self.send(Authenticate(self.CC_public_encoded))
         elif text == 'GETUSERS' and self.authenticated:
             print('[SEC] Asking the playing area for the list of registed users...')
-            Proto.send_msg(self.sock, GetUsers(self.CC_public, "signature"))
+            self.send(GetUsers(self.CC_public_encoded, "signature"))
         elif text == 'GETLOG' and self.authenticated:
-            print('[SEC] Asking the playing area for the list of logged messages...')
-            Proto.send_msg(self.sock, GetLog(self.CC_public, "signature"))
+            print('[SEC] Asking the playing area for the new logged messages...')
+            self.request_log()
+        elif text == 'WATCHLOG' and self.authenticated:
+            print('[SEC] Asking the playing area to send logged messages as they come...')
+            self.request_log(subscribe=True)
+        elif text.startswith('CHECKLOG ') and text[len('CHECKLOG '):].isdigit() and self.authenticated:
+            print('[SEC] Asking the playing area to prove a logged message is in the log...')
+            self.send(LogProof(self.CC_public_encoded, "signature", int(text[len('CHECKLOG '):])))
+        elif text == 'STATS' and self.authenticated:
+            print('[STATS] Asking the playing area for its metrics...')
+            self.send(Stats(self.CC_public_encoded, "signature"))
         elif text == 'REGISTER' and not self.registered and self.authenticated:
             print(f'[REG] Registering yourself to the playing area as "{self.nickname}"...')
-            Proto.send_msg(self.sock, Register(self.nickname, self.public_key, self.CC_public, "signature"))
+            self.send(Register(self.nickname, self.public_key, self.CC_public_encoded, "signature", table=self.table, party_max=self.party_max))
         else:
             print('Invalid input.')
 
+    def register_handlers(self):
+        """Only the caller generates the deck"""
+        super().register_handlers()
+        self.dispatcher.register(GenerateDeck, self.generate_deck)
+
     def generate_deck(self, sock : socket, msg : GenerateCard):
         """Generate the deck"""
         print('[GAME] Generating deck...')
         self.deck = [n for n in range(self.deck_size)]
         random.shuffle(self.deck)
 
-        # encrypt each number with the sym key
-        encrypted_deck = self.deck
-        encrypted_deck = [Crypto.sym_encrypt(self.deck_key, num) for num in self.deck]
+        # encrypt the whole deck with the sym key in one pass
+        encrypted_deck = Crypto.encrypt_deck(self.deck_key, self.deck)
+        encrypted_deck = Records(encrypted_deck, len(encrypted_deck) // len(self.deck)) # kept as one block, it is sent as such
 
         print(f'[GAME] Deck generated : {self.deck}')
         self.signed_deck = True
@@ -50,7 +62,7 @@ class Caller(User):
         card_msg = GenerateCard(1, encrypted_deck)
         card_msg.sign(self.private_key) 
 
-        Proto.send_msg(sock, card_msg)
+        self.send(card_msg)
 
     def generate_card(self, sock : socket, msg : GenerateCard):
         """The deck made all the way back after all players generated their cards"""
@@ -67,5 +79,5 @@ class Caller(User):
         self.deck_keys[0] = self.deck_key
  
         print('[GAME] Comitting deck to all users...')
-        Proto.send_msg(self.sock, msg)
+        self.send(msg)
         print('[GAME] Waiting for deck keys to decrypt deck...')
@@ -1,4 +1,5 @@
 import json # for serializing
+import hashlib # for chaining the entries
 from src.crypto import Crypto
 import base64
 
@@ -15,17 +16,35 @@ class LogEntry:
     def parse(cls, j):
         return LogEntry(j['sequence'], j['timestamp'], j['prev_hash'], j['text'], j['signature'])
 
+    def signed_text(self) -> str:
+        return str(self.sequence)+str(self.timestamp)+self.prev_hash+self.text
+
     def sign(self, private_key):
-        sign = Crypto.sign(private_key, str(self.sequence)+str(self.timestamp)+self.prev_hash+self.text) # Get signature
+        sign = Crypto.sign(private_key, self.signed_text()) # Get signature
         send_format = base64.b64encode(sign).decode('ascii') # Transform to sending forma
         self.signature = send_format
     
     def verify(self, public_key, signature: str) -> bool:
         signature = base64.b64decode(signature.encode('ascii')) # Transform back to bytes
-        return Crypto.verify(public_key, str(self.sequence)+str(self.timestamp)+self.prev_hash+self.text, signature) # Return true if matches false if it doesnt 
+        return Crypto.verify(public_key, self.signed_text(), signature) # Return true if matches false if it doesnt 
+
+    def canonical(self) -> bytes:
+        """The bytes the entry is hashed over. Every field, in a fixed order and without whitespace"""
+        return json.dumps([self.sequence, self.timestamp, self.prev_hash, self.text, self.signature], separators=(',', ':')).encode('UTF-8')
+
+    @classmethod
+    def from_canonical(cls, data : bytes):
+        """Entry back from its canonical bytes"""
+        sequence, timestamp, prev_hash, text, signature = json.loads(bytes(data))
+        return LogEntry(sequence, timestamp, prev_hash, text, signature)
 
     def hash(self) -> str:
-        return 'hash'
+        """Hex SHA256 of the entry, which the next entry carries as prev_hash"""
+        return self.hash_of(self.canonical())
+
+    @classmethod
+    def hash_of(cls, data : bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
 
     @classmethod
     def genesis_block(cls):
@@ -11,9 +11,31 @@ import base64
 from cryptography.hazmat.backends import default_backend
 from binascii import a2b_hex, b2a_hex 
 import hashlib 
+import functools # for caching parsed keys
+import threading # for the memo of verified signatures
+from collections import OrderedDict # for the memo of verified signatures
+import struct # for reading the shuffle stream in bulk
+import itertools # for chaining the blocks of the shuffle stream
+from src.merkle import Merkle # for committing to decks
 
 class Crypto:
     """Cryptographic utilities""" 
+
+    # how many parsed keys are kept around, per kind of key
+    KEY_CACHE_SIZE = 256
+
+    # KeyPool asym_gen takes ready keys from, None generates every key on the spot
+    key_pool = None
+    generated_keys = OrderedDict() # key is the PEM of a private key made by asym_gen, value is its key object ; so it isn't decrypted back
+
+    # how many keys made by asym_gen are kept parsed, a session only uses the last few
+    GENERATED_CACHE_SIZE = 8
+
+    # how many signature verification results are remembered
+    VERIFY_CACHE_SIZE = 4096
+
+    verified = OrderedDict() # key is (key fingerprint, digest, signature) of a verification that succeeded, value is True
+    verified_lock = threading.Lock()
  
     @classmethod
     def sym_gen(cls) -> tuple:
@@ -66,6 +88,86 @@ class Crypto:
          
         return data.decode('ascii')
 
+    # size of an AES block, the unit of the deck records
+    BLOCK_SIZE = 16
+
+    @classmethod
+    def encrypt_deck(cls, key: str, numbers: list) -> bytes:
+        """Encrypts a whole deck with a single cipher context. Returns the ciphertexts as fixed-size records in one buffer,
+        byte for byte what sym_encrypt would output for every item"""
+
+        key=base64.b64decode(key.encode('ascii'))
+
+        # pads every item on its own, like sym_encrypt, into a single buffer
+        padded_data = bytearray()
+        for num in numbers:
+            data = bytes(str(num), 'ascii')
+            pad = cls.BLOCK_SIZE - len(data) % cls.BLOCK_SIZE
+            padded_data += data
+            padded_data += bytes([pad]) * pad
+
+        # ECB encrypts every block on its own, so one pass over the buffer equals one pass per item
+        encryptor = Cipher(algorithms.AES(key), modes.ECB()).encryptor()
+        return encryptor.update(bytes(padded_data)) + encryptor.finalize()
+
+    @classmethod
+    def decrypt_deck(cls, key: str, blob: bytes, record_size: int = BLOCK_SIZE) -> list:
+        """Decrypts a deck of fixed-size records with a single cipher context. Returns what sym_decrypt would for every item"""
+
+        key=base64.b64decode(key.encode('ascii'))
+
+        decryptor = Cipher(algorithms.AES(key), modes.ECB()).decryptor()
+        data = decryptor.update(bytes(blob)) + decryptor.finalize()
+
+        deck = []
+        for start in range(0, len(data), record_size):
+            end = start + record_size
+            pad = data[end - 1]
+
+            # same check as the PKCS7 unpadder
+            if not 0 < pad <= cls.BLOCK_SIZE or data[end - pad:end] != bytes([pad]) * pad:
+                raise ValueError("Invalid padding bytes.")
+
+            deck.append(data[start:end - pad].decode('ascii'))
+
+        return deck
+
+    @classmethod
+    def deck_to_blob(cls, deck: list) -> bytes:
+        """Joins a deck of base64 ciphertexts, as sent in messages, into a single buffer of records"""
+        if hasattr(deck, 'block'): # decoded by the binary codec, already a single buffer
+            return deck.block
+        return b''.join(map(base64.b64decode, deck))
+
+    @classmethod
+    def blob_to_deck(cls, blob: bytes, record_size: int) -> list:
+        """Splits a buffer of records into the base64 ciphertexts sent in messages"""
+        return [base64.b64encode(blob[i:i + record_size]).decode('ascii') for i in range(0, len(blob), record_size)]
+
+    @classmethod
+    def deck_tree(cls, deck: list) -> list:
+        """Levels of the Merkle tree over the ciphertext records of a deck of base64 ciphertexts"""
+        records = deck.raw() if hasattr(deck, 'raw') else map(base64.b64decode, deck) # decoded by the binary codec, already raw
+        return Merkle.levels([Merkle.leaf(record) for record in records])
+
+    @classmethod
+    def deck_digest(cls, deck: list) -> str:
+        """Canonical commitment to a deck: the hex Merkle root over its ciphertext records. This is what gets signed"""
+        if not deck:
+            return Merkle.root([]).hex()
+        return cls.deck_tree(deck)[-1][0].hex()
+
+    @classmethod
+    def deck_proof(cls, deck: list, index: int) -> list:
+        """Proof, as hex hashes, that the record at index belongs to the deck"""
+        return [node.hex() for node in Merkle.inclusion_proof(cls.deck_tree(deck), index)]
+
+    @classmethod
+    def verify_deck_proof(cls, digest: str, record: str, index: int, size: int, proof: list) -> bool:
+        """Checks in O(log n) that a base64 record is at index of the deck committed to by digest"""
+        leaf = Merkle.leaf(base64.b64decode(record))
+        return Merkle.verify_inclusion(bytes.fromhex(digest), leaf, index, size, [bytes.fromhex(node) for node in proof])
+
     @classmethod
     def do_hash(cls, data: bytes) -> bytes:
         """Returns an hash of a given data"""
@@ -78,20 +180,26 @@ class Crypto:
 
     @classmethod
     def asym_gen(cls) -> tuple:
-        """Generates a new Asymetric key(Object) pair"""
-        
-        private_key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=2048,
-        )
+        """Generates a new Asymetric key(Object) pair. Taken from the key pool, if there's one with keys ready"""
         
-        return ( Crypto.serialize_private_key(private_key), Crypto.serialize_public_key(private_key.public_key()))
+        private_key = cls.key_pool.take() if cls.key_pool else None
+        if private_key == None:
+            private_key = rsa.generate_private_key(
+                public_exponent=65537,
+                key_size=2048,
+            )
+
+        private_pem = Crypto.serialize_private_key(private_key)
+        cls.generated_keys[private_pem] = private_key
+        if len(cls.generated_keys) > cls.GENERATED_CACHE_SIZE:
+            cls.generated_keys.popitem(last=False)
+        return ( private_pem, Crypto.serialize_public_key(private_key.public_key()))
 
     @classmethod
-    def asym_encrypt(cls, public_key: str, data) -> bytes:
-        """Encrypts data using given public key"""
+    def asym_encrypt(cls, public_key, data) -> bytes:
+        """Encrypts data using given public key (PEM string or key object)"""
         
-        public_key = Crypto.load_public_key(public_key)
+        public_key = Crypto.public_key_object(public_key)
 
         data=bytes(str(data), 'utf-8')
         ciphertext = public_key.encrypt(data,
@@ -106,10 +214,10 @@ class Crypto:
         return ciphertext
 
     @classmethod
-    def asym_decrypt(cls, private_key: str, crypted_data) -> bytes:
-        """Encrypts data using given private key"""
+    def asym_decrypt(cls, private_key, crypted_data) -> bytes:
+        """Encrypts data using given private key (PEM string or key object)"""
 
-        private_key = Crypto.load_private_key(private_key)
+        private_key = Crypto.private_key_object(private_key)
         
         crypted_data=bytes(str(crypted_data), 'utf-8')
         data = private_key.decrypt(crypted_data,
@@ -123,10 +231,10 @@ class Crypto:
         return data
 
     @classmethod
-    def sign(cls, private_key: str, data) -> bytes:
-        """Returns Signature of given data signed with given private key"""
+    def sign(cls, private_key, data) -> bytes:
+        """Returns Signature of given data signed with given private key (PEM string or key object)"""
           
-        private_key = Crypto.load_private_key(private_key)
+        private_key = Crypto.private_key_object(private_key)
 
         data=bytes(str(data), 'utf-8')
         signature = private_key.sign(
@@ -141,10 +249,23 @@ class Crypto:
         return signature
 
     @classmethod
-    def verify(cls, public_key: str, message, signature: bytes) -> bool:
-        """Verifies if given message matches with given signature"""
+    def verify(cls, public_key, message, signature: bytes) -> bool:
+        """Verifies if given message matches with given signature, using a PEM string or key object.
+        Valid signatures are memoized, so verifying the same signature again is free"""
+
+        memo_key = cls.verify_memo_key(public_key, message, signature)
+        if memo_key in cls.verified:
+            return True
+        result = cls.verify_uncached(public_key, message, signature)
+        if result:
+            cls.remember_verified(memo_key)
+        return result
+
+    @classmethod
+    def verify_uncached(cls, public_key, message, signature: bytes) -> bool:
+        """Verifies if given message matches with given signature, always doing the RSA operation"""
           
-        public_key = Crypto.load_public_key(public_key)
+        public_key = Crypto.public_key_object(public_key)
 
         message =message.encode()
         try:  
@@ -165,6 +286,57 @@ class Crypto:
 
         return True
 
+    @classmethod
+    def verify_batch(cls, checks: list) -> list:
+        """Verifies a list of (public_key, message, signature) tuples one after the other, skipping the ones already verified
+        and doing the same check only once. Returns the result of each check, in order"""
+
+        results = [None] * len(checks)
+        pending = {} # key is the memo key, value is the indexes waiting on it
+        for i, (public_key, message, signature) in enumerate(checks):
+            memo_key = cls.verify_memo_key(public_key, message, signature)
+            results[i] = cls.verified.get(memo_key)
+            if results[i] is None:
+                pending.setdefault(memo_key, []).append(i)
+
+        # the same check is only done once, even if it's in the batch more than once
+        # checked one after the other, a pool of verifying threads measured slower than this loop
+        for memo_key, indexes in pending.items():
+            result = cls.verify_uncached(*checks[indexes[0]])
+            if result:
+                cls.remember_verified(memo_key)
+            for i in indexes:
+                results[i] = result
+
+        return results
+
+    @classmethod
+    def verify_memo_key(cls, public_key, message, signature: bytes) -> tuple:
+        """(key fingerprint, digest of the message, signature) identifying a verification"""
+        return (cls.key_fingerprint(public_key), hashlib.sha256(message.encode()).digest(), bytes(signature))
+
+    @classmethod
+    def key_fingerprint(cls, public_key) -> bytes:
+        """SHA256 of the public key, given either as PEM string or key object"""
+        if isinstance(public_key, str):
+            return cls._pem_fingerprint(public_key)
+        der = public_key.public_bytes(encoding=serialization.Encoding.DER, format=serialization.PublicFormat.SubjectPublicKeyInfo)
+        return hashlib.sha256(der).digest()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+    def _pem_fingerprint(key_string: str) -> bytes:
+        return Crypto.key_fingerprint(Crypto.load_public_key(key_string))
+
+    @classmethod
+    def remember_verified(cls, memo_key: tuple) -> None:
+        """Stores a verification that succeeded, forgetting the oldest one past VERIFY_CACHE_SIZE. Failures are never stored"""
+        with cls.verified_lock:
+            cls.verified[memo_key] = True
+            cls.verified.move_to_end(memo_key)
+            if len(cls.verified) > cls.VERIFY_CACHE_SIZE:
+                cls.verified.popitem(last=False)
+
     # SMARTCARD STUFF
 
     @classmethod
@@ -172,6 +344,7 @@ class Crypto:
         """Verifies if given message matches with given signature"""
 
         public_key = Crypto.load_public_key_from_SC(modulus,pubexp)
+        message = message.encode() if isinstance(message, str) else bytes(message) # the card signs the UTF-8 of text
 
         try:  
             public_key.verify(
@@ -187,7 +360,12 @@ class Crypto:
 
     @classmethod
     def load_public_key_from_SC(cls,modulus,pubexp):
+        """Builds the public key of a smartcard from its modulus and public exponent. Cached"""
+        return cls._load_public_key_from_SC(bytes(modulus), bytes(pubexp))
 
+    @staticmethod
+    @functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+    def _load_public_key_from_SC(modulus : bytes, pubexp : bytes):
         n = modulus
         e = pubexp
         key = rsa.RSAPublicNumbers(
@@ -200,14 +378,36 @@ class Crypto:
 
     @classmethod
     def load_private_key(cls, key_string: str):
-        """ """ 
+        """Parses a PEM private key. Cached, since decrypting the PKCS8 goes through a KDF""" 
+        key_object = cls.generated_keys.get(key_string)
+        return key_object if key_object else cls._load_private_key(key_string)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+    def _load_private_key(key_string: str):
         key_object = serialization.load_pem_private_key(key_string.encode(), password=b'mypassword')
         return  key_object
+
     @classmethod
     def load_public_key(cls, key_string: str):
-        """ """  
+        """Parses a PEM public key. Cached"""  
+        return cls._load_public_key(key_string)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+    def _load_public_key(key_string: str):
         key_object = serialization.load_pem_public_key(key_string.encode())
         return  key_object
+
+    @classmethod
+    def private_key_object(cls, key):
+        """Returns the key object of a private key given either as PEM string or already parsed"""
+        return cls.load_private_key(key) if isinstance(key, str) else key
+
+    @classmethod
+    def public_key_object(cls, key):
+        """Returns the key object of a public key given either as PEM string or already parsed"""
+        return cls.load_public_key(key) if isinstance(key, str) else key
     @classmethod
     def serialize_public_key(cls, key_object) -> str:
         """ """ 
@@ -226,10 +426,19 @@ class Crypto:
         )
         return key_string.decode()  
 
+    # versions of the deterministic shuffle. 1 is the original MD5 based one, 2 draws from SHAKE-256
+    SHUFFLE_VERSIONS = (1, 2)
+    SHUFFLE_VERSION = 2 # latest
+
     # Fisher-Yates Algorithm https://favtutor.com/blogs/shuffle-list-python
     @classmethod
-    def deterministic_shuffle(cls, ls : list, seed : str):
-        """Deterministically shuffles a list given a seed using the Fisher-Yates Algorithm""" 
+    def deterministic_shuffle(cls, ls : list, seed : str, version : int = 1):
+        """Deterministically shuffles a list in place given a seed using the Fisher-Yates Algorithm""" 
+
+        if version == 2:
+            return cls.shuffle_v2(ls, seed)
+        elif version != 1:
+            raise ValueError(f"Unknown shuffle version {version}")
 
         rng = [] # array of 16 random numbers as generated from a MD5 hash
         nonce = 0 # nonce for generating the hash in case the original rng pool runs out
@@ -247,16 +456,87 @@ class Crypto:
         
         return ls
 
-    # https://crypto.stackexchange.com/q/78309
-    @classmethod
-    def deterministic_unshuffle(cls, shuffled_ls : list, seed : str):
-        """Reverses the deterministic shuffle and returns the original list"""
-        n = len(shuffled_ls)
-        # perm is [1, 2, ..., n]
-        perm = [i for i in range(1, n + 1)]
-        # apply sigma to perm
-        shuffled_perm = cls.deterministic_shuffle(perm, seed)
-        # zip and unshuffle
-        zipped_ls = list(zip(shuffled_ls, shuffled_perm))
-        zipped_ls.sort(key=lambda x: x[1])
-        return [a for (a, b) in zipped_ls]
+    @classmethod
+    def shuffle_v2(cls, ls : list, seed : str):
+        """Version 2 of the shuffle. Forward Fisher-Yates with unbiased indices drawn in bulk from a SHAKE-256 stream"""
+        words = ShuffleStream(seed).words
+        word_range = ShuffleStream.WORD_RANGE
+        n = len(ls)
+        for i in range(n - 1):
+            # same as ShuffleStream.below(n - i), inlined since it runs for every item
+            bound = n - i
+            limit = word_range - word_range % bound
+            word = next(words)
+            while word >= limit:
+                word = next(words)
+
+            j = i + word % bound
+            ls[i], ls[j] = ls[j], ls[i] # swaps two items
+
+        return ls
+
+    @classmethod
+    def derive_card(cls, deck : list, seed : str, card_size : int, version : int = 1) -> list:
+        """Returns the first card_size items of the shuffled deck, without copying or touching the deck.
+        Version 2 only runs the first card_size steps of the shuffle, over a sparse map of the swapped positions"""
+
+        # the original shuffle finishes the first positions last, so it has to run in full
+        if version == 1:
+            return cls.deterministic_shuffle(list(deck), seed, version)[:card_size]
+        elif version != 2:
+            raise ValueError(f"Unknown shuffle version {version}")
+
+        stream = ShuffleStream(seed)
+        n = len(deck)
+        swapped = {} # key is a position, value is the index of the deck item the shuffle moved there
+        card = []
+        for i in range(min(card_size, n)):
+            j = i + stream.below(n - i) if i < n - 1 else i # same steps as shuffle_v2
+
+            # position i is final after its swap, position j gets what was at i
+            card.append(deck[swapped.get(j, j)])
+            swapped[j] = swapped.get(i, i)
+
+        return card
+
+    @classmethod
+    def shuffle_permutation(cls, n : int, seed : str, version : int = 1) -> list:
+        """The permutation applied by the shuffle: shuffled[i] is the item originally at perm[i]"""
+        return cls.deterministic_shuffle(list(range(n)), seed, version)
+
+    @classmethod
+    def deterministic_unshuffle(cls, shuffled_ls : list, seed : str, version : int = 1):
+        """Reverses the deterministic shuffle and returns the original list, in O(n) using the inverse permutation"""
+        perm = cls.shuffle_permutation(len(shuffled_ls), seed, version)
+
+        ls = [None] * len(shuffled_ls)
+        for i, original_index in enumerate(perm):
+            ls[original_index] = shuffled_ls[i]
+        return ls
+
+class ShuffleStream:
+    """Stream of random indices for the shuffle, drawn in bulk from SHAKE-256 keyed on the deck key"""
+
+    # 32 bit words generated per block of the stream
+    BLOCK_WORDS = 2048
+
+    # words are rejected past the biggest multiple of the bound below this
+    WORD_RANGE = 1 << 32
+
+    def __init__(self, seed : str):
+        self.key = b'bingo-shuffle-v2' + seed.encode()
+        # endless iterator over the words of every block, in order
+        self.words = itertools.chain.from_iterable(map(self.block, itertools.count()))
+
+    def block(self, counter : int) -> tuple:
+        """Generates the words of a block of the stream"""
+        digest = hashlib.shake_256(self.key + counter.to_bytes(8, 'big')).digest(4 * self.BLOCK_WORDS)
+        return struct.unpack(f'>{self.BLOCK_WORDS}I', digest)
+
+    def below(self, bound : int) -> int:
+        """Returns an unbiased random integer in [0, bound)"""
+        limit = self.WORD_RANGE - self.WORD_RANGE % bound
+        word = next(self.words)
+        while word >= limit:
+            word = next(self.words)
+        return word % bound
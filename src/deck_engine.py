@@ -0,0 +1,71 @@
+from concurrent.futures import ProcessPoolExecutor # for spreading the work over cores
+from src.crypto import Crypto
+
+# the workers run these module level functions, so they can be pickled
+
+def decrypt_chunk(key : str, chunk : list) -> list:
+    """Decrypts a chunk of base64 ciphertexts in one pass"""
+    if not chunk: # nothing to size the ciphertexts by
+        return []
+    blob = Crypto.deck_to_blob(chunk)
+    return Crypto.decrypt_deck(key, blob, len(blob) // len(chunk))
+
+def derive_cards(deck : list, seeds : dict, card_size : int, version : int = 1) -> dict:
+    """Derives the card of every (sequence, seed) pair from the deck"""
+    return {seq : Crypto.derive_card(deck, seed, card_size, version) for seq, seed in seeds.items()}
+
+class DeckEngine:
+    """Unwraps the layers of the deck and derives the cards, optionally spread over a pool of processes.
+    The result is the same with or without workers"""
+
+    # smallest number of items worth sending to a worker
+    MIN_CHUNK = 1024
+
+    def __init__(self, workers : int = 0):
+        self.workers = workers # 0 or 1 does everything in this process
+        self.pool = None
+
+    def parallel(self) -> bool:
+        return self.workers > 1
+
+    def start(self) -> None:
+        """Starts the pool of workers, if any"""
+        if self.parallel() and not self.pool:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+
+    def close(self) -> None:
+        """Stops the pool of workers, if any"""
+        if self.pool:
+            self.pool.shutdown()
+            self.pool = None
+
+    def chunks(self, items : list) -> list:
+        """Splits the items into a few chunks per worker"""
+        size = max(self.MIN_CHUNK, -(-len(items) // (self.workers * 4)))
+        return [items[i:i + size] for i in range(0, len(items), size)] # never an empty one
+
+    def decrypt_layer(self, key : str, deck : list) -> list:
+        """Decrypts every item of one layer of the deck"""
+        if not self.parallel() or len(deck) <= self.MIN_CHUNK:
+            return decrypt_chunk(key, deck)
+
+        self.start()
+        chunks = self.chunks(deck)
+        decrypted = []
+        for chunk in self.pool.map(decrypt_chunk, [key] * len(chunks), chunks):
+            decrypted += chunk
+        return decrypted
+
+    def derive_cards(self, deck : list, seeds : dict, card_size : int, version : int = 1) -> dict:
+        """Derives the card of every player. seeds maps the sequence of the player to their deck key"""
+        # only the original shuffle needs the whole deck shuffled, newer ones are cheap enough to do here
+        if not self.parallel() or len(seeds) < 2 or version != 1:
+            return derive_cards(deck, seeds, card_size, version)
+
+        # groups the players so the deck is sent to each worker only once
+        self.start()
+        groups = [dict(list(seeds.items())[i::self.workers]) for i in range(min(self.workers, len(seeds)))]
+        cards = {}
+        for group in self.pool.map(derive_cards, [deck] * len(groups), groups, [card_size] * len(groups), [version] * len(groups)):
+            cards.update(group)
+        return {seq : cards[seq] for seq in seeds.keys()}
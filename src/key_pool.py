@@ -0,0 +1,150 @@
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM # for encrypting the keystore
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt # for deriving its key from the passphrase
+from cryptography.exceptions import InvalidTag
+import hashlib # for naming the keystore of a user
+import os
+import threading # for refilling in the background
+import time # for finding leftover files
+
+class KeyPool:
+    """Local keystore of RSA keys generated ahead of time, so that getting a key doesn't wait for one to be generated.
+    Every key is handed out once, even with many processes sharing the keystore, and the pool is refilled in the background.
+    Every user has a keystore of their own, so no one ever uses a key someone else made.
+    Keys are encrypted with a key derived from the passphrase in the ENV environment variable, and there's no pool without one"""
+
+    PATH = 'keystore' # relative to where the process runs, holds the keystore of every role and user
+    SIZE = 8 # keys kept ready
+    KEY_SIZE = 2048
+
+    ENV = 'BINGO_KEYSTORE_PASSPHRASE' # environment variable with the passphrase the keys are encrypted with
+
+    # seconds before refilling, so the process that took a key isn't slowed down while it starts
+    REFILL_DELAY = 1.0
+
+    # seconds after which a file that was being written or taken was left behind by a process that died
+    STALE_AGE = 60
+
+    NONCE_SIZE = 12
+    SALT_SIZE = 16
+    SUFFIX = '.rsa' # of the files holding a ready key
+
+    def __init__(self, path : str = None, size : int = None, passphrase : str = None):
+        self.path = path if path else self.PATH
+        self.size = size if size else self.SIZE
+        passphrase = passphrase if passphrase else os.environ.get(self.ENV)
+        if not passphrase:
+            raise ValueError(f'the keystore needs a passphrase, set {self.ENV}')
+
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        self.clean()
+        self.aead = AESGCM(self.derive_key(passphrase))
+        self.filler = None # thread refilling the pool, if any
+
+    @classmethod
+    def from_env(cls, path : str):
+        """The keystore at the path, None if there's no passphrase in ENV, and keys are then generated when needed"""
+        return cls(path) if os.environ.get(cls.ENV) else None
+
+    @classmethod
+    def path_of(cls, owner : str) -> str:
+        """Keystore of an owner, in the keystore folder"""
+        return os.path.join(cls.PATH, owner)
+
+    @classmethod
+    def user_path(cls, card_modulus : bytes) -> str:
+        """Keystore of the user of a smartcard"""
+        return cls.path_of('user-' + hashlib.sha256(card_modulus).hexdigest()[:16])
+
+    def clean(self) -> None:
+        """Removes the files of keys that a process was writing or taking when it died"""
+        for name in os.listdir(self.path):
+            if not name.endswith(('.tmp', '.taken')):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                if time.time() - os.path.getmtime(path) > self.STALE_AGE: # a younger one may still be in use
+                    os.remove(path)
+            except FileNotFoundError:
+                pass # its process finished with it meanwhile
+
+    def derive_key(self, passphrase : str) -> bytes:
+        """Key the keystore is encrypted with, derived from the passphrase and the salt of the keystore, made on first use"""
+        path = os.path.join(self.path, 'salt')
+        if not os.path.exists(path):
+            # written aside and linked in place, so that a process racing us reads either none or all of it
+            tmp = f'{path}.{os.getpid()}.tmp'
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.write(fd, os.urandom(self.SALT_SIZE))
+            os.close(fd)
+            try:
+                os.link(tmp, path)
+            except FileExistsError:
+                pass # someone else made it first, theirs is used
+            finally:
+                os.remove(tmp)
+
+        with open(path, 'rb') as f:
+            salt = f.read()
+        return Scrypt(salt=salt, length=32, n=2**14, r=8, p=1).derive(passphrase.encode())
+
+    def count(self) -> int:
+        """How many keys are ready"""
+        return sum(1 for name in os.listdir(self.path) if name.endswith(self.SUFFIX))
+
+    def put(self, key) -> None:
+        """Stores a key in the pool, encrypted with the key of the keystore"""
+        name = os.urandom(16).hex()
+        data = key.private_bytes(serialization.Encoding.DER, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+        nonce = os.urandom(self.NONCE_SIZE)
+        data = nonce + self.aead.encrypt(nonce, data, name.encode())
+
+        # only shows up in the pool once completely written
+        path = os.path.join(self.path, name)
+        fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.write(fd, data)
+        os.close(fd)
+        os.rename(path + '.tmp', path + self.SUFFIX)
+
+    def take(self):
+        """A ready key object, None if there are none. Either way, the pool is refilled in the background"""
+        key = None
+        for name in os.listdir(self.path):
+            if not name.endswith(self.SUFFIX):
+                continue
+
+            # renaming is atomic, only one process gets to take each key
+            path = os.path.join(self.path, name)
+            try:
+                os.rename(path, path + '.taken')
+            except FileNotFoundError:
+                continue
+
+            with open(path + '.taken', 'rb') as f:
+                data = f.read()
+            os.remove(path + '.taken')
+
+            try:
+                data = self.aead.decrypt(data[:self.NONCE_SIZE], data[self.NONCE_SIZE:], name[:-len(self.SUFFIX)].encode())
+                # the tag proves the key was stored by us, so the costly check of the key is skipped
+                key = serialization.load_der_private_key(data, password=None, unsafe_skip_rsa_key_validation=True)
+                break
+            except (InvalidTag, ValueError):
+                continue # stored with another passphrase or damaged, skip it
+
+        self.refill()
+        return key
+
+    def fill(self) -> None:
+        """Generates keys until the pool is full"""
+        while self.count() < self.size:
+            self.put(rsa.generate_private_key(public_exponent=65537, key_size=self.KEY_SIZE))
+
+    def refill(self, delay : float = None) -> None:
+        """Fills the pool on a background thread after a while, unless it is already being filled"""
+        if self.filler and self.filler.is_alive():
+            return
+        self.filler = threading.Timer(self.REFILL_DELAY if delay == None else delay, self.fill)
+        self.filler.daemon = True
+        self.filler.start()
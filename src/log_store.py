@@ -0,0 +1,238 @@
+from src.common import LogEntry
+from collections import OrderedDict # for keeping only the most recently used files and segments open
+import os
+import mmap # for reading pages without a read call per entry
+import struct # for the index records
+
+class FileCache:
+    """Descriptors and maps of the AppendFiles, shared by every store of the process. Only the SIZE most recently used
+    files have theirs open, the rest are closed and opened again when next used, so a server with many logs open
+    stays well under the limit of descriptors"""
+
+    # files with a descriptor open at most. a map holds a descriptor of its own, so up to twice as many are used
+    SIZE = 128
+
+    files = OrderedDict() # key is the file, value is None ; least recently used first
+
+    @classmethod
+    def use(cls, file) -> None:
+        """Marks the file as the most recently used, closing the descriptors of the least recently used one if there are too many"""
+        if file in cls.files:
+            cls.files.move_to_end(file)
+            return
+        cls.files[file] = None
+        while len(cls.files) > cls.SIZE:
+            cls.files.popitem(last=False)[0].release()
+
+    @classmethod
+    def forget(cls, file) -> None:
+        cls.files.pop(file, None)
+        file.release()
+
+class AppendFile:
+    """File that is only ever appended to. Appends are buffered and written on flush, reads of what was written go through mmap.
+    The descriptor and the map are taken from the FileCache as needed, the file itself holds none of them for long"""
+
+    FLUSH_SIZE = 64 * 1024 # bytes buffered before they are written
+
+    # fsync policies: 'always' syncs every append, 'epoch' whenever sync() is called, 'never' leaves it to the OS
+    FSYNC_POLICIES = ('always', 'epoch', 'never')
+
+    def __init__(self, path : str, fsync : str = 'epoch'):
+        self.path = path
+        self.fd = None # descriptor, while the cache keeps it open
+        self.map = None # mmap of the written bytes, remapped as the file grows
+        self.fsync = fsync
+        self.written = os.fstat(self.fileno()).st_size # bytes already in the file
+        self.pending = bytearray() # bytes appended but not written yet
+
+    def fileno(self) -> int:
+        """The descriptor of the file, opening it again if the cache had closed it"""
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        FileCache.use(self)
+        return self.fd
+
+    def release(self) -> None:
+        """Closes the descriptor and drops the map. Whatever is buffered stays, and is written when next flushed"""
+        self.map = None # views of the map keep it alive, so it is dropped rather than closed
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    @property
+    def size(self) -> int:
+        return self.written + len(self.pending)
+
+    def append(self, data : bytes) -> int:
+        """Appends the data, returning the offset it starts at"""
+        offset = self.size
+        self.pending += data
+        if self.fsync == 'always':
+            self.sync()
+        elif len(self.pending) >= self.FLUSH_SIZE:
+            self.flush()
+        return offset
+
+    def flush(self) -> None:
+        """Writes the buffered bytes to the file"""
+        if self.pending:
+            os.pwrite(self.fileno(), self.pending, self.written)
+            self.written += len(self.pending)
+            self.pending = bytearray() # a read may still be holding the old buffer
+
+    def sync(self) -> None:
+        """Writes the buffered bytes and, unless the policy says otherwise, makes sure they are on disk.
+        Syncing through a descriptor opened again still covers what was written through a closed one"""
+        self.flush()
+        if self.fsync != 'never':
+            os.fsync(self.fileno())
+
+    def read(self, start : int, end : int):
+        """Bytes from start to end. Written bytes are a view of the mapped file, callers copy or decode what they keep"""
+        if start >= self.written:
+            return bytes(self.pending[start - self.written:end - self.written])
+        if end > self.written:
+            self.flush()
+
+        # views of an older map keep it alive, so it is dropped rather than closed
+        fd = self.fileno()
+        if self.map is None or len(self.map) < end:
+            self.map = mmap.mmap(fd, self.written, access=mmap.ACCESS_READ)
+        return memoryview(self.map)[start:end]
+
+    def truncate(self, size : int) -> None:
+        """Drops everything after size"""
+        self.flush()
+        if size < self.written:
+            self.map = None
+            os.ftruncate(self.fileno(), size)
+            self.written = size
+
+    def close(self) -> None:
+        self.sync()
+        FileCache.forget(self)
+
+class RecordFile(AppendFile):
+    """AppendFile of fixed-width records. Can be read like a list, every record read is a copy"""
+
+    def __init__(self, path : str, width : int, fsync : str = 'epoch'):
+        super().__init__(path, fsync)
+        self.width = width
+        self.truncate(self.written - self.written % width) # a record torn by a crash is dropped
+
+    def __len__(self):
+        return self.size // self.width
+
+    def __getitem__(self, index : int) -> bytes:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('record index out of range')
+        return bytes(self.read(index * self.width, (index + 1) * self.width))
+
+    def records(self, start : int, end : int):
+        """The records from start to end, as a single buffer"""
+        return self.read(start * self.width, end * self.width)
+
+    def truncate_records(self, count : int) -> None:
+        self.truncate(count * self.width)
+
+class LogStore:
+    """Append-only store of log entries on disk. The canonical bytes of the entries go into segment files
+    of SEGMENT_ENTRIES entries each, and a fixed-width index holds where each one is in its segment,
+    so finding any entry costs O(1) and reopening the store doesn't read it. Can be read like a list"""
+
+    SEGMENT_ENTRIES = 4096
+
+    # segments kept at hand for reading, besides the one being appended to. their descriptors come from the FileCache
+    SEGMENTS_OPEN = 8
+
+    INDEX = struct.Struct('>QI') # offset in the segment, length
+
+    def __init__(self, path : str, fsync : str = 'epoch'):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.fsync = fsync
+        self.index = RecordFile(os.path.join(path, 'index'), self.INDEX.size, fsync)
+        self.segments = OrderedDict() # key is the segment number, value is its file, least recently used first
+
+        # the index may have been written further than the segment before a crash
+        count = len(self.index)
+        while count and self.end_of(count - 1) > self.segment(self.segment_of(count - 1)).size:
+            count -= 1
+        self.truncate(count)
+
+    def segment_of(self, index : int) -> int:
+        return index // self.SEGMENT_ENTRIES
+
+    def segment(self, number : int) -> AppendFile:
+        """The file of the segment, opening it if needed"""
+        if number in self.segments:
+            self.segments.move_to_end(number)
+            return self.segments[number]
+
+        self.segments[number] = AppendFile(os.path.join(self.path, f'{number:08d}.log'), self.fsync)
+        if len(self.segments) > self.SEGMENTS_OPEN + 1:
+            self.segments.popitem(last=False)[1].close()
+        return self.segments[number]
+
+    def end_of(self, index : int) -> int:
+        """Offset, in its segment, right after the entry at index"""
+        offset, length = self.INDEX.unpack(self.index[index])
+        return offset + length
+
+    def append(self, entry : LogEntry, data : bytes = None) -> None:
+        """Appends the entry. data is its canonical bytes, if already at hand"""
+        # the entry goes in before the index points to it
+        data = data if data != None else entry.canonical()
+        offset = self.segment(self.segment_of(len(self))).append(data)
+        self.index.append(self.INDEX.pack(offset, len(data)))
+
+    def sync(self) -> None:
+        for segment in self.segments.values():
+            segment.sync()
+        self.index.sync()
+
+    def truncate(self, count : int) -> None:
+        """Drops every entry after the first count"""
+        if count < len(self.index):
+            self.segment(self.segment_of(count)).truncate(self.INDEX.unpack(self.index[count])[0])
+            for number in range(self.segment_of(count) + 1, self.segment_of(len(self.index) - 1) + 1):
+                self.segment(number).truncate(0)
+            self.index.truncate_records(count)
+
+    def close(self) -> None:
+        for segment in self.segments.values():
+            segment.close()
+        self.segments.clear()
+        self.index.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.read(*index.indices(len(self))[:2])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('log index out of range')
+        return self.read(index, index + 1)[0]
+
+    def read(self, start : int, end : int) -> list:
+        """The entries from start to end. Entries of the same segment are read as a single slice of its map, and each one is decoded"""
+        entries = []
+        while start < end:
+            stop = min(end, (self.segment_of(start) + 1) * self.SEGMENT_ENTRIES)
+            locations = list(self.INDEX.iter_unpack(self.index.records(start, stop)))
+            first = locations[0][0]
+            block = self.segment(self.segment_of(start)).read(first, locations[-1][0] + locations[-1][1])
+            for offset, length in locations:
+                entries.append(LogEntry.from_canonical(block[offset - first:offset - first + length]))
+            start = stop
+        return entries
+
+    def __iter__(self):
+        for start in range(0, len(self), self.SEGMENT_ENTRIES):
+            yield from self.read(start, min(len(self), start + self.SEGMENT_ENTRIES))
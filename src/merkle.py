@@ -0,0 +1,200 @@
+import hashlib
+
+class Merkle:
+    """Merkle tree utilities, as in RFC 6962: leaves and nodes are hashed with different prefixes and a lone node is promoted to the level above"""
+
+    @classmethod
+    def leaf(cls, data : bytes) -> bytes:
+        """Hash of a leaf"""
+        return hashlib.sha256(b'\x00' + data).digest()
+
+    @classmethod
+    def node(cls, left : bytes, right : bytes) -> bytes:
+        """Hash of an inner node"""
+        return hashlib.sha256(b'\x01' + left + right).digest()
+
+    @classmethod
+    def levels(cls, leaves : list) -> list:
+        """Every level of the tree over the leaf hashes, from the leaves up to the root"""
+        levels = [list(leaves)]
+        while len(levels[-1]) > 1:
+            level = levels[-1]
+            above = [cls.node(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+            if len(level) % 2: # lone node goes up as it is
+                above.append(level[-1])
+            levels.append(above)
+        return levels
+
+    @classmethod
+    def root(cls, leaves : list) -> bytes:
+        """Root of the tree over the leaf hashes. The empty tree's root is the hash of nothing"""
+        if not leaves:
+            return hashlib.sha256(b'').digest()
+        return cls.levels(leaves)[-1][0]
+
+    @classmethod
+    def inclusion_proof(cls, levels : list, index : int) -> list:
+        """Hashes needed to recompute the root from the leaf at index, O(log n) of them"""
+        proof = []
+        for level in levels[:-1]:
+            sibling = index - 1 if index % 2 else index + 1
+            if sibling < len(level): # a lone node has no sibling
+                proof.append(level[sibling])
+            index //= 2
+        return proof
+
+    # RFC 9162, section 2.1.3.2
+    @classmethod
+    def verify_inclusion(cls, root : bytes, leaf : bytes, index : int, size : int, proof : list) -> bool:
+        """Verifies that the leaf hash is at index of the tree of given size and root"""
+        if index >= size:
+            return False
+
+        fn, sn = index, size - 1
+        r = leaf
+        for p in proof:
+            if sn == 0:
+                return False
+            if fn % 2 or fn == sn:
+                r = cls.node(p, r)
+                while fn % 2 == 0 and fn != 0:
+                    fn >>= 1
+                    sn >>= 1
+            else:
+                r = cls.node(r, p)
+            fn >>= 1
+            sn >>= 1
+
+        return sn == 0 and r == root
+
+    # RFC 9162, section 2.1.4.2
+    @classmethod
+    def verify_consistency(cls, old_size : int, size : int, old_root : bytes, root : bytes, proof : list) -> bool:
+        """Verifies that the tree of old_size and old_root is a prefix of the tree of given size and root"""
+        if old_size > size:
+            return False
+        if old_size == size:
+            return not proof and old_root == root
+        if old_size == 0: # everything extends the empty tree
+            return not proof
+
+        proof = list(proof)
+        if old_size & (old_size - 1) == 0: # the old tree is a subtree of the new one, its root starts the path
+            proof.insert(0, old_root)
+        if not proof:
+            return False
+
+        fn, sn = old_size - 1, size - 1
+        while fn % 2:
+            fn >>= 1
+            sn >>= 1
+
+        fr = sr = proof[0]
+        for c in proof[1:]:
+            if sn == 0:
+                return False
+            if fn % 2 or fn == sn:
+                fr = cls.node(c, fr)
+                sr = cls.node(c, sr)
+                while fn % 2 == 0 and fn != 0:
+                    fn >>= 1
+                    sn >>= 1
+            else:
+                sr = cls.node(sr, c)
+            fn >>= 1
+            sn >>= 1
+
+        return sn == 0 and fr == old_root and sr == root
+
+class MerkleLog:
+    """Merkle accumulator over an append-only list of leaf hashes. Appending costs O(1) amortized,
+    and the root, inclusion and consistency proofs of any past size cost O(log n).
+    Nodes are stored in post-order, as in a Merkle mountain range: leaf j sits at 2j - popcount(j)
+    and the node of height h over the leaves ending at j sits h positions after it.
+    The roots are the same as Merkle.root's over the same leaves"""
+
+    def __init__(self, nodes = None, size : int = 0):
+        self.nodes = nodes if nodes != None else [] # every node of the perfect subtrees, in post-order. Anything that reads like a list
+        self.size = size # number of leaves
+
+    @classmethod
+    def leaf_position(cls, index : int) -> int:
+        return 2 * index - bin(index).count('1')
+
+    @classmethod
+    def node_count(cls, size : int) -> int:
+        """How many nodes are stored for size leaves"""
+        return 2 * size - bin(size).count('1')
+
+    @classmethod
+    def split(cls, size : int) -> int:
+        """Largest power of two smaller than size, where RFC 6962 splits a tree"""
+        return 1 << (size - 1).bit_length() - 1
+
+    def append(self, leaf : bytes) -> None:
+        """Adds a leaf hash, merging the perfect subtrees it completes"""
+        position = self.node_count(self.size) # where the leaf goes
+        self.nodes.append(leaf)
+        self.size += 1
+
+        # one merge per trailing zero of the new size
+        node, height, size = leaf, 0, self.size
+        while size % 2 == 0:
+            node = Merkle.node(self.nodes[position + 1 - (2 << height)], node)
+            self.nodes.append(node)
+            position += 1
+            height += 1
+            size >>= 1
+
+    def subtree(self, start : int, end : int) -> bytes:
+        """Root of the tree over the leaves from start to end"""
+        size = end - start
+        if size & (size - 1) == 0 and start % size == 0: # perfect subtree, already stored
+            return self.nodes[self.leaf_position(end - 1) + size.bit_length() - 1]
+        k = self.split(size)
+        return Merkle.node(self.subtree(start, start + k), self.subtree(start + k, end))
+
+    def root(self, size : int = None) -> bytes:
+        """Root of the tree as it was when it had size leaves, the current one by default"""
+        size = self.size if size == None else size
+        if size == 0:
+            return Merkle.root([])
+        return self.subtree(0, size)
+
+    # RFC 6962, section 2.1.1
+    def inclusion_proof(self, index : int, size : int = None) -> list:
+        """Hashes proving the leaf at index is in the tree of given size, for Merkle.verify_inclusion"""
+        size = self.size if size == None else size
+        proof = []
+        start, end = 0, size
+        while end - start > 1:
+            k = self.split(end - start)
+            if index < start + k:
+                proof.append(self.subtree(start + k, end))
+                end = start + k
+            else:
+                proof.append(self.subtree(start, start + k))
+                start += k
+        return proof[::-1]
+
+    # RFC 6962, section 2.1.2
+    def consistency_proof(self, old_size : int, size : int = None) -> list:
+        """Hashes proving the tree of old_size is a prefix of the tree of given size, for Merkle.verify_consistency"""
+        size = self.size if size == None else size
+        if old_size == 0 or old_size >= size:
+            return []
+
+        proof = []
+        start, end, complete = 0, size, True
+        while old_size - start != end - start:
+            k = self.split(end - start)
+            if old_size - start <= k:
+                proof.append(self.subtree(start + k, end))
+                end = start + k
+            else:
+                proof.append(self.subtree(start, start + k))
+                start += k
+                complete = False
+        if not complete:
+            proof.append(self.subtree(start, end))
+        return proof[::-1]
@@ -0,0 +1,105 @@
+import bisect # for finding the bucket of a latency
+import json
+import os
+import time
+
+class Histogram:
+    """Histogram of latencies over fixed, log-spaced buckets. Observing is a bisect and an increment,
+    percentiles are read off the buckets, so they are as precise as the buckets are narrow"""
+
+    # upper bounds of the buckets in seconds, 4 per decade from 10us to 10s. the last bucket takes anything slower
+    BOUNDS = tuple(10 ** (exponent / 4) for exponent in range(-20, 5))
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds : float) -> None:
+        self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p : float) -> float:
+        """Upper bound of the bucket the p-th percentile falls in, never more than the slowest observation"""
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {'count' : self.count, 'mean' : self.total / self.count if self.count else 0.0, 'max' : self.max,
+                'p50' : self.percentile(50), 'p90' : self.percentile(90), 'p99' : self.percentile(99)}
+
+class Metrics:
+    """In-process counters, gauges, latency histograms and message counts of a server. Everything is kept in plain dicts
+    updated from the event loop, so recording costs about as much as a dict lookup"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {} # key is the name, value is how many times it happened
+        self.gauges = {} # key is the name, value is its current value
+        self.histograms = {} # key is the name, value is the Histogram of its latencies
+        self.messages = {'in' : {}, 'out' : {}} # key is the header, value is [messages, bytes] ; per direction
+
+    def inc(self, name : str, amount : int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name : str, amount : int) -> None:
+        """Moves a gauge up or down"""
+        self.gauges[name] = self.gauges.get(name, 0) + amount
+
+    def observe(self, name : str, seconds : float) -> None:
+        histogram = self.histograms.get(name)
+        if not histogram:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    def message(self, direction : str, header : str, size : int) -> None:
+        """Counts a message going 'in' or 'out', and its bytes on the wire"""
+        counts = self.messages[direction].get(header)
+        if not counts:
+            counts = self.messages[direction][header] = [0, 0]
+        counts[0] += 1
+        counts[1] += size
+
+    def snapshot(self) -> dict:
+        """Everything recorded so far, as a dict that can be sent or dumped as JSON"""
+        return {
+            'time' : time.time(),
+            'uptime' : time.time() - self.started,
+            'counters' : dict(self.counters),
+            'gauges' : dict(self.gauges),
+            'latency' : {name : histogram.snapshot() for name, histogram in sorted(self.histograms.items())},
+            'messages' : {direction : {header : {'count' : count, 'bytes' : size} for header, (count, size) in sorted(headers.items())}
+                          for direction, headers in self.messages.items()},
+        }
+
+    def dump(self, path : str) -> None:
+        """Writes the snapshot to the file. Readers see either the previous dump or this one, never half of it"""
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def report(cls, snapshot : dict) -> str:
+        """Human readable text of a snapshot"""
+        lines = [f'uptime {snapshot["uptime"]:.1f}s']
+        lines += [f'{name:<24} {value:>10}' for name, value in sorted({**snapshot['counters'], **snapshot['gauges']}.items())]
+
+        lines.append(f'{"latency (ms)":<24} {"count":>10} {"mean":>9} {"p50":>9} {"p90":>9} {"p99":>9} {"max":>9}')
+        for name, h in snapshot['latency'].items():
+            lines.append(f'{name:<24} {h["count"]:>10} ' + ' '.join(f'{h[key] * 1000:>9.3f}' for key in ('mean', 'p50', 'p90', 'p99', 'max')))
+
+        lines.append(f'{"messages":<24} {"in":>10} {"bytes in":>12} {"out":>10} {"bytes out":>12}')
+        received, sent = snapshot['messages']['in'], snapshot['messages']['out']
+        for header in sorted(set(received) | set(sent)):
+            i, o = received.get(header, {'count' : 0, 'bytes' : 0}), sent.get(header, {'count' : 0, 'bytes' : 0})
+            lines.append(f'{header:<24} {i["count"]:>10} {i["bytes"]:>12} {o["count"]:>10} {o["bytes"]:>12}')
+        return '\n'.join(lines)
@@ -3,12 +3,13 @@ from src.crypto import Crypto
 
 class Player(User):
 
-    def __init__(self, nickname : str, pin : str):
+    def __init__(self, nickname : str, pin : str, table : int = None, workers : int = None, softcard : str = None, softcard_latency : float = 0,
+                 profile : str = None):
         print(f'You are a PLAYER. Your nickname is "{nickname}".')
         
         #self.CC_private, self.CC_public = Crypto.asym_gen()
 
-        super().__init__(nickname, pin)
+        super().__init__(nickname, pin, table, workers, softcard, softcard_latency, profile)
 
     def handle_input(self, stdin):
         """Receives the typing input"""
@@ -16,21 +17,25 @@ class Player(User):
 
         if text == 'AUTH' and not self.authenticated:
             print('[AUTH] Asking the playing area for a challenge...')
-            # convert tuple of bytes to tuple of base64 strings
-            modulus, pubexp = self.CC_public
-            modulus, pubexp = base64.b64encode(modulus).decode('ascii'), base64.b64encode(pubexp).decode('ascii')
-            encoded_CC_public = (modulus, pubexp)
-
-            Proto.send_msg(self.sock, Authenticate(encoded_CC_public))
+            self.send(Authenticate(self.CC_public_encoded))
         elif text == 'GETUSERS' and self.authenticated:
             print('[SEC] Asking the playing area for the list of registed users...')
-            Proto.send_msg(self.sock, GetUsers(self.CC_public, "signature"))
+            self.send(GetUsers(self.CC_public_encoded, "signature"))
         elif text == 'GETLOG' and self.authenticated:
-            print('[SEC] Asking the playing area for the list of logged messages...')
-            Proto.send_msg(self.sock, GetLog(self.CC_public, "signature"))
+            print('[SEC] Asking the playing area for the new logged messages...')
+            self.request_log()
+        elif text == 'WATCHLOG' and self.authenticated:
+            print('[SEC] Asking the playing area to send logged messages as they come...')
+            self.request_log(subscribe=True)
+        elif text.startswith('CHECKLOG ') and text[len('CHECKLOG '):].isdigit() and self.authenticated:
+            print('[SEC] Asking the playing area to prove a logged message is in the log...')
+            self.send(LogProof(self.CC_public_encoded, "signature", int(text[len('CHECKLOG '):])))
+        elif text == 'STATS' and self.authenticated:
+            print('[STATS] Asking the playing area for its metrics...')
+            self.send(Stats(self.CC_public_encoded, "signature"))
         elif text == 'REGISTER' and not self.registered and self.authenticated:
             print(f'[REG] Registering yourself to the playing area as "{self.nickname}"...')
-            Proto.send_msg(self.sock, Register(self.nickname, self.public_key, self.CC_public, "signature"))
+            self.send(Register(self.nickname, self.public_key, self.CC_public_encoded, "signature", table=self.table))
         else:
             print('Invalid input.')
 
@@ -65,16 +70,16 @@ class Player(User):
         print('[GAME] Generating card...')
 
         # Shuffle the deck deterministically
-        msg.deck = Crypto.deterministic_shuffle(msg.deck, self.deck_key)
-        new_deck = [Crypto.sym_encrypt(self.deck_key, num) for num in msg.deck]
-        msg.deck = new_deck
+        msg.deck = Crypto.deterministic_shuffle(list(msg.deck), self.deck_key, self.shuffle_version) # decks are replaced, never changed in place
+        new_deck = Crypto.encrypt_deck(self.deck_key, msg.deck) # the whole deck in one pass
+        msg.deck = Records(new_deck, len(new_deck) // len(msg.deck)) # kept as one block, it is sent as such
 
         msg.sign(self.private_key)
 
         msg.sequence += 1
 
         print('[GAME] Card generated. Passing it forward...')
-        Proto.send_msg(self.sock, msg)
+        self.send(msg)
 
         # Create dict to hold everyone's deck keys
         self.deck_keys = {key:None for key in self.users.keys()}
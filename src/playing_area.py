@@ -1,8 +1,16 @@
 from src.common import UserData, LogEntry
+from src.audit_log import AuditLog, LogSigner
+from src.table import Table
+from src.metrics import Metrics
+from src.profiler import Profiler
 import socket # websockets
 import sys # for closing the app
 import selectors # for multiplexing
-import time # for sleeping
+import asyncio # for the asyncio server mode
+import heapq # for the timers of the selector server mode
+import itertools # for ordering timers with the same deadline
+import time # for timers
+import os # for the log directory
 
 # for generating random challenges
 import random
@@ -16,12 +24,39 @@ class PlayingArea:
     # should be >= 1024
     PORT = 1024
 
-    # the number of players needed for a game to start
+    # the default number of players needed for a game to start, tables can override it
     PARTY_MAX = 2
 
     # countdown to start the game
     GAME_COUNTDOWN = 1
 
+    # entries of the log sent per GETLOG page, when the user doesn't say and at most
+    LOG_PAGE_SIZE = 100
+    LOG_PAGE_MAX = 1000
+
+    # how the audit log is signed. 'epoch' signs, in the background, one checkpoint over every epoch of entries ;
+    # 'entry' is the strict mode, every entry is signed as it is logged
+    LOG_SIGNING = 'epoch'
+    LOG_EPOCH_ENTRIES = 64 # most entries in an epoch
+    LOG_EPOCH_TIME = 0.2 # most seconds an epoch lasts
+
+    # directory the audit logs are kept in, None keeps them in memory. Buffered appends are synced at the end of every epoch by default
+    LOG_DIR = None
+    LOG_FSYNC = 'epoch'
+
+    # file of the log directory the key the logs are signed with is kept in, so they are still signed by the same key after a restart
+    LOG_KEY = 'playing-area.key'
+
+    # biggest frame accepted from a user who hasn't authenticated yet, they only need to say hello and answer the challenge
+    UNAUTHENTICATED_MAX_FRAME = 64 * 1024
+
+    # bytes that can be waiting to be sent to a user before they're dropped for not keeping up.
+    # only the bytes queued before a message count, so a single big message never gets anyone dropped
+    OUTBOUND_HIGH_WATER = 32 * 1024 * 1024
+
+    # seconds between dumps of the metrics to the stats file, when there is one
+    STATS_INTERVAL = 10
+
     # length of the challenge string for authentication
     CHALLENGE_LENGTH = 14
 
@@ -30,27 +65,94 @@ class PlayingArea:
         """Insert the caller's public CC here"""
     ])
 
-    def __init__(self, card_size : int, deck_size : int):
+    def __init__(self, card_size : int, deck_size : int, party_max : int = None, use_asyncio : bool = False, log_signing : str = None,
+                 log_dir : str = LOG_DIR, log_fsync : str = None, callers : set = None, game_countdown : float = None,
+                 stats_file : str = None, stats_interval : float = None, profile : str = None):
+        # defaults for newly opened tables
         self.card_size = card_size
         self.deck_size = deck_size
+        self.party_max = party_max if party_max else self.PARTY_MAX
+        self.game_countdown = game_countdown if game_countdown != None else self.GAME_COUNTDOWN
 
-        self.running = True
-        self.playing = False # the game has not started
+        # public keys of the smartcards that can be callers, as (modulus, exponent) tuples of base64 strings
+        self.valid_callers = callers if callers != None else self.VALID_CALLERS
 
-        self.caller = None # tuple of socket, userdata ; data is associated with the socket so that when an user disconnects, we clear the data
-        self.players = {} # key is socket, value is userdata ; data is associated with the socket so that when an user disconnects, we clear the data
+        self.running = True
+        self.use_asyncio = use_asyncio # one coroutine per connection instead of the selector loop
+        self.timers = [] # heap of (deadline, id, callback, args) for the selector server mode
+        self.timer_ids = itertools.count()
+
+        self.tables = {} # key is the table id, value is the table
+        self.seats = {} # key is socket, value is the table the user sits at ; data is associated with the socket so that when an user disconnects, we clear the data
+        self.next_table_id = 1
+        self.codecs = {} # key is socket, value is the name of the codec negotiated with the user ; data is associated with the socket so that when an user disconnects, we clear the data
+        self.shuffle_versions = {} # key is socket, value is the list of shuffle versions the user supports ; data is associated with the socket so that when an user disconnects, we clear the data
         self.authorized_keys = {} # key is socket, value is a public key ; data is associated with the socket so that when an user disconnects, we clear the data
+        self.outbound = {} # key is socket, value is the FrameWriter of what is waiting to be sent to it ; data is associated with the socket so that when an user disconnects, we clear the data
+        self.dropped = set() # sockets of the users dropped for not keeping up, closed at the end of the loop iteration
         self.challenges = {} # dict for associating public key to the challenge for users not yet authenticated
+        self.challenge_times = {} # key is the public key, value is when its challenge was sent
+
+        # counters, gauges and latency histograms of every phase, sent to whoever asks with STATS and dumped to the stats file
+        self.metrics = Metrics()
+        self.stats_file = stats_file
+        self.stats_interval = stats_interval if stats_interval else self.STATS_INTERVAL
+
+        # the lobby log is reopened as it was left. tables don't outlive the run, their logs stay on disk but aren't reopened
+        self.log_dir = log_dir
+        self.log_fsync = log_fsync if log_fsync else self.LOG_FSYNC
+        if self.log_dir:
+            os.makedirs(self.log_dir, exist_ok=True)
+            table_ids = [int(name[len('table-'):]) for name in os.listdir(self.log_dir) if name.startswith('table-')]
+            self.next_table_id = max(table_ids, default=0) + 1 # new tables don't write to the logs of old ones
+
+        # Sets Up Private/Public key. the private key is kept parsed for the whole session
+        # there's no key pool, the only key needed is made once, and refilling a pool would stall the serving loop
+        (private_key, self.public_key), new_key = self.signing_key()
+        self.private_key = Crypto.load_private_key(private_key)
+
+        # Log for the commands given by users not sitting at any table yet
+        self.lobby_log = self.open_log('lobby')
+
+        # the checkpoints of a log signed by a key we no longer have can't be checked, it is checkpointed again with ours
+        if new_key:
+            self.lobby_log.checkpoint, self.lobby_log.checkpointed = None, 0
+
+        self.log_signing = log_signing if log_signing else self.LOG_SIGNING
+        self.log_signer = LogSigner(self.private_key) if self.log_signing == 'epoch' else None
+        self.epoch_logs = {self.lobby_log} # logs appended to during this epoch. a reopened log may have entries no checkpoint covers yet
 
-        # Sets Up Private/Public key
-        (self.private_key, self.public_key) = Crypto.asym_gen()
+        self.register_handlers()
 
-        # Log for every command given to the playing area
-        self.log = [LogEntry.genesis_block()]
+        # profiling is off unless asked for, with the flag or the environment
+        profile = profile if profile else os.environ.get(Profiler.ENV)
+        self.profiler = Profiler.start(profile, self.dispatcher) if profile else None
 
         # creates and starts the server
-        self.server_setup()
-        self.run()
+        if self.use_asyncio:
+            self.run_async()
+        else:
+            self.server_setup()
+            self.run()
+
+    def signing_key(self) -> tuple:
+        """The (private, public) PEM key pair the playing area signs with, and whether it was just made.
+        With a log directory the key is kept there, so entries and checkpoints signed before a restart can still be checked"""
+        path = os.path.join(self.log_dir, self.LOG_KEY) if self.log_dir else None
+        if path and os.path.exists(path):
+            with open(path) as f:
+                private_key = f.read()
+            return (private_key, Crypto.serialize_public_key(Crypto.load_private_key(private_key).public_key())), False
+
+        private_key, public_key = Crypto.asym_gen()
+        if path:
+            # written aside and renamed in place, so a crash never leaves half a key. only we can read it
+            fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.write(fd, private_key.encode())
+            os.fsync(fd)
+            os.close(fd)
+            os.replace(path + '.tmp', path)
+        return (private_key, public_key), True
 
     def server_setup(self):
         """Creates a TCP websocket at a predifined port"""
@@ -75,111 +177,425 @@ class PlayingArea:
     def run(self):
         """Receives messages as they come"""
 
+        self.start_log_epochs()
+        self.start_stats_dumps()
+
         # waits for messages
         try:
             while self.running:
-                events = self.selector.select()
+                events = self.selector.select(timeout=self.next_timeout())
+                start = time.perf_counter() # the iteration is timed from the end of the wait
 
                 # loops through every event in the selector...
-                for key, _ in events:
+                for key, mask in events:
                     # if the data is none, that means that the socket has not yet been accepted
                     if key.data is None:
                         # accept the connection
                         self.accept_connection(key.fileobj) # key.fileobj is the socket object
-                    else:
-                        self.service_connection(key)
+                    elif key.fileobj not in self.dropped:
+                        self.service_connection(key, mask)
+
+                # fires the timers that are due
+                self.run_timers()
+
+                # users dropped during the iteration are only closed now, no handler is in the middle of going over them
+                for sock in list(self.dropped):
+                    self.close_connection(sock)
+                self.metrics.observe('loop_iteration', time.perf_counter() - start)
+
+        # shutdowns if the user interrupts the proccess
+        except KeyboardInterrupt:
+            self.poweroff()
 
+    def run_async(self):
+        """Receives messages as they come, with one coroutine per connection"""
+        try:
+            asyncio.run(self.serve())
         # shutdowns if the user interrupts the proccess
         except KeyboardInterrupt:
             self.poweroff()
 
+    async def serve(self):
+        """Starts the asyncio server and serves until powered off"""
+        self.loop = asyncio.get_running_loop()
+        self.start_log_epochs()
+        self.start_stats_dumps()
+        self.server = await asyncio.start_server(self.serve_connection, socket.gethostname(), self.PORT, reuse_address=True)
+
+        print(f"[NET] Started playing area at port {self.PORT} (asyncio).")
+
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def serve_connection(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter):
+        """Coroutine for a single connection. The writer stands in for the socket in the handlers"""
+        print(f"[NET] Accepted connection from {writer.get_extra_info('peername')}.")
+        self.metrics.inc('connections_accepted')
+        self.metrics.gauge('connections_open', 1)
+
+        try:
+            while self.running:
+                # get the length of the incoming message
+                header = await reader.readexactly(Proto.HEADER_SIZE)
+                msg_size = Proto.frame_size(header, self.frame_limit(writer))
+
+                msg_encoded = await reader.readexactly(msg_size)
+                msg = Proto.parse_msg(msg_encoded)
+                if msg:
+                    self.metrics.message('in', msg.header, Proto.HEADER_SIZE + msg_size)
+                    self.handle_message(writer, msg)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except ProtoBadFormat:
+            print(f'[NET] Closing a connection that sent a frame over the limit or malformed.')
+        # a bad message only costs the connection that sent it, never the other tables
+        except Exception as e:
+            print(f'[NET] Closing a connection whose message could not be handled: {e!r}')
+
+        print(f"[NET] Connection with a user has been lost.")
+        self.metrics.gauge('connections_open', -1)
+        self.leave(writer)
+        writer.close()
+
+    def send(self, sock : socket, msg : Message):
+        """Sends a message to a user with their codec, whatever the server mode"""
+        self.broadcast([sock], msg)
+
+    def broadcast(self, socks : list, msg : Message):
+        """Sends the same message to every user. It is encoded once per codec, and the frame is shared by all of their queues"""
+        frames = {} # key is the codec, value is (frame, size)
+        for sock in socks:
+            codec = self.codecs.get(sock, JsonCodec.NAME)
+            if codec not in frames:
+                frame = Proto.encode_frame(msg, codec)
+                frames[codec] = (frame, sum(len(view) for view in frame))
+            frame, size = frames[codec]
+
+            self.metrics.message('out', msg.header, size)
+            self.write(sock, frame)
+
+    def write(self, sock : socket, frame : tuple):
+        """Queues the frame to be sent to the user without blocking, dropping them if they don't keep up"""
+        if self.use_asyncio:
+            # buffered by the transport
+            if sock.is_closing():
+                return
+            if sock.transport.get_write_buffer_size() > self.OUTBOUND_HIGH_WATER:
+                self.drop(sock, sock.transport.get_write_buffer_size())
+                return
+            sock.writelines(frame)
+            return
+
+        writer = self.outbound.get(sock)
+        if not writer or sock in self.dropped:
+            return
+        if writer.size > self.OUTBOUND_HIGH_WATER:
+            self.drop(sock, writer.size)
+            return
+
+        # with nothing queued before it, most frames go out right away. the rest waits for the socket to be writable
+        pending = writer.size
+        writer.queue(frame)
+        if not pending:
+            self.flush(sock)
+
+    def flush(self, sock : socket):
+        """Writes what is queued for the user, watching for the socket to be writable until all of it is sent"""
+        try:
+            done = self.outbound[sock].flush(sock)
+        except OSError: # the connection is gone, the read side finds out too
+            self.dropped.add(sock)
+            return
+        reader = self.selector.get_key(sock).data
+        self.selector.modify(sock, selectors.EVENT_READ if done else selectors.EVENT_READ | selectors.EVENT_WRITE, data=reader)
+
+    def drop(self, sock : socket, queued : int):
+        """Disconnects a user who is not reading what is sent to them"""
+        print(f'[NET] Dropping a user who is not keeping up, {queued} bytes are waiting for them.')
+        self.metrics.inc('connections_dropped')
+        if self.use_asyncio:
+            sock.transport.abort() # the coroutine of the connection clears the rest
+        else:
+            self.dropped.add(sock)
+
+    def call_later(self, delay : float, callback, *args):
+        """Schedules a callback without blocking the server"""
+        if self.use_asyncio:
+            self.loop.call_later(delay, callback, *args)
+        else:
+            heapq.heappush(self.timers, (time.monotonic() + delay, next(self.timer_ids), callback, args))
+
+    def start_log_epochs(self):
+        """Starts ending an epoch of the audit logs every so often, unless they are in memory and every entry is signed as it is logged"""
+        if self.log_signer or self.log_dir:
+            self.call_later(self.LOG_EPOCH_TIME, self.log_epoch)
+
+    def start_stats_dumps(self):
+        """Starts dumping the metrics to the stats file every so often, if there is one"""
+        if self.stats_file:
+            self.call_later(self.stats_interval, self.dump_stats)
+
+    def dump_stats(self):
+        self.metrics.dump(self.stats_file)
+        if self.running:
+            self.call_later(self.stats_interval, self.dump_stats)
+
+    def next_timeout(self) -> float:
+        """How long the selector may block until the next timer is due, None if there are no timers"""
+        if not self.timers:
+            return None
+        return max(0, self.timers[0][0] - time.monotonic())
+
+    def run_timers(self):
+        """Fires every timer that is due"""
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self.timers)
+            callback(*args)
+
     def accept_connection(self, sock):
         """Accepts the connection from a client (player)"""
 
         connection, address = sock.accept()
 
-        # only accepts connection if game has not yet started
-        if self.playing:
-            print(f"[NET] Refused a connection because the game has already begun.")
-            connection.close()
-            return
-
+        # games that have already begun refuse new users at registration, not here
         print(f"[NET] Accepted connection from {address}.")
-        self.selector.register(connection, selectors.EVENT_READ, data="")
+        self.metrics.inc('connections_accepted')
+        self.metrics.gauge('connections_open', 1)
+
+        # a slow user must never block the loop, what they can't take right away waits in their queue
+        connection.setblocking(False)
+        self.outbound[connection] = FrameWriter()
 
-    def service_connection(self, key):
+        # every connection reassembles its frames in its own buffer
+        self.selector.register(connection, selectors.EVENT_READ, data=FrameReader())
+
+    def service_connection(self, key, mask : int = selectors.EVENT_READ):
         sock = key.fileobj
-        data = key.data
-
-        msg = Proto.recv_msg(sock)
-
-        # if message is valid
-        if msg:
-            if msg.header == 'AUTH':
-                self.authenticate(sock, msg)
-            elif msg.header == 'REGISTER':
-                self.register(sock, msg)
-            elif msg.header == 'GETUSERS':
-                self.get_user_list(sock, msg)
-            elif msg.header == 'GETLOG':
-                self.get_audit_log(sock, msg)
-            elif msg.header == 'GENCARD':
-                self.gen_card(sock, msg)
-            elif msg.header == 'DECKKEYRES':
-                self.deck_key_response(sock, msg)
-
-            # log the message
-            if msg.should_log():
-                self.log_message(sock, msg)
+        reader = key.data
+
+        # the socket can take more of what is queued for it
+        if mask & selectors.EVENT_WRITE:
+            self.flush(sock)
+        if not mask & selectors.EVENT_READ:
+            return
+
+        reader.limit = self.frame_limit(sock)
+        try:
+            received = reader.recv(sock)
+        except BlockingIOError: # nothing to read after all
+            return
+        except ConnectionError:
+            received = 0
+
+        # if the connection is alive, handle every message that is complete by now
+        if received:
+            try:
+                for frame in reader.frames():
+                    msg = Proto.parse_msg(frame)
+                    if msg:
+                        self.metrics.message('in', msg.header, Proto.HEADER_SIZE + len(frame))
+                        self.handle_message(sock, msg)
+            except ProtoBadFormat:
+                print(f'[NET] Closing a connection that sent a frame over the limit or malformed.')
+                self.close_connection(sock)
+            # a bad message only costs the connection that sent it, never the other tables
+            except Exception as e:
+                print(f'[NET] Closing a connection whose message could not be handled: {e!r}')
+                self.close_connection(sock)
+        else:
+            self.close_connection(sock)
+
+    def frame_limit(self, sock : socket) -> int:
+        """Biggest frame accepted from the user, only authenticated users may send decks"""
+        return Proto.MAX_FRAME if sock in self.authorized_keys else self.UNAUTHENTICATED_MAX_FRAME
+
+    def close_connection(self, sock : socket):
+        """Clears a lost or dropped connection of the selector mode"""
+        self.dropped.discard(sock)
+        if self.outbound.pop(sock, None) == None: # already closed
+            return
+
+        print(f"[NET] Connection with a user has been lost.")
+        self.metrics.gauge('connections_open', -1)
+        self.leave(sock)
+
+        self.selector.unregister(sock)
+        sock.close()
+
+    def register_handlers(self):
+        """Registers the handler of every message type the playing area answers to"""
+        self.dispatcher = Dispatcher(self.metrics)
+        self.dispatcher.register(Hello, self.hello)
+        self.dispatcher.register(Authenticate, self.authenticate)
+        self.dispatcher.register(Register, self.register)
+        self.dispatcher.register(GetUsers, self.get_user_list)
+        self.dispatcher.register(GetLog, self.get_audit_log)
+        self.dispatcher.register(LogProof, self.prove_log_entry)
+        self.dispatcher.register(GenerateCard, self.gen_card)
+        self.dispatcher.register(DeckKeyResponse, self.deck_key_response)
+        self.dispatcher.register(Stats, self.get_stats)
+
+    def handle_message(self, sock : socket, msg : Message):
+        """Handles a message received from a user, whatever the server mode"""
+        self.dispatcher.dispatch(sock, msg)
+
+        # log the message
+        if msg.should_log():
+            self.log_message(sock, msg)
+
+    def leave(self, sock : socket):
+        """Clears the data associated with a lost socket"""
+        self.codecs.pop(sock, None)
+        self.shuffle_versions.pop(sock, None)
+        self.lobby_log.subscribers.discard(sock)
+        if sock in self.authorized_keys.keys():
+            self.authorized_keys.pop(sock)
+
+        table = self.seats.pop(sock, None)
+        if not table:
+            return
+
+        # if a user disconnected midgame, abort it
+        table.log.subscribers.discard(sock)
+        if table.state in (Table.STARTING, Table.PLAYING):
+            table.remove(sock)
+            self.abort_table(table, 'player_left')
+
+        # if not, no biggie
         else:
-            print(f"[NET] Connection with a user has been lost.")
-
-            # if a user disconnected midgame, abort it
-            if self.playing:
-                print('[GAME] Aborting game since we lost a player.')
-                print('[GAME] Notifying players that the game has been aborted...')
-                for sock in self.players.keys():
-                    Proto.send_msg(sock, GameOver('player_left'))
-                if self.caller:
-                    Proto.send_msg(self.caller[0], GameOver('player_left'))
-                # stop
-                self.running = False
-
-            # if not, no biggie
-            else:
-                # remove data associated with the socket
-                if self.caller and self.caller[0] == sock:
-                    self.caller = None
-                if sock in self.authorized_keys.keys():
-                    self.authorized_keys.pop(sock)
-                if sock in self.players.keys():
-                    self.players.pop(sock)
-                    self.party_changed() # trigger party changed event since someone left
-
-            self.selector.unregister(sock)
-            sock.close()
+            if table.remove(sock) and table.state == Table.WAITING:
+                self.party_changed(table) # trigger party changed event since someone left
+            if table.is_empty():
+                self.close_table(table)
+
+    def open_table(self, card_size : int = None, deck_size : int = None, party_max : int = None, shuffle_version : int = None) -> Table:
+        """Opens a new table, using the playing area's defaults for what is not given"""
+        table = Table(self.next_table_id,
+                      card_size if card_size else self.card_size,
+                      deck_size if deck_size else self.deck_size,
+                      party_max if party_max else self.party_max,
+                      shuffle_version if shuffle_version else Crypto.SHUFFLE_VERSION,
+                      self.open_log(f'table-{self.next_table_id}'))
+        self.next_table_id += 1
+        self.tables[table.id] = table
+
+        print(f'[GAME] Opened {table} (card size {table.card_size}, deck size {table.deck_size}, party of {table.party_max}, shuffle v{table.shuffle_version}).')
+        return table
+
+    def open_log(self, name : str) -> AuditLog:
+        """Opens the audit log of the given name, kept on disk if there is a log directory"""
+        return AuditLog(os.path.join(self.log_dir, name) if self.log_dir else None, self.log_fsync)
+
+    def close_table(self, table : Table):
+        """Removes the table and unseats whoever is still sitting at it"""
+        table.state = Table.OVER
+        self.tables.pop(table.id, None)
+        for sock in table.sockets():
+            self.seats.pop(sock, None)
+
+        # the log is done with, a last checkpoint covers all of it
+        if self.log_signer and table.log.unsigned():
+            self.log_signer.submit(table.log)
+        self.epoch_logs.discard(table.log)
+        table.log.close()
+
+        print(f'[GAME] Closed {table}. {len(self.tables)} table(s) open.')
+
+    def abort_table(self, table : Table, status : str):
+        """Aborts the game of a table and lets the remaining users know"""
+        print(f'[GAME] Aborting the game of {table} since we lost a player.')
+        self.metrics.inc('games_aborted')
+        print(f'[GAME] Notifying players of {table} that the game has been aborted...')
+        self.broadcast(table.sockets(), GameOver(status))
+        self.close_table(table)
+
+    def find_table(self, caller : bool, shuffle_versions : list, table_id : int = None, party_max : int = None) -> Table:
+        """Finds the table a new user should sit at. Opens a new one if every table is taken.
+        A caller asking for a party size only sits at a table that doesn't already have more players than that"""
+        def fits(table : Table) -> bool:
+            if party_max and len(table.players) > party_max:
+                return False
+            return table.accepts(caller) and table.shuffle_version in shuffle_versions
+
+        # the user asked for a specific table
+        if table_id != None:
+            table = self.tables.get(table_id)
+            return table if table and fits(table) else None
+
+        # otherwise, the first table with an empty seat for them
+        for table in self.tables.values():
+            if fits(table):
+                return table
+
+        # a new table, with the latest shuffle both sides support
+        return self.open_table(party_max=party_max, shuffle_version=max(shuffle_versions))
+
+    def log_of(self, sock : socket) -> AuditLog:
+        """The log of the table the user sits at, or the lobby's if they're not seated"""
+        table = self.seats.get(sock)
+        return table.log if table else self.lobby_log
 
     def log_message(self, sock : socket, msg : Message):
+        start = time.perf_counter()
 
-        sequence = None
-        if self.caller and self.caller[0] == sock:
-            sequence = 0
-        elif sock in self.players.keys():
-            sequence = self.players[sock].sequence
+        table = self.seats.get(sock)
+        sequence = table.sequence_of(sock) if table else None
+        log = self.log_of(sock)
 
         timestamp = 'now'
 
-        last_entry = self.log[-1]
-        last_hash = last_entry.hash()
-
         text = str(msg) # the text for now will be the message as a json
 
-        # creates the log entry from the message
-        entry = LogEntry(sequence, timestamp, last_hash, text)
- 
-        entry.sign(self.private_key)
+        # creates the log entry from the message, chained to the one before it
+        entry = LogEntry(sequence, timestamp, log.head, text)
+
+        # in strict mode every entry is signed, otherwise a checkpoint will cover it along with the rest of the epoch
+        if not self.log_signer:
+            entry.sign(self.private_key)
+
+        log.append(entry)
+
+        self.epoch_logs.add(log)
+        if self.log_signer and log.unsigned() >= self.LOG_EPOCH_ENTRIES:
+            self.log_signer.submit(log)
+
+        # pushes the new entry to whoever is following this log
+        if log.subscribers:
+            update = GetLog(None, None, [entry], len(log) - 1, 1, len(log), log.head, True, log.root(), log.consistency_proof(len(log) - 1))
+            self.broadcast(list(log.subscribers), update)
+
+        self.metrics.observe('log_message', time.perf_counter() - start)
+
+    def log_epoch(self):
+        """Ends the epoch: checkpoints the logs with unsigned entries, publishes the checkpoints signed since the last one
+        and syncs the logs to disk"""
+        for log in self.epoch_logs:
+            if self.log_signer and log.unsigned():
+                self.log_signer.submit(log)
+            log.sync()
+        self.epoch_logs.clear()
+
+        if self.log_signer:
+            for log, checkpoint in self.log_signer.collect():
+                self.broadcast(list(log.subscribers), checkpoint)
+
+        if self.running:
+            self.call_later(self.LOG_EPOCH_TIME, self.log_epoch)
+
+    def hello(self, sock : socket, msg : Hello):
+        """Picks the codec for the connection among the ones the user supports"""
+        # the reply still goes out in JSON, everyone understands it
+        msg.codec = Proto.negotiate(msg.codecs)
+        msg.public_key = self.public_key # for checking the log checkpoints
+        self.send(sock, msg)
+        self.codecs[sock] = msg.codec
 
-        self.log.append(entry)
+        # the shuffle version is picked per table, when the user registers
+        if msg.shuffle_versions:
+            self.shuffle_versions[sock] = [version for version in msg.shuffle_versions if version in Crypto.SHUFFLE_VERSIONS]
+
+        print(f'[NET] Negotiated the {msg.codec} codec with a user.')
 
     def authenticate(self, sock : socket, msg : Authenticate):
         """Challenge-response authentication for Portuguese citzens"""
@@ -189,7 +605,7 @@ class PlayingArea:
             print(f'[AUTH] "{msg.public_key}" is already authorized.')
             # let the user know they are authenticated 
             msg.success = True
-            Proto.send_msg(sock, msg)
+            self.send(sock, msg)
             return
 
         # helper function for generating random strings, used for challenges
@@ -215,16 +631,18 @@ class PlayingArea:
 
             if not Crypto.verifyFromCard(modulus, pubexp, msg.challenge, signature): # if signature if forged
                 print(f'[AUTH] "{msg.public_key}" has forged it\'s signature. Request denied.')
+                self.metrics.inc('auth_failures')
                 return
 
             # at this point, the user is authenticated as a Portuguese citzen
             print(f'[AUTH] "{msg.public_key}" has passed the challenge and it\'s authenticated.')
             self.challenges.pop(msg.public_key) 
             self.authorized_keys[sock] = msg.public_key
+            self.metrics.observe('auth_round_trip', time.perf_counter() - self.challenge_times.pop(msg.public_key))
 
             # let the user know they are authenticated 
             msg.success = True
-            Proto.send_msg(sock, msg)
+            self.send(sock, msg)
 
         # if it's starting now...
         else:
@@ -239,10 +657,11 @@ class PlayingArea:
 
             # store in the dict for later steps
             self.challenges[msg.public_key] = challenge
+            self.challenge_times[msg.public_key] = time.perf_counter()
 
             # update message and send it back. wait for response
             msg.challenge = challenge
-            Proto.send_msg(sock, msg)
+            self.send(sock, msg)
 
     def register(self, sock : socket, msg : Register):
         print(f'[REG] Received register request...')
@@ -252,18 +671,10 @@ class PlayingArea:
             print(f'[REG] ...user was not authorized. Request denied.')
             return
 
-        # nickname cannot be already taken
-        if any(player.nickname == msg.nickname for player in self.players.values()):
-            # Send it back with success as False to let them know
-            print(f'[REG] ...nickname already taken. Request denied.')
-            Proto.send_msg(sock, msg)
-            return
-
-        # key cannot be already taken
-        if any(player.public_key == msg.playing_key for player in self.players.values()):
-            # Send it back with success as False to let them know
-            print(f'[REG] ...public key already taken. Request denied.')
-            Proto.send_msg(sock, msg)
+        # users can only sit at one table
+        if sock in self.seats.keys():
+            print(f'[REG] ...user is already sitting at {self.seats[sock]}. Request denied.')
+            self.send(sock, msg)
             return
 
         # signature must be valid
@@ -271,131 +682,241 @@ class PlayingArea:
             print(f'[REG] ...signature forged. Request denied.')
             return
 
-        # is the user a caller...
-        if msg.auth_key in self.VALID_CALLERS:
-            # there can only be one caller
-            if self.caller:
-                print(f'[REG] ...users wants to be a caller but there\'s already one. Request denied.')
-                Proto.send_msg(sock, msg)
-                return
+        # is the user a caller or a player
+        is_caller = msg.auth_key in self.valid_callers
+
+        # users that did not say otherwise only know the original shuffle
+        shuffle_versions = self.shuffle_versions.get(sock) or [1]
+
+        # only the caller picks the size of the party, and it must be a party
+        party_max = msg.party_max if is_caller else None
+        if party_max != None and party_max <= 0:
+            print(f'[REG] ...party size of {party_max} asked for. Request denied.')
+            self.send(sock, msg)
+            return
 
-            print(f'[REG] ...Caller "{msg.nickname}" with public key "{msg.playing_key}" registered.')  
+        # find them a seat
+        table = self.find_table(is_caller, shuffle_versions, msg.table, party_max)
+        if not table:
+            print(f'[REG] ...table {msg.table} does not exist, has already begun, has no seat left or uses another shuffle. Request denied.')
+            self.send(sock, msg)
+            return
+
+        # nickname cannot be already taken
+        if any(user.nickname == msg.nickname for user in table.users()):
+            # Send it back with success as False to let them know
+            print(f'[REG] ...nickname already taken at {table}. Request denied.')
+            self.send(sock, msg)
+            return
+
+        # key cannot be already taken
+        if any(user.public_key == msg.playing_key for user in table.users()):
+            # Send it back with success as False to let them know
+            print(f'[REG] ...public key already taken at {table}. Request denied.')
+            self.send(sock, msg)
+            return
+
+        # the caller...
+        if is_caller:
+            print(f'[REG] ...Caller "{msg.nickname}" with public key "{msg.playing_key}" registered at {table}.')
             caller_data = UserData(0, msg.nickname, msg.playing_key)
-            self.caller = (sock, caller_data)
+            table.caller = (sock, caller_data)
             sequence = 0
+
+            # the party is the size the caller asked for, the players already seated are told with the party update
+            if party_max:
+                table.party_max = party_max
         # ... or a player
         else:
-            print(f'[REG] ...Player "{msg.nickname}" with public key "{msg.playing_key}" registered.')
-            player_data = UserData(len(self.players) + 1, msg.nickname, msg.playing_key)
-            self.players[sock] = player_data # player data is associated with socket so that when a player disconnects, we clear the player data
-            sequence = len(self.players)
+            print(f'[REG] ...Player "{msg.nickname}" with public key "{msg.playing_key}" registered at {table}.')
+            player_data = UserData(len(table.players) + 1, msg.nickname, msg.playing_key)
+            table.players[sock] = player_data # player data is associated with socket so that when a player disconnects, we clear the player data
+            sequence = len(table.players)
+
+        self.seats[sock] = table
+        self.lobby_log.subscribers.discard(sock) # the user now writes to the table's log, they can follow it instead
 
         # inform that registration was successful
         msg.success = True
-        Proto.send_msg(sock, msg)
+        msg.table = table.id
+        self.send(sock, msg)
 
         # let them know info about the game
-        Proto.send_msg(sock, GameInfo(sequence, self.card_size, self.deck_size))
+        self.send(sock, GameInfo(table.id, sequence, table.card_size, table.deck_size, table.shuffle_version))
 
         # trigger party changed event since someone joined
-        self.party_changed()
+        self.party_changed(table)
 
     def get_audit_log(self, sock : socket, msg : GetLog):
-        """Returns to the user the list of logged messages"""
+        """Returns to the user a page of logged messages, from the position they ask for onwards"""
+
+        log = self.log_of(sock)
+
+        # users only ask for what they don't have yet, so pages are usually small
+        start = min(max(msg.start or 0, 0), len(log))
+        limit = min(msg.limit, self.LOG_PAGE_MAX) if msg.limit and msg.limit > 0 else self.LOG_PAGE_SIZE
+
+        print(f'[SEC] Received request to audit the message log from entry {start}. Sending {min(limit, len(log) - start)} entries...')
+
+        msg.response = log[start:start + limit]
+        msg.start = start
+        msg.limit = limit
+        msg.size = len(log)
+        msg.head = log.head
+        msg.root = log.root()
+        msg.proof = log.consistency_proof(start) # lets the user check what they already have wasn't rewritten
+        msg.checkpoint = log.checkpoint
+        self.send(sock, msg)
+
+        # from now on, new entries are pushed as they are appended
+        if msg.subscribe:
+            log.subscribers.add(sock)
 
-        print('[SEC] Received request to audit the message log. Sending the list...')
+    def prove_log_entry(self, sock : socket, msg : LogProof):
+        """Returns to the user a logged message along with the proof that it is in the log"""
 
-        msg.response = self.log
-        Proto.send_msg(sock, msg)
+        log = self.log_of(sock)
+        if not 0 <= msg.index < len(log):
+            print(f'[SEC] Received request to prove entry {msg.index} of the message log, which does not exist. Request denied.')
+            return
+
+        print(f'[SEC] Received request to prove entry {msg.index} of the message log. Sending the proof...')
+
+        msg.entry = log[msg.index]
+        msg.size = len(log)
+        msg.root = log.root()
+        msg.proof = log.inclusion_proof(msg.index)
+        self.send(sock, msg)
 
     def get_user_list(self, sock : socket, msg : GetUsers):
         """Returns to the user the list of connected users"""
 
         print('[SEC] Received request to see registed users. Sending the list...')
 
-        # add the players
-        res = list(self.players.values())
+        # only the users sitting at the same table
+        table = self.seats.get(sock)
+        msg.response = table.users() if table else []
 
-        # add the caller if exists
-        if self.caller:
-            res.append(self.caller[1])
+        self.send(sock, msg)
 
-        msg.response = res
+    def get_stats(self, sock : socket, msg : Stats):
+        """Returns to the user the metrics of the playing area"""
 
-        Proto.send_msg(sock, msg)
+        # only users that proved who they are can watch the server
+        if sock not in self.authorized_keys.keys():
+            print('[STATS] Received request for the metrics from an unauthenticated user. Request denied.')
+            return
 
-    def party_changed(self):
-        player_count = len(self.players)
-        print(f'[GAME] Party status: {player_count}/{self.PARTY_MAX} ({"(Caller present)" if self.caller else "Caller absent"})')
+        print('[STATS] Received request for the metrics. Sending them...')
+        msg.response = self.metrics.snapshot()
+        self.send(sock, msg)
+
+    def party_changed(self, table : Table):
+        player_count = len(table.players)
+        print(f'[GAME] Party status of {table}: {player_count}/{table.party_max} ({"(Caller present)" if table.caller else "Caller absent"})')
 
         # notifies players
         if player_count > 0:
-            print('[GAME] Notifying players on party status...')
-            for sock in self.players.keys():
-                Proto.send_msg(sock, PartyUpdate(player_count, self.PARTY_MAX, self.caller != None))
-
-            if self.caller:
-                Proto.send_msg(self.caller[0], PartyUpdate(player_count, self.PARTY_MAX, True))
+            print(f'[GAME] Notifying players of {table} on party status...')
+            self.broadcast(table.sockets(), PartyUpdate(table.id, player_count, table.party_max, table.caller != None))
 
         # start game if party is full and there's a caller
-        if player_count == self.PARTY_MAX and self.caller:
-            self.start_game()
+        if table.is_ready():
+            self.start_game(table)
+
+    def start_game(self, table : Table):
+        print(f'[GAME] Game of {table} starting in {self.game_countdown} second(s)...')
+        table.state = Table.STARTING
+        print(f'[SEC] Sending everyone at {table} the list of all the participants.')
+        self.broadcast(table.sockets(), GetUsers("", "", table.users()))
 
-    def start_game(self):
-        print(f'[GAME] Game starting in {self.GAME_COUNTDOWN} second(s)...')
-        print('[SEC] Sending everyone the list of all the participants.')
-        self.get_user_list(self.caller[0], GetUsers("",""))
-        for sock in self.players.keys():
-            self.get_user_list(sock, GetUsers("",""))
+        # counts down without blocking the other tables
+        self.call_later(self.game_countdown, self.begin_game, table)
 
-        time.sleep(self.GAME_COUNTDOWN)
-        print('[GAME] Game started.')
-        self.playing = True
+    def begin_game(self, table : Table):
+        # the game might have been aborted during the countdown
+        if table.state != Table.STARTING:
+            return
+
+        print(f'[GAME] Game of {table} started.')
+        table.state = Table.PLAYING
+        self.metrics.inc('games_started')
 
         # deck generation
         print('[GAME] Initiating deck generation.')
         print('[GAME] Asking Caller to generate the deck...')
-        Proto.send_msg(self.caller[0], GenerateDeck())
+        self.send(table.caller[0], GenerateDeck())
+        table.hop_sent = time.perf_counter()
 
     def gen_card(self, sock : socket, msg : GenerateCard):
-        def find_user_by_sequence(sequence : id):
-            for socket, player in self.players.items():
-                if player.sequence == sequence:
-                    return socket, player
-            return None, None
+        table = self.seats.get(sock)
+        if not table or not table.playing:
+            return
+
+        # time since the deck was handed to this user
+        if table.hop_sent:
+            self.metrics.observe('ring_hop', time.perf_counter() - table.hop_sent)
+            table.hop_sent = None
 
         # if the card generation has made all the way back to the caller...
         if msg.done:
-            # ... distribute it to every player
-            for _sock in self.players.keys():
-                Proto.send_msg(_sock, msg)
+            # ... distribute it to every player, the deck is encoded only once
+            self.broadcast(list(table.players.keys()), msg)
 
             # and ask for the deck key
-            Proto.send_msg(self.caller[0], DeckKeyRequest(0))
-            for seq in range(1,len(self.players)+1):
-                _sock, _ = find_user_by_sequence(seq)
-                Proto.send_msg(_sock, DeckKeyRequest(seq))
+            self.send(table.caller[0], DeckKeyRequest(0))
+            for seq in range(1,len(table.players)+1):
+                _sock, _ = table.find_user_by_sequence(seq)
+                self.send(_sock, DeckKeyRequest(seq))
             return
 
-        next_socket, next_player = find_user_by_sequence(msg.sequence)
+        next_socket, next_player = table.find_user_by_sequence(msg.sequence)
 
         # If there's no next player, send it back to the caller
         if not next_socket:
-            next_socket, next_player = self.caller
+            next_socket, next_player = table.caller
 
-        print(f'[NET] Forwarding deck to {next_player.nickname}... ({msg.sequence}/{len(self.players) + 1})')
-        Proto.send_msg(next_socket, msg)
+        print(f'[NET] Forwarding deck at {table} to {next_player.nickname}... ({msg.sequence}/{len(table.players) + 1})')
+        self.send(next_socket, msg)
+        table.hop_sent = time.perf_counter()
 
     def deck_key_response(self, sock : socket, msg : DeckKeyResponse):
         """Verifies and distribute deck keys to all users"""
+        table = self.seats.get(sock)
+        if not table or not table.playing:
+            return
+
+        print(f'[NET] Forwarding deck key around {table}...')
+        start = time.perf_counter()
+        self.broadcast([_sock for _sock in table.sockets() if _sock != sock], msg) # don't need to send it back
+        self.metrics.observe('key_fanout', time.perf_counter() - start)
 
-        print('[NET] Forwarding deck key around...')
-        for _sock in [i for i in self.players.keys()] + [self.caller[0]]:
-            if _sock == sock: # don't need to send it back
-                continue
-            Proto.send_msg(_sock, msg) 
+        # once every key is revealed, the users can finish the game on their own
+        table.revealed_keys.add(table.sequence_of(sock))
+        if len(table.revealed_keys) == len(table.players) + 1:
+            print(f'[GAME] Every deck key of {table} was revealed. The game is over.')
+            table.state = Table.OVER
+            self.metrics.inc('games_finished')
 
     def poweroff(self):
         """Shutdowns the server"""
-        self.sock.close()
+        print('[STATS] Time spent per message type:')
+        print(self.dispatcher.report())
+        if self.stats_file:
+            self.metrics.dump(self.stats_file)
+        if self.profiler:
+            self.profiler.stop()
+
+        # the checkpoints still being signed are kept with their logs
+        if self.log_signer:
+            self.log_signer.close()
+            self.log_signer.collect()
+        for table in self.tables.values():
+            table.log.close()
+        self.lobby_log.close()
+
+        if self.use_asyncio:
+            self.server.close()
+        else:
+            self.sock.close()
         sys.exit()
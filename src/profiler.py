@@ -0,0 +1,113 @@
+import os
+import sys
+import threading # for the sampling thread
+import time
+from src.crypto import Crypto
+
+class Profiler:
+    """Opt-in profiler of the message handlers. While a handler runs, a background thread samples its stack every INTERVAL seconds,
+    and every public Crypto function is timed. On stop, the samples are written as collapsed stacks (one "frame;frame;... count"
+    line per stack, what flamegraph.pl, speedscope and inferno read) and the time per handler and per Crypto function is printed.
+    Nothing is wrapped unless a profiler is started, so there is no cost when profiling is off"""
+
+    ENV = 'BINGO_PROFILE' # environment variable with the file to write the stacks to, for turning profiling on without a flag
+
+    INTERVAL = 0.001 # seconds between samples
+
+    def __init__(self, path : str):
+        self.path = path
+        self.stacks = {} # key is the collapsed stack, value is how many samples hit it
+        self.handlers = {} # key is the header, value is [calls, seconds spent]
+        self.crypto = {} # key is the Crypto function, value is [calls, seconds spent] ; nested calls count for both
+        self.current = None # header of the handler being run
+        self.thread = None # thread running it
+        self.originals = {} # key is the name of a Crypto function, value is the function it was before being wrapped
+        self.running = True
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+
+    @classmethod
+    def start(cls, path : str, dispatcher):
+        """Starts profiling the handlers of the dispatcher, and Crypto"""
+        profiler = Profiler(path)
+        for header, handler in dispatcher.handlers.items():
+            dispatcher.handlers[header] = profiler.wrap_handler(header, handler)
+        profiler.wrap_crypto()
+        profiler.sampler.start()
+        print(f'[PROF] Profiling the handlers. The stacks will be written to "{path}".')
+        return profiler
+
+    def wrap_handler(self, header : str, handler):
+        stats = self.handlers[header] = [0, 0.0]
+
+        def profiled(sock, msg):
+            self.current, self.thread = header, threading.get_ident()
+            start = time.perf_counter()
+            try:
+                handler(sock, msg)
+            finally:
+                stats[0] += 1
+                stats[1] += time.perf_counter() - start
+                self.current = None
+        return profiled
+
+    def wrap_crypto(self) -> None:
+        """Times every public function of Crypto. They're all called through the class, so plain functions stand in for them"""
+        for name, attribute in list(vars(Crypto).items()):
+            if name.startswith('_') or not isinstance(attribute, (classmethod, staticmethod)):
+                continue
+            self.originals[name] = attribute
+            setattr(Crypto, name, self.timed(name, getattr(Crypto, name)))
+
+    def timed(self, name : str, function):
+        stats = self.crypto[name] = [0, 0.0]
+
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stats[0] += 1
+                stats[1] += time.perf_counter() - start
+        return call
+
+    def sample(self) -> None:
+        """Takes a sample of the stack of the running handler, from the handler down"""
+        while self.running:
+            time.sleep(self.INTERVAL)
+            header, thread = self.current, self.thread
+            if not header:
+                continue
+            frame = sys._current_frames().get(thread)
+
+            frames = []
+            while frame and frame.f_code.co_name != 'profiled':
+                if frame.f_code.co_name != 'call' or frame.f_code.co_filename != __file__: # the Crypto wrappers aren't shown
+                    frames.append(f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}')
+                frame = frame.f_back
+            if not frame: # the handler had returned already
+                continue
+
+            stack = ';'.join([header] + frames[::-1])
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def stop(self) -> None:
+        """Stops sampling, puts Crypto back as it was, writes the stacks and prints the report"""
+        self.running = False
+        self.sampler.join()
+        for name, attribute in self.originals.items():
+            setattr(Crypto, name, attribute)
+
+        with open(self.path, 'w') as f:
+            f.writelines(f'{stack} {count}\n' for stack, count in sorted(self.stacks.items()))
+
+        print(f'[PROF] {sum(self.stacks.values())} samples written to "{self.path}".')
+        print(self.report())
+
+    def report(self) -> str:
+        """Calls and time spent per handler and per Crypto function, the most expensive first"""
+        lines = []
+        for title, stats in (('handler', self.handlers), ('Crypto function', self.crypto)):
+            lines.append(f'{title:<24} {"calls":>8} {"seconds":>10} {"ms / call":>10}')
+            lines += [f'{name:<24} {calls:>8} {seconds:>10.4f} {seconds / calls * 1000:>10.3f}'
+                      for name, (calls, seconds) in sorted(stats.items(), key=lambda x: -x[1][1]) if calls]
+        return '\n'.join(lines)
@@ -1,12 +1,37 @@
 import json # for serializing
+import time # for timing the handlers
+import struct # for the binary codec
+import binascii # for fast base64 in the binary codec
 import socket # websockets
+from collections import deque # for the outbound queues
+from collections.abc import Sequence # for decks decoded by the binary codec
+import itertools
 from src.crypto import Crypto # cryptography
 import base64
 
 class Message:
     """Generic message"""
+
+    # every message type, by header. filled as the subclasses are declared
+    TYPES = {}
+
+    HEADER = None
+    SCHEMA = ()
+
+    def __init_subclass__(cls, **kwargs):
+        """Registers the message type under its header, once"""
+        super().__init_subclass__(**kwargs)
+        Message.TYPES[cls.HEADER] = cls
+
+    @staticmethod
+    def wire_fields(o):
+        """Attributes of an object that go on the wire. Those starting with an underscore are local state"""
+        if isinstance(o, Records): # a deck decoded by the binary codec goes as the list it reads as
+            return list(o)
+        return {k : v for k, v in o.__dict__.items() if not k.startswith('_')}
+
     def to_json(self):
-        return json.dumps(self, default=lambda o: o.__dict__, sort_keys=False)
+        return json.dumps(self, default=Message.wire_fields, sort_keys=False)
 
     def should_log(self) -> bool:
         return True
@@ -14,10 +39,34 @@ class Message:
     def __str__(self):
         return self.to_json()
 
+class Hello(Message):
+    """First message of a connection. Users list the codecs and shuffle versions they support and the playing area picks a codec"""
+
+    HEADER = 'HELLO'
+    SCHEMA = (('codecs', 'json'), ('codec', 'str'), ('shuffle_versions', 'json'), ('public_key', 'str')) # fields in wire order, for the binary codec
+
+    def __init__(self, codecs : list, codec : str = None, shuffle_versions : list = None, public_key : str = None):
+        self.header = self.HEADER
+        self.codecs = codecs
+        self.codec = codec
+        self.shuffle_versions = shuffle_versions # versions of the deterministic shuffle the user supports
+        self.public_key = public_key # the playing area's, for checking what it signs
+
+    def should_log(self) -> bool:
+        return False
+
+    @classmethod
+    def parse(cls, j : dict):
+        return Hello(j['codecs'], j['codec'], j['shuffle_versions'], j.get('public_key'))
+
 class Authenticate(Message):
     """Message for players authenticating themselves to the playing area. Uses challenge-response authentication"""
+
+    HEADER = 'AUTH'
+    SCHEMA = (('public_key', 'json'), ('challenge', 'str'), ('response', 'b64'), ('success', 'bool')) # fields in wire order, for the binary codec
+
     def __init__(self, public_key : tuple[bytes,bytes], challenge : str = None, response : str = None, success : bool = False):
-        self.header = 'AUTH'
+        self.header = self.HEADER
         self.public_key = public_key
         self.challenge = challenge
         self.response = response
@@ -25,43 +74,61 @@ class Authenticate(Message):
 
     @classmethod
     def parse(cls, j : dict):
-        return Authenticate(j['public_key'], j['challenge'], j['response'], j['success'])
+        # json turns the (modulus, pubexp) tuple into a list, which can't be used as a key
+        return Authenticate(tuple(j['public_key']), j['challenge'], j['response'], j['success'])
 
 class Register(Message): 
      
     """Message for players registering themselves to the playing area"""
-    def __init__(self, nickname : str, playing_key : str, auth_key : str, signature : str, success : bool = False, sequence : int = None):
-        self.header = 'REGISTER'
+
+    HEADER = 'REGISTER'
+    SCHEMA = (('nickname', 'str'), ('playing_key', 'str'), ('auth_key', 'json'), ('signature', 'str'), ('success', 'bool'), ('table', 'int'), ('party_max', 'int')) # fields in wire order, for the binary codec
+
+    def __init__(self, nickname : str, playing_key : str, auth_key : str, signature : str, success : bool = False, sequence : int = None, table : int = None,
+                 party_max : int = None):
+        self.header = self.HEADER
         self.nickname = nickname
         self.playing_key = playing_key
         self.auth_key = auth_key
         self.signature = signature
         self.success = success
+        self.table = table # table to join, None lets the playing area pick one
+        self.party_max = party_max # players the caller wants at their table, None keeps the playing area's default
 
     @classmethod
     def parse(cls, j : dict):
-        return Register(j['nickname'], j['playing_key'], j['auth_key'], j['signature'], j['success'])
+        return Register(j['nickname'], j['playing_key'], tuple(j['auth_key']), j['signature'], j['success'], table=j['table'], party_max=j.get('party_max'))
 
 class GameInfo(Message):
-    """Simple message for letting users know the card and deck size"""
-    def __init__(self, sequence : int, card_size : int, deck_size : int):
-        self.header = 'GAMEINFO'
+    """Simple message for letting users know the card and deck size, and the shuffle version of the table"""
+
+    HEADER = 'GAMEINFO'
+    SCHEMA = (('table', 'int'), ('sequence', 'int'), ('card_size', 'int'), ('deck_size', 'int'), ('shuffle_version', 'int')) # fields in wire order, for the binary codec
+
+    def __init__(self, table : int, sequence : int, card_size : int, deck_size : int, shuffle_version : int = 1):
+        self.header = self.HEADER
+        self.table = table
         self.sequence = sequence
         self.card_size = card_size
         self.deck_size = deck_size
+        self.shuffle_version = shuffle_version # version of the deterministic shuffle used at the table
 
     def should_log(self) -> bool:
         return False
 
     @classmethod
     def parse(cls, j : dict):
-        return GameInfo(j['sequence'], j['card_size'], j['deck_size'])
+        return GameInfo(j['table'], j['sequence'], j['card_size'], j['deck_size'], j['shuffle_version'])
 
 class GetUsers(Message):
  
     """Message for getting a list of registered users"""
+
+    HEADER = 'GETUSERS'
+    SCHEMA = (('public_key', 'json'), ('signature', 'str'), ('response', 'json')) # fields in wire order, for the binary codec
+
     def __init__(self, public_key : str, signature : str, response : list = None):
-        self.header = 'GETUSERS'
+        self.header = self.HEADER
         self.public_key = public_key
         self.signature = signature
         self.response = response
@@ -73,26 +140,118 @@ class GetUsers(Message):
     def parse(cls, j : dict): 
         return GetUsers( j['public_key'], j['signature'], j['response'])
 
+class Stats(Message):
+    """Message for getting the metrics of the playing area: counters, gauges, latency histograms and messages and bytes per header"""
+
+    HEADER = 'STATS'
+    SCHEMA = (('public_key', 'json'), ('signature', 'str'), ('response', 'json')) # fields in wire order, for the binary codec
+
+    def __init__(self, public_key : str, signature : str, response : dict = None):
+        self.header = self.HEADER
+        self.public_key = public_key
+        self.signature = signature
+        self.response = response
+
+    def should_log(self) -> bool:
+        return False
+
+    @classmethod
+    def parse(cls, j : dict):
+        return Stats(j['public_key'], j['signature'], j['response'])
 
 class GetLog(Message):
-    """Message for getting a list of logged messages"""
-    def __init__(self, public_key : str, signature : str, response : list = None):
-        self.header = 'GETLOG'
+    """Message for getting a page of logged messages, starting at a given position of the log.
+    The response carries the entries from start onwards, the size of the log, the hash of its last entry,
+    its Merkle root and a proof that the log of start entries is a prefix of it"""
+
+    HEADER = 'GETLOG'
+    SCHEMA = (('public_key', 'json'), ('signature', 'str'), ('response', 'json'), ('start', 'int'), ('limit', 'int'),
+              ('size', 'int'), ('head', 'str'), ('subscribe', 'bool'), ('root', 'str'), ('proof', 'json'), ('checkpoint', 'json')) # fields in wire order, for the binary codec
+
+    def __init__(self, public_key : str, signature : str, response : list = None, start : int = 0, limit : int = 0,
+                 size : int = 0, head : str = None, subscribe : bool = False, root : str = None, proof : list = None, checkpoint = None):
+        self.header = self.HEADER
         self.public_key = public_key
         self.signature = signature
         self.response = response
+        self.start = start # position of the first entry wanted / sent
+        self.limit = limit # most entries wanted, 0 lets the playing area pick
+        self.size = size # how many entries the log has
+        self.head = head # hash of the last entry of the log
+        self.subscribe = subscribe # whether new entries should be pushed as they are appended
+        self.root = root # hex Merkle root of the log
+        self.proof = proof # consistency proof from the log of start entries to the log of size entries
+        self.checkpoint = checkpoint # latest signed checkpoint of the log
+
+    def should_log(self) -> bool:
+        return False
+
+    @classmethod
+    def parse(cls, j : dict):
+        return GetLog(j['public_key'], j['signature'], j['response'], j.get('start', 0), j.get('limit', 0),
+                      j.get('size', 0), j.get('head'), j.get('subscribe', False), j.get('root'), j.get('proof'), j.get('checkpoint'))
+
+class LogProof(Message):
+    """Message for proving a single logged message is in the log, without downloading the rest of it"""
+
+    HEADER = 'LOGPROOF'
+    SCHEMA = (('public_key', 'json'), ('signature', 'str'), ('index', 'int'), ('entry', 'json'), ('size', 'int'),
+              ('root', 'str'), ('proof', 'json')) # fields in wire order, for the binary codec
+
+    def __init__(self, public_key : str, signature : str, index : int, entry = None, size : int = 0, root : str = None, proof : list = None):
+        self.header = self.HEADER
+        self.public_key = public_key
+        self.signature = signature
+        self.index = index # position of the entry in the log
+        self.entry = entry
+        self.size = size # how many entries the log had when the proof was made
+        self.root = root # hex Merkle root of the log of that size
+        self.proof = proof # inclusion proof of the entry
 
     def should_log(self) -> bool:
         return False
 
     @classmethod
     def parse(cls, j : dict):
-        return GetLog(j['public_key'], j['signature'], j['response'])
+        return LogProof(j['public_key'], j['signature'], j['index'], j['entry'], j['size'], j['root'], j['proof'])
+
+class LogCheckpoint(Message):
+    """Signed Merkle root of the first size entries of a log. One signature vouches for every entry before it"""
+
+    HEADER = 'CHECKPOINT'
+    SCHEMA = (('size', 'int'), ('root', 'str'), ('signature', 'str')) # fields in wire order, for the binary codec
+
+    def __init__(self, size : int, root : str, signature : str = None):
+        self.header = self.HEADER
+        self.size = size
+        self.root = root # hex Merkle root of the log of size entries
+        self.signature = signature
+
+    def sign(self, private_key):
+        sign = Crypto.sign(private_key, str(self.size)+self.root) # Get signature
+        send_format = base64.b64encode(sign).decode('ascii') # Transform to sending forma
+        self.signature = send_format
+
+    def verify(self, public_key) -> bool:
+        signature = base64.b64decode(self.signature.encode('ascii')) # Transform back to bytes
+        return Crypto.verify(public_key, str(self.size)+self.root, signature) # Return true if matches false if it doesnt
+
+    def should_log(self) -> bool:
+        return False
+
+    @classmethod
+    def parse(cls, j : dict):
+        return LogCheckpoint(j['size'], j['root'], j['signature'])
 
 class PartyUpdate(Message):
     """Message for updating registered users on how big the party is"""
-    def __init__(self, current : int, maximum : int, caller : bool):
-        self.header = "PARTY"
+
+    HEADER = 'PARTY'
+    SCHEMA = (('table', 'int'), ('current', 'int'), ('maximum', 'int'), ('caller', 'bool')) # fields in wire order, for the binary codec
+
+    def __init__(self, table : int, current : int, maximum : int, caller : bool):
+        self.header = self.HEADER
+        self.table = table
         self.current = current
         self.maximum = maximum
         self.caller = caller
@@ -102,12 +261,16 @@ class PartyUpdate(Message):
 
     @classmethod
     def parse(cls, j : dict):
-        return PartyUpdate(j['current'], j['maximum'], j['caller'])
+        return PartyUpdate(j['table'], j['current'], j['maximum'], j['caller'])
 
 class GenerateDeck(Message):
     """Message telling the caller to generate the deck and initiate the card generation proccess"""
+
+    HEADER = 'GENDECK'
+    SCHEMA = () # fields in wire order, for the binary codec
+
     def __init__(self):
-        self.header = "GENDECK"
+        self.header = self.HEADER
 
     @classmethod
     def parse(cls, j : dict):
@@ -115,21 +278,36 @@ class GenerateDeck(Message):
 
 class GenerateCard(Message):
     """Players will pass this message around until everyone has commited their card"""
-    def __init__(self, sequence : int, deck : list ,signatures : list = [], done : bool = False):
-        self.header = "GENCARD"
+
+    HEADER = 'GENCARD'
+    SCHEMA = (('sequence', 'int'), ('deck', 'records'), ('signatures', 'b64list'), ('done', 'bool')) # fields in wire order, for the binary codec
+
+    def __init__(self, sequence : int, deck : list ,signatures : list = None, done : bool = False):
+        self.header = self.HEADER
         self.sequence = sequence
         self.deck = deck
-        self.signatures = signatures
+        self.signatures = signatures if signatures != None else []
         self.done = done
 
+        # digest of the deck and the deck it was computed for
+        self._digest = None
+        self._digest_deck = None
+
+    def digest(self) -> str:
+        """Merkle root of the deck, computed once per deck. Decks are replaced, never changed in place"""
+        if self._digest_deck is not self.deck:
+            self._digest = Crypto.deck_digest(self.deck)
+            self._digest_deck = self.deck
+        return self._digest
+
     def sign(self, private_key : str) -> None: 
-        sign = Crypto.sign(private_key, str(self.deck)) # Get signature
+        sign = Crypto.sign(private_key, self.digest()) # Get signature over the deck's digest
         send_format = base64.b64encode(sign).decode('ascii') # Transform to sending format
         self.signatures.append(send_format) # append to signatures list
         
     def verify(self, public_key, signature: str) -> bool:
         signature = base64.b64decode(signature.encode('ascii')) # Transform back to bytes
-        return Crypto.verify(public_key, str(self.deck), signature) # Return true if matches false if it doesnt 
+        return Crypto.verify(public_key, self.digest(), signature) # Return true if matches false if it doesnt 
 
     @classmethod
     def parse(cls, j : dict):
@@ -137,8 +315,12 @@ class GenerateCard(Message):
 
 class DeckKeyRequest(Message):
     """Message requesting that players and caller reveal their symmetric key after the deck is commited"""
+
+    HEADER = 'DECKKEYREQ'
+    SCHEMA = (('sequence', 'int'),) # fields in wire order, for the binary codec
+
     def __init__(self, sequence : int):
-        self.header = "DECKKEYREQ"
+        self.header = self.HEADER
         self.sequence = sequence
 
     @classmethod
@@ -147,8 +329,12 @@ class DeckKeyRequest(Message):
 
 class DeckKeyResponse(Message):
     """Response to the deck key request"""
+
+    HEADER = 'DECKKEYRES'
+    SCHEMA = (('sequence', 'int'), ('response', 'str'), ('signature', 'b64')) # fields in wire order, for the binary codec
+
     def __init__(self, sequence : int, response : str, signature : str = None):
-        self.header = "DECKKEYRES"
+        self.header = self.HEADER
         self.sequence = sequence
         self.response = response
         self.signature = signature
@@ -168,8 +354,12 @@ class DeckKeyResponse(Message):
 
 class GameOver(Message):
     """Message for when the game is over / aborted """
+
+    HEADER = 'GAMEOVER'
+    SCHEMA = (('status', 'str'), ('detail', 'json')) # fields in wire order, for the binary codec
+
     def __init__(self, status : str, detail : any = None):
-        self.header = "GAMEOVER"
+        self.header = self.HEADER
         self.status = status
         self.detail = detail
 
@@ -188,70 +378,466 @@ class GameOver(Message):
         else:
             return 'Error :('
 
+class JsonCodec:
+    """Encodes messages as JSON text"""
+
+    NAME = 'json'
+
+    @classmethod
+    def encode(cls, msg : Message) -> list:
+        """Returns the buffers making up the body of the frame"""
+        return [str.encode(msg.to_json())]
+
+    @classmethod
+    def decode(cls, frame) -> dict:
+        """Returns the fields of the message as a dict"""
+        return json.loads(str(frame, 'UTF-8'))
+
+class Records(Sequence):
+    """Deck decoded by the binary codec. The ciphertext records stay in one contiguous block, and read as a list of base64
+    strings, each one converted only when it is read. The block itself is used where the raw records are needed"""
+
+    def __init__(self, block : bytes, size : int):
+        self.block = block
+        self.size = size # of every record
+
+    def __len__(self) -> int:
+        return len(self.block) // self.size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1: # still a single block
+                return Records(self.block[start * self.size:max(start, stop) * self.size], self.size)
+            return [self[i] for i in range(start, stop, step)]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('record index out of range')
+        return binascii.b2a_base64(self.block[index * self.size:(index + 1) * self.size], newline=False).decode('ascii')
+
+    def __iter__(self):
+        size = self.size
+        block = self.block
+        for i in range(0, len(block), size):
+            yield binascii.b2a_base64(block[i:i + size], newline=False).decode('ascii')
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, (list, Records)):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def raw(self):
+        """The records as bytes, without going through base64"""
+        size = self.size
+        block = self.block
+        return (block[i:i + size] for i in range(0, len(block), size))
+
+class BinaryCodec:
+    """Encodes messages with a fixed schema per header. Byte fields travel raw and length-prefixed"""
+
+    NAME = 'binary'
+
+    # first byte of every binary frame. JSON frames always start with '{'
+    TAG = 0
+
+    # u32 length used for None values
+    NONE = 0xFFFFFFFF
+
+    @classmethod
+    def encode(cls, msg : Message) -> list:
+        """Returns the buffers making up the body of the frame. Decks are sent as a single block of ciphertexts"""
+        header = msg.header.encode('ascii')
+        out = bytearray([cls.TAG, len(header)]) + header
+        buffers = [out]
+
+        for name, kind in msg.SCHEMA:
+            value = getattr(msg, name)
+
+            if kind == 'int':
+                out += struct.pack('>?q', value != None, value if value != None else 0)
+            elif kind == 'bool':
+                out += struct.pack('>?', bool(value))
+            elif kind == 'str':
+                cls.pack_bytes(out, value.encode('UTF-8') if value != None else None)
+            elif kind == 'b64':
+                cls.pack_bytes(out, binascii.a2b_base64(value) if value != None else None)
+            elif kind == 'json':
+                cls.pack_bytes(out, json.dumps(value, default=Message.wire_fields).encode('UTF-8'))
+            elif kind == 'b64list':
+                out += struct.pack('>I', len(value))
+                for item in value:
+                    cls.pack_bytes(out, binascii.a2b_base64(item))
+            elif kind == 'records':
+                encoded_size = len(value[0]) if value else 0
+
+                # a deck that was decoded by this codec is forwarded as the block it came in
+                if isinstance(value, Records):
+                    out += struct.pack('>II', len(value), value.size)
+                    out = bytearray()
+                    buffers += [value.block, out]
+                # fixed size records go as one contiguous block...
+                elif all(len(item) == encoded_size for item in value):
+                    block = binascii.a2b_base64(''.join(value)) if value and not value[0].endswith('=') else b''
+                    if len(block) != len(value) * (encoded_size // 4 * 3): # records with padding can't be decoded in one go
+                        block = b''.join(map(binascii.a2b_base64, value))
+                    out += struct.pack('>II', len(value), len(block) // len(value) if value else 0)
+                    out = bytearray()
+                    buffers += [block, out]
+                # ... anything else item by item
+                else:
+                    out += struct.pack('>II', len(value), cls.NONE)
+                    for item in value:
+                        cls.pack_bytes(out, binascii.a2b_base64(item))
+
+        return buffers
+
+    @classmethod
+    def pack_bytes(cls, out : bytearray, value : bytes) -> None:
+        """Appends a length-prefixed byte field"""
+        if value == None:
+            out += struct.pack('>I', cls.NONE)
+        else:
+            out += struct.pack('>I', len(value))
+            out += value
+
+    @classmethod
+    def unpack_bytes(cls, frame : memoryview, offset : int):
+        """Reads a length-prefixed byte field. Returns the field and the offset after it"""
+        (size,) = struct.unpack_from('>I', frame, offset)
+        offset += 4
+        if size == cls.NONE:
+            return None, offset
+        if offset + size > len(frame):
+            raise ProtoBadFormat(b'field past the end of the frame')
+        return frame[offset:offset + size], offset + size
+
+    @classmethod
+    def decode(cls, frame) -> dict:
+        """Returns the fields of the message as a dict. Raises ProtoBadFormat if the frame is malformed"""
+        try:
+            return cls.decode_fields(memoryview(frame))
+        except (struct.error, UnicodeDecodeError, IndexError, ValueError) as e:
+            raise ProtoBadFormat(repr(e).encode())
+
+    @classmethod
+    def decode_fields(cls, frame : memoryview) -> dict:
+        header_size = frame[1]
+        header = str(frame[2:2 + header_size], 'ascii')
+        offset = 2 + header_size
+
+        if header not in Message.TYPES:
+            raise ProtoBadFormat(bytes(frame))
+
+        j = {'header' : header}
+        for name, kind in Message.TYPES[header].SCHEMA:
+            if kind == 'int':
+                present, value = struct.unpack_from('>?q', frame, offset)
+                offset += 9
+                j[name] = value if present else None
+            elif kind == 'bool':
+                (j[name],) = struct.unpack_from('>?', frame, offset)
+                offset += 1
+            elif kind in ('str', 'b64', 'json'):
+                value, offset = cls.unpack_bytes(frame, offset)
+                if value == None:
+                    j[name] = None
+                elif kind == 'str':
+                    j[name] = str(value, 'UTF-8')
+                elif kind == 'b64':
+                    j[name] = binascii.b2a_base64(value, newline=False).decode('ascii')
+                else:
+                    j[name] = json.loads(str(value, 'UTF-8'))
+            elif kind == 'b64list':
+                (count,) = struct.unpack_from('>I', frame, offset)
+                offset += 4
+                j[name] = []
+                for _ in range(count):
+                    value, offset = cls.unpack_bytes(frame, offset)
+                    j[name].append(binascii.b2a_base64(value, newline=False).decode('ascii'))
+            elif kind == 'records':
+                count, size = struct.unpack_from('>II', frame, offset)
+                offset += 8
+                if count == 0: # an empty list has no record size
+                    j[name] = []
+                elif size == cls.NONE:
+                    j[name] = []
+                    for _ in range(count):
+                        value, offset = cls.unpack_bytes(frame, offset)
+                        j[name].append(binascii.b2a_base64(value, newline=False).decode('ascii'))
+                else:
+                    # kept as one block, the records are only converted to base64 if they are read
+                    if size == 0 or offset + count * size > len(frame):
+                        raise ProtoBadFormat(b'records past the end of the frame')
+                    j[name] = Records(frame[offset:offset + count * size].tobytes(), size)
+                    offset += count * size
+
+        return j
+
+class FrameReader:
+    """Incremental per-connection reader. Reassembles frames across partial reads into a reusable buffer"""
+
+    # starting size of the buffer, it grows to fit the biggest frame
+    INITIAL_SIZE = 64 * 1024
+
+    # most room made for a single read. the buffer grows with what has arrived, never with what a header announces
+    READ_CHUNK = 1024 * 1024
+
+    def __init__(self, size : int = INITIAL_SIZE, limit : int = None):
+        self.buffer = bytearray(size)
+        self.start = 0 # first byte not yet handed out as a frame
+        self.end = 0 # first free byte
+        self.limit = limit # biggest frame accepted from the connection, Proto.MAX_FRAME if None
+
+    def pending(self) -> int:
+        """Number of bytes received but not yet handed out"""
+        return self.end - self.start
+
+    def missing(self) -> int:
+        """Number of bytes still missing to complete the frame being received"""
+        if self.pending() < Proto.HEADER_SIZE:
+            return Proto.HEADER_SIZE - self.pending()
+        size = Proto.frame_size(self.buffer[self.start:self.start + Proto.HEADER_SIZE], self.limit)
+        return max(1, Proto.HEADER_SIZE + size - self.pending())
+
+    def writable(self, min_free : int = 1) -> memoryview:
+        """Free space at the end of the buffer, compacting or growing it when needed"""
+        if len(self.buffer) - self.end < min_free:
+            pending = self.pending()
+            needed = pending + min_free
+
+            if needed <= len(self.buffer):
+                # enough room if the consumed bytes are dropped. same length assignment, no reallocation
+                self.buffer[0:pending] = self.buffer[self.start:self.end]
+            else:
+                # a new buffer, so that frames handed out earlier stay valid
+                buffer = bytearray(max(2 * len(self.buffer), needed))
+                buffer[0:pending] = self.buffer[self.start:self.end]
+                self.buffer = buffer
+
+            self.start, self.end = 0, pending
+
+        return memoryview(self.buffer)[self.end:]
+
+    def commit(self, n : int) -> None:
+        """Marks n bytes written into the writable view as received"""
+        self.end += n
+
+    def recv(self, connection: socket) -> int:
+        """Reads whatever is available from the connection. Returns 0 when the connection is closed"""
+        # makes room for the rest of the frame being received so big decks don't need many reads, a chunk at a time
+        n = connection.recv_into(self.writable(min(self.missing(), self.READ_CHUNK)))
+        self.commit(n)
+        return n
+
+    def frames(self):
+        """Yields every complete frame as a view into the buffer, valid until the next read"""
+        view = memoryview(self.buffer)
+        while self.pending() >= Proto.HEADER_SIZE:
+            msg_size = Proto.frame_size(view[self.start:self.start + Proto.HEADER_SIZE], self.limit)
+
+            # frame is not complete yet
+            if self.pending() < Proto.HEADER_SIZE + msg_size:
+                break
+
+            frame_start = self.start + Proto.HEADER_SIZE
+            self.start = frame_start + msg_size
+            yield view[frame_start:self.start]
+
+        # everything was consumed, start over at the beginning of the buffer
+        if self.pending() == 0:
+            self.start = self.end = 0
+
+            # don't hold on to the memory of a huge frame forever
+            if len(self.buffer) > self.INITIAL_SIZE * 16:
+                self.buffer = bytearray(self.INITIAL_SIZE)
+
+class FrameWriter:
+    """Per-connection outbound queue, for non-blocking sockets. Frames are queued as the read-only views a broadcast shares
+    between every recipient, and written whenever the connection can take more, without ever blocking on it"""
+
+    # most buffers handed to a single sendmsg, under the IOV_MAX of every platform
+    MAX_VIEWS = 512
+
+    def __init__(self):
+        self.views = deque() # views of the frames not written yet, in order
+        self.size = 0 # bytes queued
+
+    def queue(self, frame : tuple) -> None:
+        for view in frame:
+            if len(view): # an empty one would never be written
+                self.views.append(view)
+                self.size += len(view)
+
+    def flush(self, connection : socket) -> bool:
+        """Writes as much as the connection takes right now. Returns whether the queue is empty"""
+        while self.views:
+            try:
+                sent = connection.sendmsg(itertools.islice(self.views, self.MAX_VIEWS))
+            except BlockingIOError:
+                return False
+            self.size -= sent
+
+            # drops whatever was already sent
+            while sent and sent >= len(self.views[0]):
+                sent -= len(self.views.popleft())
+            if sent:
+                self.views[0] = self.views[0][sent:]
+        return True
+
 class Proto:
 
     HEADER_SIZE = 4
 
+    # biggest frame accepted, a whole deck of a million numbers fits. anything bigger is refused before any memory is reserved for it
+    MAX_FRAME = 256 * 1024 * 1024
+
+    # codecs this side supports, in order of preference
+    CODECS = {BinaryCodec.NAME : BinaryCodec, JsonCodec.NAME : JsonCodec}
+
+    @classmethod
+    def negotiate(cls, codecs : list) -> str:
+        """Picks the first codec the other side prefers that is also supported here"""
+        for codec in codecs:
+            if codec in cls.CODECS:
+                return codec
+        return JsonCodec.NAME
+
+    @classmethod
+    def frame_size(cls, header, limit : int = None) -> int:
+        """Size of the frame announced by a header. Raises ProtoBadFormat if it is over the limit, MAX_FRAME by default"""
+        size = int.from_bytes(header, "big")
+        if size > (limit if limit else cls.MAX_FRAME):
+            raise ProtoBadFormat(b'frame of %d bytes' % size)
+        return size
+
     @classmethod
-    def send_msg(cls, connection: socket, msg: Message):
+    def encode_msg(cls, msg: Message, codec: str = JsonCodec.NAME) -> list:
+        """Encodes a Message object into the buffers of a frame, header first."""
+        body = cls.CODECS[codec].encode(msg)
+
+        # get the length of the message as a fixed length header header
+        header = sum(len(buffer) for buffer in body).to_bytes(cls.HEADER_SIZE, byteorder = 'big')
+
+        return [header] + body
+
+    @classmethod
+    def encode_frame(cls, msg: Message, codec: str = JsonCodec.NAME) -> tuple:
+        """Encodes a Message object into a frame that can be shared by every recipient: read-only views of its buffers"""
+        return tuple(memoryview(buffer).toreadonly() for buffer in cls.encode_msg(msg, codec))
+
+    @classmethod
+    def send_msg(cls, connection: socket, msg: Message, codec: str = JsonCodec.NAME):
         """Sends through a connection a Message object."""
         try:
-            # encodes the string to byte array
-            encoded_msg = str.encode(msg.to_json())
-
-            # get the length of the message as a fixed length header header
-            header = len(encoded_msg).to_bytes(cls.HEADER_SIZE, byteorder = 'big')
-            
-            # sends the message + the header
-            connection.send(header + encoded_msg)
+            # sends the header + the message in a single write
+            cls.send_buffers(connection, cls.encode_msg(msg, codec))
         except Exception as e:
             print("[PROTO] An error occurred while sending the message")
             raise e
 
+    @classmethod
+    def send_buffers(cls, connection: socket, buffers):
+        """Scatter-gather write of every buffer, without concatenating them first. Handles partial writes"""
+        views = [memoryview(buffer) for buffer in buffers]
+        while views:
+            sent = connection.sendmsg(views)
+
+            # drops whatever was already sent
+            while views and sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            if views:
+                views[0] = views[0][sent:]
+
+    @classmethod
+    def recv_exactly(cls, connection: socket, size: int) -> bytearray:
+        """Receives exactly size bytes, None if the connection closes before that"""
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        received = 0
+        while received < size:
+            n = connection.recv_into(view[received:])
+            if n == 0:
+                return None
+            received += n
+        return buffer
+
     @classmethod
     def recv_msg(cls, connection: socket) -> Message:
         """Receives through a connection a Message object."""
         # get the length of the incoming message
-        header = connection.recv(cls.HEADER_SIZE)
-        msg_size = int.from_bytes(header, "big")
+        header = cls.recv_exactly(connection, cls.HEADER_SIZE)
+        if not header:
+            return None
+        msg_size = cls.frame_size(header)
 
-        msg_encoded = connection.recv(msg_size) 
-        msg_str = msg_encoded.decode('UTF-8')
+        # partial reads are reassembled into a single preallocated buffer
+        msg_encoded = cls.recv_exactly(connection, msg_size)
+        if msg_encoded is None:
+            return None
 
-        return cls.parse_msg(msg_str)
+        return cls.parse_msg(msg_encoded)
 
     @classmethod
-    def parse_msg(self, msg_str: str):
+    def parse_msg(self, msg_str):
+        """Returns a Message instance from a message string, or the bytes / view of a frame"""
         if not msg_str:
             return None
 
-        j = json.loads(msg_str)
-
-        if j['header'] == 'AUTH':
-            return Authenticate.parse(j)
-        elif j['header'] == 'REGISTER':
-            return Register.parse(j)
-        elif j['header'] == 'GAMEINFO':
-            return GameInfo.parse(j)
-        elif j['header'] == 'GETUSERS':
-            return GetUsers.parse(j)
-        elif j['header'] == 'GETLOG':
-            return GetLog.parse(j)
-        elif j['header'] == 'PARTY':
-            return PartyUpdate.parse(j)
-        elif j['header'] == 'GENDECK':
-            return GenerateDeck.parse(j)
-        elif j['header'] == 'GENCARD':
-            return GenerateCard.parse(j)
-        elif j['header'] == 'DECKKEYREQ':
-            return DeckKeyRequest.parse(j)
-        elif j['header'] == 'DECKKEYRES':
-            return DeckKeyResponse.parse(j)
-        elif j['header'] == 'GAMEOVER':
-            return GameOver.parse(j)
+        # frames are decoded straight from the buffer, without copying them to bytes first
+        if isinstance(msg_str, str):
+            j = json.loads(msg_str)
+        elif msg_str[0] == BinaryCodec.TAG:
+            j = BinaryCodec.decode(msg_str)
         else:
+            j = JsonCodec.decode(msg_str)
+
+        # a single lookup in the registry of message types
+        message_type = Message.TYPES.get(j.get('header'))
+        if not message_type:
             raise ProtoBadFormat(msg_str)
 
+        return message_type.parse(j)
+
+class Dispatcher:
+    """Routes messages to the handler registered for their header with a single lookup. Counts calls and time spent per header,
+    and records the time of every call in the metrics, if given"""
+
+    def __init__(self, metrics = None):
+        self.handlers = {} # key is the header, value is the handler
+        self.stats = {} # key is the header, value is [calls, seconds spent]
+        self.metrics = metrics
+
+    def register(self, message_type, handler) -> None:
+        """Registers the handler of a message type. Handlers take the socket and the message"""
+        self.handlers[message_type.HEADER] = handler
+        self.stats[message_type.HEADER] = [0, 0.0]
+
+    def dispatch(self, sock : socket, msg : Message) -> bool:
+        """Calls the handler of the message. Returns False if there is none"""
+        handler = self.handlers.get(msg.header)
+        if not handler:
+            return False
+
+        start = time.perf_counter()
+        try:
+            handler(sock, msg)
+        finally:
+            elapsed = time.perf_counter() - start
+            stats = self.stats[msg.header]
+            stats[0] += 1
+            stats[1] += elapsed
+            if self.metrics:
+                self.metrics.observe('handler.' + msg.header, elapsed)
+        return True
+
+    def report(self) -> str:
+        """Calls and time spent per header, the most expensive first"""
+        lines = [f'{header:<12} {calls:>8} calls {seconds:>10.4f}s' for header, (calls, seconds) in sorted(self.stats.items(), key=lambda x: -x[1][1]) if calls]
+        return '\n'.join(lines)
+
 class ProtoBadFormat(Exception):
     """Exception when source message is not Proto."""
 
@@ -1,18 +1,98 @@
-import PyKCS11
+# PyKCS11 is only needed for real smartcards, the software token works without it
+try:
+    import PyKCS11
+except ImportError:
+    PyKCS11 = None
+
+from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives import hashes, serialization
+import os
+import time # for simulating the latency of a card
 
 # PyKCS11 does not include a PKCS11 library. We'll use opensc
 #lib = '/usr/lib/x86_64-linux-gnu/pkcs11/opensc-pkcs11.so' # Mint location using apt install opensc-pkcs11
 lib = '/usr/lib64/pkcs11/opensc-pkcs11.so' # Fedora location using dnf install opensc
 
+# PKCS#11 constants, the same numbers PyKCS11 uses. Both backends understand them
+CKA_CLASS = 0x0000
+CKO_PUBLIC_KEY = 0x0002
+CKO_PRIVATE_KEY = 0x0003
+CKA_MODULUS = 0x0120
+CKA_PUBLIC_EXPONENT = 0x0122
+CKM_SHA256_RSA_PKCS = 0x0040
+
+class SoftwareToken():
+    """Stand-in for the PKCS#11 session of a smartcard, for running without a card reader. The key is an RSA key in a file,
+    encrypted with the PIN and made on first use, and signatures are PKCS#1 v1.5 with SHA256 like the Citizen Card's.
+    Only the few session calls SmartCardSession makes are supported"""
+
+    KEY_SIZE = 2048
+
+    def __init__(self, key_file : str, latency : float = 0):
+        self.key_file = key_file
+        self.latency = latency # seconds every operation on the card takes, as a real one would
+        self.key = None # the private key, once logged in
+
+    def login(self, pin : str) -> bool:
+        """Unlocks the key with the PIN. Returns whether the PIN was right"""
+        time.sleep(self.latency)
+        if not os.path.exists(self.key_file):
+            key = rsa.generate_private_key(public_exponent=65537, key_size=self.KEY_SIZE)
+            fd = os.open(self.key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            os.write(fd, key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                           serialization.BestAvailableEncryption(pin.encode())))
+            os.close(fd)
+
+        with open(self.key_file, 'rb') as f:
+            try:
+                self.key = serialization.load_pem_private_key(f.read(), password=pin.encode())
+            except ValueError:
+                return False
+        return True
+
+    def findObjects(self, template : list) -> list:
+        """The key has a single handle per class, which is the class itself"""
+        return [dict(template)[CKA_CLASS]]
+
+    def getAttributeValue(self, handle : int, attributes : list) -> list:
+        numbers = self.key.public_key().public_numbers()
+        values = {CKA_MODULUS : numbers.n, CKA_PUBLIC_EXPONENT : numbers.e}
+        return [list(values[attribute].to_bytes((values[attribute].bit_length() + 7) // 8, 'big')) for attribute in attributes]
+
+    def sign(self, handle : int, message, mechanism) -> bytes:
+        time.sleep(self.latency)
+        message = message.encode() if isinstance(message, str) else bytes(message)
+        return self.key.sign(message, padding.PKCS1v15(), hashes.SHA256())
+
+    def logout(self) -> None:
+        self.key = None
+
+    def closeSession(self) -> None:
+        pass
+
 class SmartCardSession():
     """Smart Card Session Utilities"""
 
     # static method for creating session object
     @classmethod
-    def create(cls, pin : str) -> None:
-        """Generates a PyKCS11 session, required Citizen Card PIN code"""
+    def create(cls, pin : str, key_file : str = None, latency : float = 0):
+        """Generates a PyKCS11 session, required Citizen Card PIN code.
+        Given a key file, a software token stands in for the smartcard, taking latency seconds per operation"""
 
         session = SmartCardSession()
+
+        if key_file:
+            session.session = SoftwareToken(key_file, latency)
+            if not session.session.login(pin):
+                print("[ERROR] Incorrect PIN for the software token.")
+                return None
+            session.mechanism = CKM_SHA256_RSA_PKCS
+            return session.find_keys()
+
+        if PyKCS11 == None:
+            print("[ERROR] PyKCS11 is not installed. Failed to create session.")
+            return None
+
         session.pkcs11 = PyKCS11.PyKCS11Lib()
         
         # load PKCS11 library
@@ -41,22 +121,28 @@ class SmartCardSession():
                 print("[ERROR] An error occurred while creating a session. This smartcard might be blocked.")
                 return None
 
-        session.pubKey = session.session.findObjects([(PyKCS11.CKA_CLASS, PyKCS11.CKO_PUBLIC_KEY)])[0]
+        session.mechanism = PyKCS11.Mechanism(CKM_SHA256_RSA_PKCS, None)
+        return session.find_keys()
+
+    def find_keys(self):
+        """Looks up the key handles and the public key once, they're the same for the whole session"""
+        self.pubKey = self.session.findObjects([(CKA_CLASS, CKO_PUBLIC_KEY)])[0]
+        self.privKey = self.session.findObjects([(CKA_CLASS, CKO_PRIVATE_KEY)])[0]
 
-    def getPublicKey(self) -> tuple[bytes, bytes]:
-        """Returns the modulus and pubExponent corresponding to the smart card's public key as bytes"""
         modulus, pubexp = self.session.getAttributeValue(
-                self.pubKey, [PyKCS11.CKA_MODULUS, PyKCS11.CKA_PUBLIC_EXPONENT]
+                self.pubKey, [CKA_MODULUS, CKA_PUBLIC_EXPONENT]
         )
+        self.publicKey = (bytes(modulus), bytes(pubexp))
+        return self
 
-        return bytes(modulus),bytes(pubexp)
+    def getPublicKey(self) -> tuple[bytes, bytes]:
+        """Returns the modulus and pubExponent corresponding to the smart card's public key as bytes"""
+        return self.publicKey
 
     def sign(self,message: bytes) -> bytes:
         """Signs a message and returns the signature"""
 
-        signature = self.session.sign(
-                self.session.findObjects([(PyKCS11.CKA_CLASS, PyKCS11.CKO_PRIVATE_KEY)])[0], message, PyKCS11.Mechanism(PyKCS11.CKM_SHA256_RSA_PKCS, None)
-            )
+        signature = self.session.sign(self.privKey, message, self.mechanism)
 
         return signature
 
@@ -0,0 +1,91 @@
+from src.audit_log import AuditLog
+import socket # websockets
+
+class Table:
+    """A single game hosted by the playing area. Every table has its own party, log, sequence numbers and state"""
+
+    # states of the table's state machine
+    WAITING = 'waiting' # party is still being formed
+    STARTING = 'starting' # party is full, counting down to the start
+    PLAYING = 'playing' # the game is running
+    OVER = 'over' # the game has finished or was aborted
+
+    def __init__(self, table_id : int, card_size : int, deck_size : int, party_max : int, shuffle_version : int = 1, log : AuditLog = None):
+        self.id = table_id
+        self.card_size = card_size
+        self.deck_size = deck_size
+        self.party_max = party_max
+        self.shuffle_version = shuffle_version # every user at the table must support it
+
+        self.state = Table.WAITING
+
+        self.caller = None # tuple of socket, userdata ; data is associated with the socket so that when an user disconnects, we clear the data
+        self.players = {} # key is socket, value is userdata ; data is associated with the socket so that when an user disconnects, we clear the data
+        self.revealed_keys = set() # sequences of the users that have already revealed their deck key
+        self.hop_sent = None # when the deck was last handed to a user of the ring, for timing the hops
+
+        # Log for every command given to this table
+        self.log = log if log else AuditLog()
+
+    @property
+    def playing(self) -> bool:
+        return self.state == Table.PLAYING
+
+    def is_full(self) -> bool:
+        return len(self.players) >= self.party_max
+
+    def is_ready(self) -> bool:
+        """The game can start when the party is full and there's a caller"""
+        return self.is_full() and self.caller != None
+
+    def accepts(self, caller : bool) -> bool:
+        """Whether a new caller / player can still join this table"""
+        if self.state != Table.WAITING:
+            return False
+        return self.caller == None if caller else not self.is_full()
+
+    def sockets(self) -> list:
+        """Sockets of every user sitting at the table, players first"""
+        res = list(self.players.keys())
+        if self.caller:
+            res.append(self.caller[0])
+        return res
+
+    def users(self) -> list:
+        """Userdata of every user sitting at the table"""
+        res = list(self.players.values())
+        if self.caller:
+            res.append(self.caller[1])
+        return res
+
+    def sequence_of(self, sock : socket) -> int:
+        """Returns the sequence of the user behind the socket, None if not at the table"""
+        if self.caller and self.caller[0] == sock:
+            return 0
+        if sock in self.players.keys():
+            return self.players[sock].sequence
+        return None
+
+    def find_user_by_sequence(self, sequence : int):
+        """Returns the (socket, userdata) tuple for the given sequence"""
+        if sequence == 0:
+            return self.caller if self.caller else (None, None)
+        for sock, player in self.players.items():
+            if player.sequence == sequence:
+                return sock, player
+        return None, None
+
+    def remove(self, sock : socket) -> bool:
+        """Removes the user behind the socket from the table. Returns whether it was a player"""
+        if self.caller and self.caller[0] == sock:
+            self.caller = None
+        if sock in self.players.keys():
+            self.players.pop(sock)
+            return True
+        return False
+
+    def is_empty(self) -> bool:
+        return self.caller == None and len(self.players) == 0
+
+    def __str__(self):
+        return f'Table {self.id}'
@@ -9,20 +9,33 @@ import os
 
 from src.protocol import *
 from src.smartcard_reader import SmartCardSession
+from src.deck_engine import DeckEngine
+from src.bingo import Bingo
+from src.key_pool import KeyPool
+from src.merkle import Merkle, MerkleLog # for checking the log
+from src.metrics import Metrics # for showing the playing area's metrics
+from src.profiler import Profiler
 
 class User:
     """This is a generic class for state and logic common to both players and callers."""
 
     PLAYING_AREA_PORT = 1024
 
+    # processes used to decrypt the deck and derive the cards, 0 does it all in this process
+    DECK_WORKERS = 0
+
+    # seconds the results of the game stay up before powering off
+    POWEROFF_DELAY = 1
+
     # set sys.stdin non-blocking
     orig_fl = fcntl.fcntl(sys.stdin, fcntl.F_GETFL)
     fcntl.fcntl(sys.stdin, fcntl.F_SETFL, orig_fl | os.O_NONBLOCK)
 
-    def __init__(self, nickname : str, pin : str):
+    def __init__(self, nickname : str, pin : str, table : int = None, workers : int = None, softcard : str = None, softcard_latency : float = 0,
+                 profile : str = None):
 
-        # read smartcard
-        self.CC_session = SmartCardSession.create(pin)
+        # read smartcard, or the software token standing in for it
+        self.CC_session = SmartCardSession.create(pin, softcard, softcard_latency)
         
         # if PIN failed, stop here
         if self.CC_session == None:
@@ -31,24 +44,45 @@ class User:
         self.pin = pin
         self.CC_public = self.CC_session.getPublicKey()
 
+        # convert tuple of bytes to tuple of base64 strings, the format it is sent in
+        modulus, pubexp = self.CC_public
+        self.CC_public_encoded = (base64.b64encode(modulus).decode('ascii'), base64.b64encode(pubexp).decode('ascii'))
+
         self.nickname = nickname
         self.sequence = None # given by the playing area
+        self.table = table # table to sit at, None lets the playing area pick one
+        self.shuffle_version = 1 # version of the deterministic shuffle, given by the playing area
         self.users = {} # userdata of all players
-        self.log = [] # message logs as received from
+        self.reset_log()
+        self.log_requested = False # whether a page of the log is on its way
+        self.playing_area_key = None # given in the reply to our hello
 
         self.deck_key = Crypto.sym_gen()[0] # sym key, AES128
-        self.private_key, self.public_key = Crypto.asym_gen()
+        Crypto.key_pool = KeyPool.from_env(KeyPool.user_path(modulus)) # our own keys generated ahead of time, the one we take is replaced in the background
+        private_key, self.public_key = Crypto.asym_gen()
+        self.private_key = Crypto.load_private_key(private_key) # kept parsed for the whole session
 
         self.encrypted_deck = None
+        self.deck_engine = DeckEngine(workers if workers != None else self.DECK_WORKERS)
 
         self.authenticated = False # not authenticated at the start
         self.registered = False # not registered at the start
 
+        self.register_handlers()
+
+        # profiling is off unless asked for, with the flag or the environment
+        profile = profile if profile else os.environ.get(Profiler.ENV)
+        self.profiler = Profiler.start(profile, self.dispatcher) if profile else None
+
         # connects to the playing area
         self.running = True
         self.connect()
         self.loop()
 
+        # the playing area closed the connection
+        if self.profiler:
+            self.profiler.stop()
+
     def connect(self):
         """Connects to the playing field"""
 
@@ -58,6 +92,13 @@ class User:
 
         print('[NET] You are now connected to the playing area.')
 
+        # reassembles the frames coming from the playing area
+        self.reader = FrameReader()
+
+        # JSON until the playing area picks one of the codecs we support
+        self.codec = JsonCodec.NAME
+        self.send(Hello(list(Proto.CODECS), shuffle_versions=list(Crypto.SHUFFLE_VERSIONS)))
+
         # setups up selector for receiving messages
         self.selector = selectors.DefaultSelector()
         self.selector.register(self.sock, selectors.EVENT_READ, self.service_connection)
@@ -78,46 +119,186 @@ class User:
 
     def service_connection(self, sock : socket):
 
-        msg = Proto.recv_msg(sock)
-        if msg:
-            if msg.header == 'AUTH':
-                self.authenticate(sock, msg)
-            elif msg.header == 'REGISTER':
-                self.register(sock, msg)
-            elif msg.header == 'GAMEINFO':
-                print(f'[GAME] I am the user of sequence {msg.sequence}')
-                self.sequence = msg.sequence
-                print(f'[GAME] Card and deck size is of {msg.card_size} and {msg.deck_size} numbers respectivally.')
-                self.card_size = msg.card_size
-                self.deck_size = msg.deck_size
-            elif msg.header == 'GETUSERS':
-                self.users = {int(entry['sequence']) : UserData.parse(entry) for entry in msg.response}
-                print('[SEC] Registered users:')
-                print('\n'.join([str(entry) for entry in self.users.values()]))
-            elif msg.header == 'GETLOG':
-                self.log = [LogEntry.parse(entry) for entry in msg.response]
-                print('[SEC] Logged messages:')
-                print('\n'.join([str(entry) for entry in self.log]))
-            elif msg.header == 'PARTY':
-                print(f'[GAME] Party status: {msg.current}/{msg.maximum} ({"Caller present" if msg.caller else "Caller absent"})')
-                if msg.caller and msg.current == msg.maximum:
-                    print('[GAME] Game starting shortly...')
-            elif msg.header == 'GENDECK':
-                self.generate_deck(sock, msg)
-            elif msg.header == 'GENCARD':
-                self.generate_card(sock, msg)
-            elif msg.header == 'DECKKEYREQ':
-                self.deck_key_request(sock, msg)
-            elif msg.header == 'DECKKEYRES':
-                self.deck_key_response(sock, msg)
-            elif msg.header == 'GAMEOVER':
-                print(f'[GAME] {msg}')
+        try:
+            received = self.reader.recv(sock)
+        except ConnectionError:
+            received = 0
+
+        # handle every message that is complete by now
+        if received:
+            for frame in self.reader.frames():
+                msg = Proto.parse_msg(frame)
+                if msg:
+                    self.handle_message(sock, msg)
         else:
             print(f"[NET] Connection with the playing area is closed.")
             self.selector.unregister(sock)
             sock.close()
             self.running = False
 
+    def send(self, msg : Message):
+        """Sends a message to the playing area with the negotiated codec"""
+        Proto.send_msg(self.sock, msg, self.codec)
+
+    def register_handlers(self):
+        """Registers the handler of every message type the user answers to"""
+        self.dispatcher = Dispatcher()
+        self.dispatcher.register(Hello, self.hello)
+        self.dispatcher.register(Authenticate, self.authenticate)
+        self.dispatcher.register(Register, self.register)
+        self.dispatcher.register(GameInfo, self.game_info)
+        self.dispatcher.register(GetUsers, self.user_list)
+        self.dispatcher.register(GetLog, self.audit_log)
+        self.dispatcher.register(LogProof, self.log_proof)
+        self.dispatcher.register(LogCheckpoint, self.log_checkpoint)
+        self.dispatcher.register(Stats, self.stats)
+        self.dispatcher.register(PartyUpdate, self.party_update)
+        self.dispatcher.register(GenerateCard, self.generate_card)
+        self.dispatcher.register(DeckKeyRequest, self.deck_key_request)
+        self.dispatcher.register(DeckKeyResponse, self.deck_key_response)
+        self.dispatcher.register(GameOver, self.game_over)
+
+    def handle_message(self, sock : socket, msg : Message):
+        """Handles a message received from the playing area"""
+        self.dispatcher.dispatch(sock, msg)
+
+    def hello(self, sock : socket, msg : Hello):
+        self.codec = msg.codec
+        self.playing_area_key = msg.public_key
+
+    def game_info(self, sock : socket, msg : GameInfo):
+        print(f'[GAME] I am the user of sequence {msg.sequence} at table {msg.table}')
+        self.table = msg.table
+        self.sequence = msg.sequence
+        print(f'[GAME] Card and deck size is of {msg.card_size} and {msg.deck_size} numbers respectivally.')
+        self.card_size = msg.card_size
+        self.deck_size = msg.deck_size
+        print(f'[GAME] The table uses version {msg.shuffle_version} of the shuffle.')
+        self.shuffle_version = msg.shuffle_version
+        self.reset_log() # the table has a log of its own
+
+    def user_list(self, sock : socket, msg : GetUsers):
+        self.users = {int(entry['sequence']) : UserData.parse(entry) for entry in msg.response}
+        print('[SEC] Registered users:')
+        print('\n'.join([str(entry) for entry in self.users.values()]))
+
+    def reset_log(self):
+        self.log = [] # message logs as received from the playing area, kept up to date incrementally
+        self.log_tree = MerkleLog() # Merkle accumulator over our copy of the log
+        self.log_head = None # hash of the last entry we have
+        self.log_signed = 0 # entries vouched for by a checkpoint signed by the playing area
+        self.log_pending_checkpoint = None # checkpoint covering entries we don't have yet
+
+    def request_log(self, subscribe : bool = False):
+        """Asks for the entries of the log we don't have yet"""
+        self.log_requested = True
+        self.send(GetLog(self.CC_public_encoded, "signature", start=len(self.log), subscribe=subscribe))
+
+    def audit_log(self, sock : socket, msg : GetLog):
+        pushed = msg.public_key == None # entries pushed as they are appended, not asked for
+        if not pushed:
+            self.log_requested = False
+
+        # entries were missed, ask for the gap unless a page is already on its way
+        if msg.start > len(self.log):
+            if not self.log_requested:
+                self.request_log()
+            return
+
+        # what we already have must not have been rewritten
+        proof = [bytes.fromhex(node) for node in msg.proof or []]
+        if not Merkle.verify_consistency(msg.start, msg.size, self.log_tree.root(msg.start), bytes.fromhex(msg.root), proof):
+            print('[SEC] The playing area rewrote logged messages we already had! The log cannot be trusted.')
+            return
+
+        # only keeps the entries we don't have yet, as long as each is chained to the one before it
+        new_entries = [LogEntry.parse(entry) for entry in msg.response[len(self.log) - msg.start:]]
+        head, leaves = self.log_head, []
+        for entry in new_entries:
+            if entry.prev_hash != head:
+                print(f'[SEC] Logged message {len(self.log) + len(leaves)} is not chained to the one before it! The log cannot be trusted.')
+                return
+            data = entry.canonical()
+            head = LogEntry.hash_of(data)
+            leaves.append(Merkle.leaf(data))
+
+        # in strict mode every entry is signed by the playing area
+        signed = [entry for entry in new_entries if entry.signature]
+        checks = [(self.playing_area_key, entry.signed_text(), base64.b64decode(entry.signature)) for entry in signed]
+        if not all(Crypto.verify_batch(checks)):
+            print('[SEC] Some logged messages were not signed by the playing area! The log cannot be trusted.')
+            return
+
+        self.log += new_entries
+        self.log_head = head
+        for leaf in leaves:
+            self.log_tree.append(leaf)
+
+        # once we have the whole log, it must be the one the playing area committed to
+        if len(self.log) == msg.size and (self.log_head != msg.head or self.log_tree.root().hex() != msg.root):
+            print('[SEC] The logged messages do not match the playing area\'s log! The log cannot be trusted.')
+
+        if new_entries:
+            print('[SEC] New logged messages:' if pushed else '[SEC] Logged messages:')
+            print('\n'.join([str(entry) for entry in new_entries]))
+
+        # one signature vouches for every entry the checkpoint covers
+        checkpoint = LogCheckpoint.parse(msg.checkpoint) if msg.checkpoint else self.log_pending_checkpoint
+        if checkpoint:
+            self.log_checkpoint(sock, checkpoint)
+
+        # the log is bigger than a page, ask for the next one
+        if not pushed and len(self.log) < msg.size:
+            self.request_log()
+
+    def log_checkpoint(self, sock : socket, msg : LogCheckpoint):
+        """Checks a checkpoint of the log signed by the playing area, which vouches for every entry before it"""
+        if msg.size <= self.log_signed:
+            return
+
+        if not msg.verify(self.playing_area_key):
+            print('[SEC] The checkpoint of the log was not signed by the playing area! The log cannot be trusted.')
+            return
+
+        # we don't have all of the entries yet, check them once we do
+        if msg.size > len(self.log):
+            self.log_pending_checkpoint = msg
+            return
+        self.log_pending_checkpoint = None
+
+        if self.log_tree.root(msg.size).hex() != msg.root:
+            print('[SEC] The playing area signed a different log than ours! The log cannot be trusted.')
+            return
+
+        self.log_signed = msg.size
+        print(f'[SEC] The playing area signed the first {msg.size} logged messages.')
+
+    def log_proof(self, sock : socket, msg : LogProof):
+        """Checks a single logged message is in the log, without needing the rest of it"""
+        entry = LogEntry.parse(msg.entry)
+        proof = [bytes.fromhex(node) for node in msg.proof]
+
+        if not Merkle.verify_inclusion(bytes.fromhex(msg.root), Merkle.leaf(entry.canonical()), msg.index, msg.size, proof):
+            print(f'[SEC] Logged message {msg.index} is not in the playing area\'s log! The log cannot be trusted.')
+        # if we have that much of the log, the playing area must have committed to the same one
+        elif msg.size <= len(self.log) and self.log_tree.root(msg.size).hex() != msg.root:
+            print('[SEC] The playing area\'s log does not match ours! The log cannot be trusted.')
+        else:
+            print(f'[SEC] Logged message {msg.index} is in the log of {msg.size} messages:')
+            print(entry)
+
+    def stats(self, sock : socket, msg : Stats):
+        print('[STATS] Metrics of the playing area:')
+        print(Metrics.report(msg.response))
+
+    def party_update(self, sock : socket, msg : PartyUpdate):
+        print(f'[GAME] Party status of table {msg.table}: {msg.current}/{msg.maximum} ({"Caller present" if msg.caller else "Caller absent"})')
+        if msg.caller and msg.current == msg.maximum:
+            print('[GAME] Game starting shortly...')
+
+    def game_over(self, sock : socket, msg : GameOver):
+        print(f'[GAME] {msg}')
+
     def authenticate(self, sock : socket, msg : Authenticate):        
         # only respond if not authenticated. just in case
         if not self.authenticated:
@@ -128,6 +309,9 @@ class User:
                 print('- To register yourself, type "REGISTER"')
                 print('- Authenticated users can see registed users. type "GETUSERS".')
                 print('- Authenticated users can audit the message log. type "GETLOG".')
+                print('- Authenticated users can follow the message log as it grows. type "WATCHLOG".')
+                print('- Authenticated users can check a single logged message is in the log. type "CHECKLOG <number>".')
+                print('- Authenticated users can see the metrics of the playing area. type "STATS".')
                 self.authenticated = True
                 return
 
@@ -137,7 +321,7 @@ class User:
             msg.response = base64.b64encode(response).decode('ascii') # Transform to sending format
 
             # send it back to the playing area
-            Proto.send_msg(sock, msg)
+            self.send(msg)
 
     def register(self, sock : socket, msg : Register):
         # if the registration was a success
@@ -166,7 +350,7 @@ class User:
         print('[SEC] Sending my deck key to other players...') 
         response = DeckKeyResponse(msg.sequence, self.deck_key)
         response.sign(self.private_key)
-        Proto.send_msg(sock, response)
+        self.send(response)
 
     def deck_key_response(self, sock : socket, msg : DeckKeyResponse):
         """Verifies and stores deck key response"""
@@ -193,33 +377,40 @@ class User:
 
         print('[SEC] Starting to decrypt the deck...')
 
+        # signatures are over the digest of the deck, computed once per layer
+        digest = Crypto.deck_digest(self.encrypted_deck)
+
         # the deck must have been signed by the caller next
         signature = self.deck_signatures.pop()
         signature = base64.b64decode(signature.encode('ascii'))  
-        
-        if not Crypto.verify(get_public_key(0), str(self.encrypted_deck), signature) :  
+        if not Crypto.verify(get_public_key(0), digest, signature):
             print('[ERROR] Deck was not last signed by the caller')
             return
 
         # starts unshuffling and decrypting deck to arrive at cards
         total = len(self.deck_keys)
-        for seq in reversed(range(total)):
-            # check if the signature is valid
-            signature = self.deck_signatures.pop()
-            signature = base64.b64decode(signature.encode('ascii'))  
-
-            if not Crypto.verify(get_public_key(seq), str(self.encrypted_deck), signature): # if it's invalid...
-                print("[ERROR] There's an invalid signature in the deck. Game should be aborted.")
-                self.poweroff()
-                return
-
-            # unencrypts the deck
-            deck_key = self.deck_keys[seq]
-            self.encrypted_deck = [Crypto.sym_decrypt(deck_key, num) for num in self.encrypted_deck]
-
-            # unshuffle the deck to get to the state of the previous player
-            if seq != 0: 
-                self.encrypted_deck = Crypto.deterministic_unshuffle(self.encrypted_deck, deck_key) # deck key is seed
+        try:
+            for seq in reversed(range(total)):
+                # a layer is only decrypted once its signature checks out. the digest of the layer below is only known after decrypting this one
+                signature = self.deck_signatures.pop()
+                signature = base64.b64decode(signature.encode('ascii'))  
+                if not Crypto.verify(get_public_key(seq), digest, signature): # if it's invalid...
+                    print("[ERROR] There's an invalid signature in the deck. Game should be aborted.")
+                    self.poweroff()
+                    return
+
+                # unencrypts the deck
+                deck_key = self.deck_keys[seq]
+                self.encrypted_deck = self.deck_engine.decrypt_layer(deck_key, self.encrypted_deck)
+
+                # unshuffle the deck to get to the state of the previous player
+                if seq != 0: 
+                    self.encrypted_deck = Crypto.deterministic_unshuffle(self.encrypted_deck, deck_key, self.shuffle_version) # deck key is seed
+                    digest = Crypto.deck_digest(self.encrypted_deck)
+        except ValueError: # a key did not match its layer
+            print("[ERROR] The deck could not be decrypted with the revealed keys. Game should be aborted.")
+            self.poweroff()
+            return
 
         # now we have the decrypted, unshuffled deck
         self.encrypted_deck = [int(num) for num in self.encrypted_deck] # converts str to int
@@ -231,48 +422,37 @@ class User:
         if(len(self.deck) != self.deck_size): # must have expected size
             valid = False
             print(f'[SEC] Deck has incorrect size! Size of {len(self.deck)}, expected {self.deck_size}.')
-        if len(self.deck) != len(set(self.deck)): # must not have duplicate numbers
+        out_of_bounds, repeated = Bingo.validate_deck(self.deck, self.deck_size)
+        if repeated: # must not have duplicate numbers
             valid = False
-            print('[SEC] Deck has repeated numbers!')
-        out_of_bounds = [num not in [i for i in range(0, self.deck_size)] for num in self.deck]
-        if (any(out_of_bounds)): # must not have out of bounds numbers
+            print(f'[SEC] Deck has repeated numbers! They are: {repeated}')
+        if out_of_bounds: # must not have out of bounds numbers
             valid = False
-            print(f'[SEC] Deck has out of bound numbers! They are: {[self.deck[idx] for idx, val in enumerate(out_of_bounds) if val]}')
+            print(f'[SEC] Deck has out of bound numbers! They are: {out_of_bounds}')
 
         if not valid:
             print('[SEC] Invalid deck. Abandoning game...')
             self.poweroff()
             return
 
-        # calculate each player card...
+        # calculate each player card, every one from the decrypted deck
+        self.cards = self.deck_engine.derive_cards(self.deck, {seq : self.deck_keys[seq] for seq in range(1,total)}, self.card_size, self.shuffle_version)
+        self.deck_engine.close()
+
         print('[GAME] The cards are as following:')
-        self.cards = {}
-        for seq in range(1,total):
-            seed = self.deck_keys[seq]
-            self.cards[seq] = Crypto.deterministic_shuffle(self.encrypted_deck, seed)[:self.card_size] 
-            print(f'{self.users[seq].nickname} {"(You)" if seq == self.sequence else ""} : {self.cards[seq]}')
+        for seq, card in self.cards.items():
+            print(f'{self.users[seq].nickname} {"(You)" if seq == self.sequence else ""} : {card}')
 
         # now that the deck and card are known, find the winner
         self.declare_winner()
 
     def declare_winner(self):
         """Verifies which card gets filled first"""
-        fill = {seq : [False for i in range(self.card_size)] for seq in self.users.keys() }
-        
+        # every card, in the order they got filled
+        order = Bingo.finishing_order(self.deck, self.cards)
+
         # sequence of the winners
-        winners = []
-
-        # look for winners
-        for num_deck in self.deck:
-            for seq, card in self.cards.items():
-                for idx, num_card in enumerate(card):
-                    if num_card == num_deck:
-                        fill[seq][idx] = True
-                        break
-            # if there are winners, stop looking
-            winners = [seq for seq, card in fill.items() if all(card)]
-            if winners != []:
-                break
+        winners = Bingo.winners(order)
 
         if winners:
             if len(winners) == 1:
@@ -283,11 +463,21 @@ class User:
         else:
             print('[GAME] Game over! There were no winners.')
 
+        if order:
+            print('[GAME] Finishing order:')
+            for place, (draw, seq) in enumerate(order, 1):
+                print(f'{place}. {self.users[seq].nickname} {"(You)" if seq == self.sequence else ""} on draw {draw + 1}')
+
         print('[NET] Powering off...')
-        time.sleep(1)
+        time.sleep(self.POWEROFF_DELAY)
         self.poweroff()
 
     def poweroff(self):
         """Shutdowns the server"""
+        print('[STATS] Time spent per message type:')
+        print(self.dispatcher.report())
+        if self.profiler:
+            self.profiler.stop()
+
         self.sock.close()
         sys.exit()